@@ -4,28 +4,187 @@ import subprocess
 import shlex
 import random
 import uuid
+import time
+import queue
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from typing import Optional
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, ImageFont
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Response, Request
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Header, Response, Request, Depends, Body
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse, unquote, urljoin
 import re
 from fastapi.responses import StreamingResponse, JSONResponse, FileResponse
+from starlette.background import BackgroundTask
+from starlette.concurrency import run_in_threadpool
+from email.utils import formatdate, parsedate_to_datetime
 from google.oauth2.service_account import Credentials as GCredentials
+from google.auth.transport.requests import Request as GAuthRequest
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload, MediaFileUpload
+from googleapiclient.errors import HttpError
 import io
 import glob
+import shutil
+import hashlib
+import json
+import struct
+import contextlib
+import math
+import base64
+import sqlite3
+import socket
+import ipaddress
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
 
 API_KEY = os.getenv("API_KEY", "change_me")
 FONT_PATH = "/System/Library/Fonts/Geneva.ttf"
 VIDEOS_DIR = os.path.join(os.getcwd(), "generated_videos")
 
+def _available_cpus() -> int:
+    """Número de CPUs utilizables respetando el límite del cgroup del contenedor"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    # cgroup v2: "max 100000" o "200000 100000"
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()[:2]
+        if quota != "max":
+            cpus = min(cpus, max(1, int(int(quota) // int(period))))
+    except (OSError, ValueError):
+        pass
+    return max(1, cpus)
+
+# Pool de workers de render: por defecto tantos como CPUs tenga el contenedor
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", str(_available_cpus())))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", "8"))
+RENDER_RETRY_AFTER = int(os.getenv("RENDER_RETRY_AFTER", "30"))
+JOBS_HISTORY_SIZE = int(os.getenv("JOBS_HISTORY_SIZE", "500"))
+# Tiempo máximo (s) de un trabajo de render antes de matar sus procesos (0 = sin límite)
+RENDER_TIMEOUT = float(os.getenv("RENDER_TIMEOUT", "0"))
+JOB_EVENTS_INTERVAL = float(os.getenv("JOB_EVENTS_INTERVAL", "1"))
+# Bytes finales de stderr que se incluyen en el error si un proceso falla
+STDERR_TAIL_BYTES = 16 * 1024
+
+# Render en streaming (/render/stream): MP4 fragmentado escrito a un pipe
+FRAGMENTED_MP4_ARGS = "-movflags frag_keyframe+empty_moov+default_base_moof -f mp4"
+STREAM_CHUNK_SIZE = 64 * 1024
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "64"))
+STREAM_CLIENT_TIMEOUT = int(os.getenv("STREAM_CLIENT_TIMEOUT", "30"))
+
+# Perfiles de encoder: preset/tune x264, CRF por defecto, resolución máxima,
+# intervalo de keyframes (segundos), +faststart y bitrate de audio
+# threads: hilos de x264 por encode (0 = automático); los borradores son pequeños y se
+# lanzan muchos a la vez, así que cada uno usa pocos hilos
+ENCODER_PROFILES = {
+    "draft": {
+        "preset": "ultrafast", "tune": "fastdecode", "crf": 28, "max_height": 960,
+        "keyint": 2, "faststart": True, "audio_bitrate": "96k", "threads": 2,
+    },
+    "social": {
+        "preset": "veryfast", "tune": None, "crf": 18, "max_height": None,
+        "keyint": 2, "faststart": True, "audio_bitrate": "192k", "threads": 0,
+    },
+    "archive": {
+        "preset": "slow", "tune": "film", "crf": 16, "max_height": None,
+        "keyint": 5, "faststart": True, "audio_bitrate": "256k", "threads": 0,
+    },
+}
+ENCODER_PROFILE = os.getenv("ENCODER_PROFILE", "social")
+# Fuerza los hilos de x264 de todos los perfiles (0 = los de cada perfil)
+ENCODER_THREADS = int(os.getenv("ENCODER_THREADS", "0"))
+
+# Encode por segmentos en paralelo para videos largos (chunked=auto|true|false)
+CHUNKED_MIN_DURATION = float(os.getenv("CHUNKED_MIN_DURATION", "180"))
+CHUNK_SECONDS = float(os.getenv("CHUNK_SECONDS", "30"))
+CHUNK_WORKERS = int(os.getenv("CHUNK_WORKERS", str(_available_cpus())))
+
+# Renditions: salidas extra del mismo render (nombre -> lado corto en píxeles), además de WxH y "poster"
+RENDITION_LADDER = {"1080p": 1080, "720p": 720, "480p": 480, "360p": 360}
+RENDITIONS_MAX = int(os.getenv("RENDITIONS_MAX", "6"))
+POSTER_AT = float(os.getenv("POSTER_AT", "1.0"))
+
+# Render por lotes (/render/batch)
+BATCH_MAX_VARIANTS = int(os.getenv("BATCH_MAX_VARIANTS", "50"))
+BATCH_PARALLELISM = int(os.getenv("BATCH_PARALLELISM", str(RENDER_WORKERS)))
+BATCH_OUTPUTS_PER_PROCESS = int(os.getenv("BATCH_OUTPUTS_PER_PROCESS", "4"))
+
+# Modo de audio por defecto: "two_pass" (recorte AAC previo) o "single_pass" (todo en un ffmpeg)
+AUDIO_MODES = ("two_pass", "single_pass")
+RENDER_AUDIO_MODE = os.getenv("RENDER_AUDIO_MODE", "two_pass")
+
+# Metadatos de ffprobe memoizados en memoria
+PROBE_CACHE_SIZE = int(os.getenv("PROBE_CACHE_SIZE", "512"))
+
+# Caché en disco de descargas de Google Drive (0 desactiva la caché)
+CACHE_DIR = os.getenv("CACHE_DIR", os.path.join(os.getcwd(), "cache"))
+DOWNLOAD_CACHE_MAX_MB = int(os.getenv("DOWNLOAD_CACHE_MAX_MB", "5120"))
+PRERENDER_LAYERS = os.getenv("PRERENDER_LAYERS", "true").lower() == "true"
+LAYER_CACHE_MAX_MB = int(os.getenv("LAYER_CACHE_MAX_MB", "256"))
+# Pistas de audio preprocesadas (AAC 48 kHz estéreo + loudness EBU R128) por versión de la fuente
+AUDIO_CACHE_MAX_MB = int(os.getenv("AUDIO_CACHE_MAX_MB", "1024"))
+AUDIO_ASSET_BITRATE = os.getenv("AUDIO_ASSET_BITRATE", "256k")
+# Sonoridad integrada (LUFS) de la música en mix_audio; 0 mantiene el volumen fijo de 0.35
+AUDIO_MIX_MUSIC_LUFS = float(os.getenv("AUDIO_MIX_MUSIC_LUFS", "-22"))
+MIX_MUSIC_VOLUME = 0.35  # volumen fijo de la música sin nivelado por loudness
+
+# Fuentes HTTP(S) genéricas (p. ej. nuestro object store) con una sesión requests compartida
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_METADATA_TTL = int(os.getenv("HTTP_METADATA_TTL", "30"))
+# Hosts HTTP(S) permitidos como fuente (vacío = cualquiera con direcciones públicas)
+HTTP_SOURCE_HOSTS = [h.strip().lower() for h in os.getenv("HTTP_SOURCE_HOSTS", "").split(",") if h.strip()]
+# Directorios locales permitidos para URLs file:// (vacío = file:// desactivado)
+FILE_SOURCE_ROOTS = [os.path.realpath(d) for d in os.getenv("FILE_SOURCE_ROOTS", "").split(",") if d.strip()]
+
+# Conexiones HTTP reutilizables del cliente de Drive
+DRIVE_HTTP_POOL_SIZE = int(os.getenv("DRIVE_HTTP_POOL_SIZE", "8"))
+DRIVE_HTTP_TIMEOUT = int(os.getenv("DRIVE_HTTP_TIMEOUT", "120"))
+DRIVE_METADATA_TTL = int(os.getenv("DRIVE_METADATA_TTL", "30"))
+# Segundos antes de volver a buscar credenciales de Drive tras no encontrarlas
+DRIVE_CREDENTIALS_RETRY = int(os.getenv("DRIVE_CREDENTIALS_RETRY", "60"))
+# Descargas de Drive por rangos HTTP en paralelo, reanudables y con reintentos con backoff
+DRIVE_CHUNK_MB = int(os.getenv("DRIVE_CHUNK_MB", "16"))
+DRIVE_PARALLEL_RANGES = int(os.getenv("DRIVE_PARALLEL_RANGES", "4"))
+DRIVE_RANGED_MIN_MB = int(os.getenv("DRIVE_RANGED_MIN_MB", "32"))
+DRIVE_RETRIES = int(os.getenv("DRIVE_RETRIES", "5"))
+DRIVE_BACKOFF_BASE = float(os.getenv("DRIVE_BACKOFF_BASE", "0.5"))
+DRIVE_PARTIAL_DIR = os.path.join(CACHE_DIR, "partial")
+# Encode mientras el video se descarga (MP4 con moov al principio, leído por un pipe)
+PIPELINED_INPUT = os.getenv("PIPELINED_INPUT", "true").lower() == "true"
+PIPELINED_HEADER_MAX_MB = int(os.getenv("PIPELINED_HEADER_MAX_MB", "16"))
+
 app = FastAPI(title="Video Render API", version="1.0.0")
 
 # Crear directorio para videos generados
 os.makedirs(VIDEOS_DIR, exist_ok=True)
+# Salidas de ffmpeg en curso; se publican en VIDEOS_DIR con un rename atómico
+STAGING_DIR = os.path.join(VIDEOS_DIR, ".staging")
+os.makedirs(STAGING_DIR, exist_ok=True)
+# Catálogo SQLite de videos publicados (listados, info y deduplicación sin escanear el directorio)
+CATALOG_PATH = os.getenv("CATALOG_PATH", os.path.join(VIDEOS_DIR, ".catalog.sqlite3"))
+
+# Retención de videos generados (0 = sin límite)
+VIDEOS_MAX_TOTAL_MB = int(os.getenv("VIDEOS_MAX_TOTAL_MB", "0"))
+VIDEOS_MAX_AGE_HOURS = float(os.getenv("VIDEOS_MAX_AGE_HOURS", "0"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "60"))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", "50"))
+STAGING_MAX_AGE_HOURS = float(os.getenv("STAGING_MAX_AGE_HOURS", "6"))
+# /download: los videos son inmutables por UUID, así que se cachean indefinidamente
+DOWNLOAD_CACHE_CONTROL = os.getenv("DOWNLOAD_CACHE_CONTROL", "public, max-age=31536000, immutable")
+DOWNLOAD_CHUNK_KB = int(os.getenv("DOWNLOAD_CHUNK_KB", "1024"))
+DOWNLOAD_MAX_RANGES = int(os.getenv("DOWNLOAD_MAX_RANGES", "16"))
 
 # Init Google Drive credentials if provided inline in env (JSON format only)
 def _init_inline_service_account_from_env():
@@ -50,13 +209,135 @@ def check_auth(authorization: Optional[str]):
     if token != API_KEY:
         raise HTTPException(status_code=403, detail="Forbidden")
 
-def run(cmd: str):
-    proc = subprocess.run(
-        shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    if proc.returncode != 0:
-        raise RuntimeError(proc.stderr.decode("utf-8", "ignore"))
-    return proc.stdout.decode("utf-8", "ignore")
+# Métricas Prometheus (/metrics); el estado de cachés y cola se lee al hacer scrape
+STAGE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RENDER_STAGE_SECONDS = Histogram(
+    "video_render_stage_seconds", "Duración de cada etapa del pipeline de render", ["stage"], buckets=STAGE_BUCKETS
+)
+RENDERS_TOTAL = Counter("video_renders_total", "Trabajos de render terminados", ["kind", "outcome"])
+DOWNLOAD_BYTES = Counter(
+    "video_render_download_bytes_total", "Bytes de fuentes obtenidos (del origen o de la caché)",
+    ["source", "origin", "cache"],
+)
+ENCODE_FPS = Histogram(
+    "video_render_encode_fps", "Velocidad del encode en frames por segundo", ["profile"],
+    buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 240, 360, 480),
+)
+OUTPUT_BITRATE_KBPS = Histogram(
+    "video_render_output_bitrate_kbps", "Bitrate medio de los videos generados", ["profile"],
+    buckets=(250, 500, 1000, 2000, 4000, 6000, 8000, 12000, 16000, 24000),
+)
+ACTIVE_PROCESSES = Gauge("video_render_active_processes", "Procesos ffmpeg/ffprobe en ejecución", ["binary"])
+
+def _stderr_tail(err) -> str:
+    err.seek(0, os.SEEK_END)
+    err.seek(max(0, err.tell() - STDERR_TAIL_BYTES))
+    return err.read().decode("utf-8", "ignore")
+
+def _progress_args(args: list, job, duration: float):
+    """Añade -progress a un comando ffmpeg asociado a un trabajo; devuelve (fd lectura, fd escritura)"""
+    if job is None or duration <= 0 or os.path.basename(args[0]) != "ffmpeg":
+        return None, None
+    read_fd, write_fd = os.pipe()
+    args[1:1] = ["-progress", f"pipe:{write_fd}", "-nostats"]
+    return read_fd, write_fd
+
+def _read_progress(read_fd: int, job, key: int, duration: float):
+    """Lee los bloques clave=valor de -progress y actualiza el progreso del trabajo"""
+    block = {}
+    with os.fdopen(read_fd, "r", errors="ignore") as f:
+        for line in f:
+            name, _, value = line.strip().partition("=")
+            block[name] = value
+            if name != "progress":
+                continue
+            try:
+                out_time = int(block.get("out_time_us", "0")) / 1_000_000
+            except ValueError:
+                out_time = 0.0
+            try:
+                fps = float(block.get("fps", "0"))
+            except ValueError:
+                fps = 0.0
+            try:
+                speed = float(block.get("speed", "0x").rstrip("x"))
+            except ValueError:
+                speed = 0.0
+            job.update_progress(key, max(0.0, out_time), fps, speed, duration)
+            block = {}
+
+def run(cmd: str, job=None, duration: float = 0.0, stdin_source=None, return_stderr: bool = False):
+    """Ejecuta un comando (ffmpeg/ffprobe) y devuelve su stdout.
+
+    stderr se escribe en un fichero temporal y solo se lee su final si el proceso falla.
+    Con job el proceso queda asociado al trabajo (cancelación y timeout) y, si además
+    duration > 0, se parsea -progress de ffmpeg para el porcentaje, fps y velocidad.
+    Con stdin_source (un _GrowingSource) el fichero se copia al stdin del proceso a
+    medida que se descarga. Con return_stderr devuelve el final de stderr en lugar de
+    stdout (p. ej. el informe de loudnorm).
+    """
+    args = shlex.split(cmd)
+    if job is not None:
+        job.check()
+    read_fd, write_fd = _progress_args(args, job, duration)
+    stdin_fd = feed_fd = None
+    if stdin_source is not None:
+        stdin_fd, feed_fd = os.pipe()
+    with tempfile.TemporaryFile() as err, ACTIVE_PROCESSES.labels(os.path.basename(args[0])).track_inprogress():
+        proc = subprocess.Popen(
+            args, stdin=stdin_fd, stdout=subprocess.PIPE, stderr=err,
+            pass_fds=(write_fd,) if write_fd is not None else (),
+        )
+        reader = None
+        if write_fd is not None:
+            os.close(write_fd)
+            reader = threading.Thread(target=_read_progress, args=(read_fd, job, proc.pid, duration), daemon=True)
+            reader.start()
+        feeder = None
+        if stdin_fd is not None:
+            os.close(stdin_fd)
+            stop_feed = threading.Event()
+            feeder = threading.Thread(target=stdin_source.feed, args=(feed_fd, stop_feed), daemon=True)
+            feeder.start()
+        if job is not None:
+            job.attach(proc)
+        try:
+            stdout, _ = proc.communicate()
+            if reader:
+                reader.join()
+        finally:
+            if feeder:
+                stop_feed.set()
+                feeder.join()
+            if job is not None:
+                job.detach(proc)
+        if job is not None:
+            job.check()
+        if proc.returncode != 0:
+            raise RuntimeError(_stderr_tail(err))
+        if return_stderr:
+            return _stderr_tail(err)
+    return stdout.decode("utf-8", "ignore")
+
+# Procesos ffmpeg de encode simultáneos en todo el servicio: los renders, cada segmento
+# de un encode por segmentos y cada proceso de un lote comparten RENDER_WORKERS huecos
+ENCODE_SLOTS = threading.BoundedSemaphore(max(1, RENDER_WORKERS))
+
+@contextlib.contextmanager
+def encode_slot(job=None):
+    """Reserva un hueco de ENCODE_SLOTS mientras dura el bloque (atento a cancelaciones)"""
+    while not ENCODE_SLOTS.acquire(timeout=1):
+        if job is not None:
+            job.check()
+    try:
+        yield
+    finally:
+        ENCODE_SLOTS.release()
+
+def _run_encode(cmd: str, job=None, duration: float = 0.0) -> str:
+    """run() de un encode dentro de un hueco de ENCODE_SLOTS"""
+    with encode_slot(job):
+        return run(cmd, job, duration)
 
 def _to_direct_drive_url(url: str) -> str:
     if "drive.google.com" not in url:
@@ -81,8 +362,255 @@ def _to_direct_drive_url(url: str) -> str:
     
     return url
 
-def _download_with_drive_confirm(url: str, out_path: str) -> None:
-    """Función de descarga que usa exclusivamente la API de Google Drive"""
+class DownloadCache:
+    """Caché LRU en disco, acotada por tamaño, de ficheros fuente descargados.
+
+    Las claves incluyen la versión del fichero (md5/modifiedTime de Drive), así que
+    una entrada nunca queda obsoleta. Peticiones concurrentes de la misma clave
+    comparten una única descarga en curso; si se aborta porque el trabajo que la
+    lanzó se canceló, una de las que esperaban la retoma.
+    """
+    def __init__(self, directory: str, max_bytes: int, label: str = "download"):
+        self.directory = directory
+        self.label = label
+        self.max_bytes = max_bytes
+        self._index = OrderedDict()  # clave -> tamaño en bytes, de menos a más reciente
+        self._inflight = {}          # clave -> [Event, error]
+        self._pins = {}              # clave -> copias en curso (la expulsión las respeta)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        os.makedirs(self.directory, exist_ok=True)
+        self._load_index()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _load_index(self):
+        # Reconstruir el índice desde disco, ordenado por último uso (mtime)
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            if name.endswith(".part"):
+                # Descargas interrumpidas de una ejecución anterior
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, name, st.st_size))
+        for _, name, size in sorted(entries):
+            self._index[name] = size
+            self.total_bytes += size
+        print(f"DEBUG: {self.label.capitalize()} cache loaded {len(self._index)} entries ({self.total_bytes} bytes)")
+
+    def _materialize(self, path: str, out_path: str):
+        """Enlaza (o copia si no es posible) la entrada cacheada en la ruta de trabajo"""
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        try:
+            os.link(path, out_path)
+        except OSError:
+            shutil.copyfile(path, out_path)
+
+    def _unpin(self, key: str):
+        with self._lock:
+            self._pins[key] -= 1
+            if not self._pins[key]:
+                del self._pins[key]
+            self._evict()
+
+    def fetch(self, key: str, out_path: str, download_fn) -> bool:
+        """Deja el fichero de `key` en out_path; devuelve True si vino de la caché.
+
+        El enlace o copia a out_path se hace fuera del lock (con la entrada fijada para
+        que no se expulse), así que una copia lenta no bloquea al resto de peticiones.
+        """
+        while True:
+            leader = False
+            with self._lock:
+                hit = key in self._index
+                if hit:
+                    self._index.move_to_end(key)
+                    self.hits += 1
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                else:
+                    pending = self._inflight.get(key)
+                    if pending is None:
+                        pending = [threading.Event(), None]
+                        self._inflight[key] = pending
+                        self.misses += 1
+                        leader = True
+                    else:
+                        self.coalesced += 1
+
+            if hit:
+                path = self._path(key)
+                try:
+                    self._materialize(path, out_path)
+                    os.utime(path)
+                    return True
+                except FileNotFoundError:
+                    # Borrado externamente: olvidar la entrada y descargar de nuevo
+                    with self._lock:
+                        if key in self._index:
+                            self.total_bytes -= self._index.pop(key)
+                        self.hits -= 1
+                    continue
+                finally:
+                    self._unpin(key)
+
+            if not leader:
+                # Otra petición ya está descargando este fichero: esperar y reutilizarlo
+                print(f"DEBUG: Waiting for in-flight {self.label} of {key}")
+                pending[0].wait()
+                if pending[1] is not None:
+                    raise RuntimeError(pending[1])
+                continue
+
+            tmp_path = f"{self._path(key)}.{uuid.uuid4().hex}.part"
+            try:
+                download_fn(tmp_path)
+                size = os.path.getsize(tmp_path)
+                if size == 0:
+                    raise RuntimeError("Download failed - output file is empty")
+                os.replace(tmp_path, self._path(key))
+                with self._lock:
+                    self._index[key] = size
+                    self.total_bytes += size
+                    self._pins[key] = self._pins.get(key, 0) + 1
+                    self._evict()
+                try:
+                    self._materialize(self._path(key), out_path)
+                finally:
+                    self._unpin(key)
+                return False
+            except Exception as e:
+                # Un abort es del trabajo que lidera, no de la fuente: los demás reintentan
+                if not isinstance(e, DownloadAborted):
+                    pending[1] = str(e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                pending[0].set()
+
+    def _evict(self):
+        # Llamar con el lock tomado; nunca se expulsa la entrada más reciente ni una fijada
+        for key in list(self._index)[:-1]:
+            if self.total_bytes <= self.max_bytes:
+                break
+            if key in self._pins:
+                continue
+            size = self._index.pop(key)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+            print(f"DEBUG: Evicted {key} from {self.label} cache ({size} bytes)")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._index),
+                "total_bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "evictions": self.evictions,
+            }
+
+DOWNLOAD_CACHE = (
+    DownloadCache(os.path.join(CACHE_DIR, "downloads"), DOWNLOAD_CACHE_MAX_MB * 1024 * 1024)
+    if DOWNLOAD_CACHE_MAX_MB > 0 else None
+)
+
+# Capas estáticas (oscurecido + carátula + texto) pre-compuestas en un PNG por combinación
+LAYER_CACHE = (
+    DownloadCache(os.path.join(CACHE_DIR, "layers"), LAYER_CACHE_MAX_MB * 1024 * 1024, label="layer")
+    if LAYER_CACHE_MAX_MB > 0 else None
+)
+
+# Pistas de audio preprocesadas: "<clave>.m4a" y sus estadísticas en "<clave>.json"
+AUDIO_ASSET_CACHE = (
+    DownloadCache(os.path.join(CACHE_DIR, "audio"), AUDIO_CACHE_MAX_MB * 1024 * 1024, label="audio")
+    if AUDIO_CACHE_MAX_MB > 0 else None
+)
+
+_DRIVE_METADATA = {}  # file_id -> (timestamp, metadatos)
+_DRIVE_METADATA_LOCK = threading.Lock()
+
+def _drive_file_metadata(service, file_id: str) -> Optional[dict]:
+    """Metadatos de Drive usados para versionar la caché (None si no se pueden obtener).
+
+    Se memorizan DRIVE_METADATA_TTL segundos para no repetir la llamada dentro de un render.
+    """
+    now = time.time()
+    with _DRIVE_METADATA_LOCK:
+        cached = _DRIVE_METADATA.get(file_id)
+        if cached and now - cached[0] < DRIVE_METADATA_TTL:
+            return cached[1]
+    try:
+        meta = DRIVE_CLIENT.execute(service.files().get(
+            fileId=file_id, fields="id,name,size,md5Checksum,modifiedTime,mimeType"
+        ))
+    except Exception as e:
+        print(f"DEBUG: Could not get Drive metadata for {file_id}: {e}")
+        return None
+    with _DRIVE_METADATA_LOCK:
+        _DRIVE_METADATA[file_id] = (now, meta)
+        # Purga simple de entradas caducadas
+        if len(_DRIVE_METADATA) > 1024:
+            for fid in [k for k, (ts, _) in _DRIVE_METADATA.items() if now - ts >= DRIVE_METADATA_TTL]:
+                del _DRIVE_METADATA[fid]
+    return meta
+
+def _drive_file_id(url: str) -> Optional[str]:
+    """Extrae el file id de una URL de Google Drive"""
+    url = _to_direct_drive_url(url)
+    m = re.search(r"[?&]id=([A-Za-z0-9_-]+)", url) or re.search(r"/file/d/([A-Za-z0-9_-]+)", url)
+    return m.group(1) if m else None
+
+def _source_version(url: str) -> Optional[str]:
+    """Identificador de contenido de una fuente (origen + id + versión), o None si no se conoce"""
+    origin = source_origin(url)
+    if origin == "http":
+        return HTTP_FETCHER.version(url)
+    if origin == "file":
+        return _local_file_version(url)
+    file_id = _drive_file_id(url)
+    service = _maybe_get_drive_service() if file_id else None
+    if not service:
+        return None
+    meta = _drive_file_metadata(service, file_id)
+    version = (meta or {}).get("md5Checksum") or (meta or {}).get("modifiedTime")
+    return f"drive:{file_id}:{version}" if version else None
+
+def _drive_cache_key(file_id: str, meta: Optional[dict]) -> Optional[str]:
+    if not meta:
+        return None
+    version = meta.get("md5Checksum") or meta.get("modifiedTime")
+    if not version:
+        return None
+    return f"{file_id}-{hashlib.sha1(version.encode()).hexdigest()[:16]}"
+
+def _download_with_drive_confirm(url: str, out_path: str, progress=None) -> dict:
+    """Función de descarga que usa exclusivamente la API de Google Drive.
+
+    Con progress (un _GrowingSource) se anuncian los bytes a medida que se escriben.
+    """
     url = _to_direct_drive_url(url)
     print(f"DEBUG: Downloading from URL: {url}")
     
@@ -103,9 +631,22 @@ def _download_with_drive_confirm(url: str, out_path: str) -> None:
     file_id_api = file_id_match.group(1)
     print(f"DEBUG: Using Google Drive API for file ID: {file_id_api}")
     
+    meta = _drive_file_metadata(service, file_id_api)
+    cache_key = _drive_cache_key(file_id_api, meta)
+    cache_hit = False
+    if progress is not None:
+        progress.source = {
+            "file_id": file_id_api, "version": (meta or {}).get("md5Checksum") or (meta or {}).get("modifiedTime"),
+        }
+
     try:
-        _download_via_drive_api(service, file_id_api, out_path)
-        print("DEBUG: Google Drive API download completed")
+        if DOWNLOAD_CACHE and cache_key:
+            cache_hit = DOWNLOAD_CACHE.fetch(
+                cache_key, out_path, lambda tmp_path: _download_via_drive_api(service, file_id_api, tmp_path, meta, progress)
+            )
+        else:
+            _download_via_drive_api(service, file_id_api, out_path, meta, progress)
+        print(f"DEBUG: Google Drive API download completed (cache {'hit' if cache_hit else 'miss'})")
         
         if not os.path.exists(out_path):
             raise RuntimeError("Download failed - output file was not created")
@@ -115,7 +656,12 @@ def _download_with_drive_confirm(url: str, out_path: str) -> None:
             raise RuntimeError("Download failed - output file is empty")
         
         print(f"DEBUG: Successfully downloaded {file_size} bytes via Drive API")
-        return
+        return {
+            "file_id": file_id_api,
+            "version": (meta or {}).get("md5Checksum") or (meta or {}).get("modifiedTime"),
+            "cache_hit": cache_hit,
+            "size_bytes": file_size,
+        }
         
     except Exception as e:
         print(f"DEBUG: Google Drive API download failed: {str(e)}")
@@ -124,9 +670,45 @@ def _download_with_drive_confirm(url: str, out_path: str) -> None:
             os.remove(out_path)
         raise RuntimeError(f"Google Drive download failed: {str(e)}")
 
-def _maybe_get_drive_service():
-    """Obtiene el servicio de Google Drive priorizando credenciales JSON"""
-    try:
+class DriveHTTPError(Exception):
+    """Respuesta inesperada de Drive; status None indica un error transitorio (lectura incompleta)"""
+    def __init__(self, status: Optional[int], message: str):
+        super().__init__(message)
+        self.status = status
+
+class DriveRangeUnsupported(Exception):
+    """El servidor ignoró la cabecera Range y respondió con el fichero entero"""
+
+# Errores que merece la pena reintentar: red (httplib2 y sockets) y respuestas HTTP de Drive
+_DRIVE_TRANSIENT_ERRORS = (httplib2.HttpLib2Error, OSError, DriveHTTPError, HttpError)
+
+class DriveClient:
+    """Cliente de Google Drive único por proceso.
+
+    Las credenciales y el discovery se resuelven una sola vez; cada petición usa
+    una conexión HTTP prestada de un pool (httplib2 no es thread-safe) y el token
+    se refresca bajo lock sin reconstruir el servicio.
+    """
+    SCOPES = ["https://www.googleapis.com/auth/drive"]
+
+    def __init__(self, pool_size: int, timeout: int):
+        self.pool_size = max(1, pool_size)
+        self.timeout = timeout
+        self.credentials_path = None
+        self._creds = None
+        self._service = None
+        self._failed_at = None  # momento del último intento sin credenciales válidas
+        self._lock = threading.Lock()
+        self._token_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._pool = queue.LifoQueue()
+        self.builds = 0
+        self.refreshes = 0
+        self.http_clients = 0
+        self.requests = 0
+        self.retries = 0
+
+    def _find_credentials_path(self) -> Optional[str]:
         creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
         
         # Priorizar credenciales locales en el repo (solo para desarrollo local)
@@ -152,43 +734,742 @@ def _maybe_get_drive_service():
         if not creds_path or not os.path.exists(creds_path):
             print("DEBUG: No Google Drive credentials found")
             return None
-            
-        # Verificar que el archivo de credenciales es válido JSON
+        return creds_path
+
+    def _count(self, name: str):
+        with self._stats_lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _credentials_failed(self) -> bool:
+        return self._failed_at is not None and time.monotonic() - self._failed_at < DRIVE_CREDENTIALS_RETRY
+
+    def service(self):
+        """Servicio de Drive construido perezosamente (None si no hay credenciales válidas).
+
+        La falta de credenciales se recuerda DRIVE_CREDENTIALS_RETRY segundos para no
+        repetir la búsqueda en disco en cada petición.
+        """
+        if self._service is not None:
+            return self._service
+        if self._credentials_failed():
+            return None
+        with self._lock:
+            if self._service is not None:
+                return self._service
+            if self._credentials_failed():
+                return None
+            service = self._build_service()
+            self._failed_at = None if service is not None else time.monotonic()
+            return service
+
+    def _build_service(self):
+        """Construye el servicio de Drive con las credenciales encontradas (None si no hay)"""
+        try:
+            creds_path = self._find_credentials_path()
+            if not creds_path:
+                return None
+
+            # Verificar que el archivo de credenciales es válido JSON
+            try:
+                with open(creds_path, 'r') as f:
+                    cred_data = json.load(f)
+                    if cred_data.get('type') != 'service_account':
+                        print("DEBUG: Credentials file is not a service account")
+                        return None
+            except json.JSONDecodeError:
+                print("DEBUG: Credentials file is not valid JSON")
+                return None
+
+            creds = GCredentials.from_service_account_file(creds_path, scopes=self.SCOPES)
+            service = build("drive", "v3", credentials=creds, cache_discovery=False)
+            self._creds = creds
+            self.credentials_path = creds_path
+            self._service = service
+            self._count("builds")
+            print(f"DEBUG: Google Drive service initialized successfully using: {creds_path}")
+            return service
+        except Exception as e:
+            print(f"DEBUG: Could not init Drive service: {e}")
+            return None
+
+    def _ensure_token(self):
+        # Un único refresh aunque varios hilos encuentren el token caducado a la vez
+        if self._creds.valid:
+            return
+        with self._token_lock:
+            if not self._creds.valid:
+                self._creds.refresh(GAuthRequest())
+                self._count("refreshes")
+                print("DEBUG: Google Drive access token refreshed")
+
+    def _acquire_http(self):
+        self._ensure_token()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            self._count("http_clients")
+            return AuthorizedHttp(self._creds, http=httplib2.Http(timeout=self.timeout))
+
+    def _release_http(self, http):
+        if self._pool.qsize() < self.pool_size:
+            self._pool.put(http)
+
+    def execute(self, request):
+        """Ejecuta una petición de la API con una conexión del pool"""
+        http = self._acquire_http()
+        try:
+            self._count("requests")
+            return request.execute(http=http)
+        finally:
+            self._release_http(http)
+
+    def _with_retries(self, fn, what: str):
+        """Ejecuta fn reintentando errores de red, 429 y 5xx con backoff exponencial y jitter"""
+        for attempt in range(DRIVE_RETRIES + 1):
+            try:
+                return fn()
+            except _DRIVE_TRANSIENT_ERRORS as e:
+                status = getattr(e, "status", None) or getattr(getattr(e, "resp", None), "status", None)
+                retriable = status is None or status == 429 or status >= 500
+                if not retriable or attempt == DRIVE_RETRIES:
+                    raise
+                delay = DRIVE_BACKOFF_BASE * (2 ** attempt) + random.uniform(0, DRIVE_BACKOFF_BASE)
+                self._count("retries")
+                print(f"DEBUG: Drive {what} failed ({e}), retry {attempt + 1}/{DRIVE_RETRIES} in {delay:.1f}s")
+                time.sleep(delay)
+
+    def download(self, request, fh, chunksize: int = DRIVE_CHUNK_MB * 1024 * 1024):
+        """Descarga el contenido de una petición get_media en fh con una conexión del pool"""
+        http = self._acquire_http()
         try:
-            with open(creds_path, 'r') as f:
-                import json
-                cred_data = json.load(f)
-                if cred_data.get('type') != 'service_account':
-                    print("DEBUG: Credentials file is not a service account")
+            self._count("requests")
+            request.http = http
+            downloader = MediaIoBaseDownload(fh, request, chunksize=chunksize)
+            done = False
+            while not done:
+                # MediaIoBaseDownload reintenta cada trozo con su propio backoff
+                _, done = downloader.next_chunk(num_retries=DRIVE_RETRIES)
+        finally:
+            self._release_http(http)
+
+    def download_range(self, uri: str, start: int, end: int) -> bytes:
+        """Bytes [start, end] de un fichero (petición HTTP Range) con reintentos"""
+        def _get():
+            http = self._acquire_http()
+            self._count("requests")
+            # Si la petición falla la conexión no vuelve al pool
+            resp, content = http.request(uri, "GET", headers={"Range": f"bytes={start}-{end}"})
+            self._release_http(http)
+            if resp.status == 200:
+                # No se reintenta: cada petición descargaría el fichero entero
+                raise DriveRangeUnsupported(f"HTTP 200 for bytes {start}-{end}")
+            if resp.status != 206:
+                raise DriveHTTPError(resp.status, f"HTTP {resp.status} for bytes {start}-{end}")
+            if len(content) != end - start + 1:
+                raise DriveHTTPError(None, f"short read for bytes {start}-{end}: {len(content)} bytes")
+            return content
+        return self._with_retries(_get, f"range {start}-{end}")
+
+    def stats(self) -> dict:
+        return {
+            "initialized": self._service is not None,
+            "builds": self.builds,
+            "token_refreshes": self.refreshes,
+            "http_clients": self.http_clients,
+            "pooled_http_clients": self._pool.qsize(),
+            "requests": self.requests,
+            "retries": self.retries,
+        }
+
+DRIVE_CLIENT = DriveClient(DRIVE_HTTP_POOL_SIZE, DRIVE_HTTP_TIMEOUT)
+
+def _maybe_get_drive_service():
+    """Obtiene el servicio de Google Drive compartido (None si no hay credenciales)"""
+    return DRIVE_CLIENT.service()
+
+_PARTIAL_LOCKS = {}  # ruta parcial -> [Lock, hilos que lo usan] (una sola descarga por fichero y versión)
+_PARTIAL_LOCKS_LOCK = threading.Lock()
+
+class DownloadAborted(RuntimeError):
+    """La descarga se interrumpió porque su trabajo se canceló o superó RENDER_TIMEOUT"""
+
+class _GrowingSource:
+    """Fichero fuente que aún se está descargando y que ffmpeg consume por un pipe.
+
+    La descarga lo anuncia con begin() y publica con advance() los bytes contiguos
+    disponibles desde el inicio; finish() marca el final o el error. abort() pide a
+    los bucles de descarga que paren en el siguiente trozo (check_aborted()).
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._fd = None
+        self.source = None
+        self.size = None
+        self.available = 0
+        self.done = False
+        self.error = None
+        self.aborted = False
+
+    def begin(self, path: str, size: Optional[int] = None):
+        with self._cond:
+            # El descriptor sigue siendo válido aunque la caché renombre el fichero
+            if self._fd is not None:
+                os.close(self._fd)
+            self._fd = os.open(path, os.O_RDONLY)
+            self.size = size
+            self._cond.notify_all()
+
+    def abort(self):
+        with self._cond:
+            self.aborted = True
+            self._cond.notify_all()
+
+    def check_aborted(self):
+        if self.aborted:
+            raise DownloadAborted("Download aborted")
+
+    def advance(self, available: int):
+        with self._cond:
+            if available > self.available:
+                self.available = available
+                self._cond.notify_all()
+
+    def finish(self, error: Optional[Exception] = None):
+        with self._cond:
+            if self._fd is not None and error is None:
+                self.available = os.fstat(self._fd).st_size
+            self.done = True
+            self.error = error
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def header(self, job=None) -> Optional[bytes]:
+        """Bytes hasta el final de moov si es un MP4 faststart que sigue descargándose, o None"""
+        limit = PIPELINED_HEADER_MAX_MB * 1024 * 1024
+        want = 64 * 1024
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.done or (self._fd is not None and self.available >= min(want, self.size or want)),
+                    timeout=1.0,
+                )
+                if self.done:
+                    # Ya descargado (o servido por la caché): se usa el fichero completo
                     return None
-        except json.JSONDecodeError:
-            print("DEBUG: Credentials file is not valid JSON")
+                fd, available = self._fd, self.available
+            if job is not None:
+                job.check()
+            if fd is None or available < min(want, self.size or want):
+                continue
+            head = os.pread(fd, min(available, limit), 0)
+            moov_end = _mp4_moov_end(head)
+            if moov_end == -1 or (moov_end or 0) > limit:
+                return None
+            if moov_end is not None and available >= moov_end:
+                return head[:moov_end]
+            want = moov_end or want * 2
+            if want > limit:
+                return None
+
+    def feed(self, write_fd: int, stop: threading.Event):
+        """Copia el fichero a write_fd a medida que llega; cierra el pipe al acabar o si falla la descarga"""
+        offset = 0
+        try:
+            while not stop.is_set():
+                with self._cond:
+                    self._cond.wait_for(lambda: self.available > offset or self.done or stop.is_set(), timeout=0.5)
+                    available, done, error = self.available, self.done, self.error
+                if error is not None or (done and offset >= available):
+                    return
+                if offset >= available:
+                    continue
+                data = os.pread(self._fd, min(available - offset, 1024 * 1024), offset)
+                if not data:
+                    return
+                view = memoryview(data)
+                while view:
+                    view = view[os.write(write_fd, view):]
+                offset += len(data)
+        except OSError:
+            # ffmpeg cerró su entrada (terminó o fue cancelado)
+            pass
+        finally:
+            os.close(write_fd)
+
+class _ProgressWriter:
+    """Fichero de destino que publica en un _GrowingSource los bytes escritos"""
+    def __init__(self, fh, progress: _GrowingSource):
+        self._fh = fh
+        self._progress = progress
+        self.written = 0
+
+    def write(self, data) -> int:
+        self._progress.check_aborted()
+        n = self._fh.write(data)
+        self.written += n
+        self._progress.advance(self.written)
+        return n
+
+def _mp4_moov_end(head: bytes) -> Optional[int]:
+    """Fin del átomo moov si está antes de mdat; -1 si no lo está (o no es MP4), None si faltan bytes"""
+    pos = 0
+    while pos + 8 <= len(head):
+        size, kind = struct.unpack(">I4s", head[pos:pos + 8])
+        if pos == 0 and kind != b"ftyp":
+            return -1
+        if size == 1:
+            if pos + 16 > len(head):
+                return None
+            size = struct.unpack(">Q", head[pos + 8:pos + 16])[0]
+        if size < 8 or kind == b"mdat":
+            return -1
+        if kind == b"moov":
+            return pos + size
+        pos += size
+    return None
+
+def _download_ranged(uri: str, size: int, out_path: str, state_path: Optional[str] = None,
+                     progress: Optional[_GrowingSource] = None):
+    """Descarga por rangos en paralelo escribiendo cada trozo en su offset.
+
+    Con state_path los trozos completados se anotan en un JSON, de modo que una
+    descarga interrumpida continúa desde ellos en lugar de empezar de cero.
+    """
+    chunk = max(1, DRIVE_CHUNK_MB) * 1024 * 1024
+    ranges = [(start, min(start + chunk, size) - 1) for start in range(0, size, chunk)]
+
+    completed = set()
+    if state_path and os.path.exists(state_path) and os.path.exists(out_path):
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+            if state.get("size") == size and state.get("chunk") == chunk:
+                completed = set(state.get("completed", []))
+        except (OSError, ValueError):
+            completed = set()
+    if completed:
+        print(f"DEBUG: Resuming Drive download: {len(completed)}/{len(ranges)} chunks already on disk")
+
+    def _save_state():
+        tmp_state = f"{state_path}.tmp"
+        with open(tmp_state, "w") as f:
+            json.dump({"size": size, "chunk": chunk, "completed": sorted(completed)}, f)
+        os.replace(tmp_state, state_path)
+
+    def _contiguous() -> int:
+        # Bytes disponibles sin huecos desde el inicio del fichero
+        available = 0
+        for start, end in ranges:
+            if start not in completed:
+                break
+            available = end + 1
+        return available
+
+    fd = os.open(out_path, os.O_RDWR | os.O_CREAT)
+    try:
+        pending = [r for r in ranges if r[0] not in completed]
+        if not completed:
+            os.ftruncate(fd, size)
+            # El primer rango va solo: si el servidor ignora Range (DriveRangeUnsupported)
+            # se descubre con una única descarga completa y no con una por worker
+            start, end = pending.pop(0)
+            os.pwrite(fd, DRIVE_CLIENT.download_range(uri, start, end), start)
+            completed.add(start)
+            if state_path:
+                _save_state()
+        if progress is not None:
+            progress.begin(out_path, size)
+            progress.advance(_contiguous())
+        lock = threading.Lock()
+
+        def _fetch(start: int, end: int):
+            if progress is not None:
+                progress.check_aborted()
+            data = DRIVE_CLIENT.download_range(uri, start, end)
+            os.pwrite(fd, data, start)
+            with lock:
+                completed.add(start)
+                if state_path:
+                    _save_state()
+                if progress is not None:
+                    progress.advance(_contiguous())
+
+        workers = max(1, min(DRIVE_PARALLEL_RANGES, len(pending) or 1))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="drive-range") as pool:
+            futures = [pool.submit(_fetch, start, end) for start, end in pending]
+            done, _ = wait(futures, return_when=FIRST_EXCEPTION)
+            for fut in done:
+                if fut.exception():
+                    for other in futures:
+                        other.cancel()
+                    raise fut.exception()
+    finally:
+        os.close(fd)
+
+def _download_stream(request, out_path: str, size: Optional[int] = None,
+                     progress: Optional[_GrowingSource] = None):
+    """Descarga una petición get_media con una sola petición en streaming"""
+    with io.FileIO(out_path, "wb") as fh:
+        if progress is not None:
+            progress.begin(out_path, size)
+            fh = _ProgressWriter(fh, progress)
+        DRIVE_CLIENT.download(request, fh)
+
+def _download_via_drive_api(service, file_id: str, out_path: str, meta: Optional[dict] = None,
+                            progress: Optional[_GrowingSource] = None):
+    request = service.files().get_media(fileId=file_id)
+    size = int((meta or {}).get("size") or 0)
+    if size < DRIVE_RANGED_MIN_MB * 1024 * 1024:
+        # Ficheros pequeños (o sin tamaño conocido): una sola petición en streaming
+        _download_stream(request, out_path, size or None, progress)
+        return
+
+    t0 = time.perf_counter()
+    version = (meta or {}).get("md5Checksum") or (meta or {}).get("modifiedTime")
+    try:
+        if not version:
+            # Sin versión no se puede saber si los bytes parciales siguen siendo válidos
+            _download_ranged(request.uri, size, out_path, progress=progress)
+        else:
+            _download_partial(request.uri, file_id, version, size, out_path, progress)
+    except DriveRangeUnsupported as e:
+        print(f"DEBUG: Drive ignored Range for {file_id} ({e}), falling back to a single stream")
+        _download_stream(request, out_path, size, progress)
+    elapsed = time.perf_counter() - t0
+    print(f"DEBUG: Ranged Drive download of {size} bytes in {elapsed:.2f}s "
+          f"({size / max(elapsed, 1e-6) / 1024 / 1024:.1f} MB/s)")
+
+def _download_partial(uri: str, file_id: str, version: str, size: int, out_path: str,
+                      progress: Optional[_GrowingSource] = None):
+    """Descarga por rangos reanudable en DRIVE_PARTIAL_DIR, una sola a la vez por fichero y versión"""
+    os.makedirs(DRIVE_PARTIAL_DIR, exist_ok=True)
+    name = hashlib.sha1(f"{file_id}:{version}".encode("utf-8")).hexdigest()
+    partial = os.path.join(DRIVE_PARTIAL_DIR, f"{name}.part")
+    with _PARTIAL_LOCKS_LOCK:
+        entry = _PARTIAL_LOCKS.setdefault(partial, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            try:
+                _download_ranged(uri, size, partial, f"{partial}.json", progress)
+            except DriveRangeUnsupported:
+                # Sin soporte de Range no hay nada que reanudar
+                for path in (partial, f"{partial}.json"):
+                    if os.path.exists(path):
+                        os.remove(path)
+                raise
+            shutil.move(partial, out_path)
+            os.remove(f"{partial}.json")
+    finally:
+        # El lock solo se olvida cuando ningún otro hilo lo espera o lo tiene
+        with _PARTIAL_LOCKS_LOCK:
+            entry[1] -= 1
+            if entry[1] == 0:
+                _PARTIAL_LOCKS.pop(partial, None)
+
+class HTTPFetcher:
+    """Fuentes HTTP(S) genéricas con una requests.Session compartida.
+
+    La sesión mantiene conexiones keep-alive por host y reintenta errores de
+    conexión, 429 y 5xx con backoff. La versión de un fichero sale del ETag o
+    Last-Modified de un HEAD, y con ella se cachea en disco igual que Drive.
+    """
+    def __init__(self, pool_size: int, timeout: int, retries: int):
+        self.timeout = timeout
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries, backoff_factor=DRIVE_BACKOFF_BASE, status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("HEAD", "GET"), raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._metadata = {}  # url -> (timestamp, metadatos)
+        self._lock = threading.Lock()
+
+    def _open(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Petición que sigue las redirecciones a mano: cada salto debe ir a un host permitido"""
+        for _ in range(self.session.max_redirects + 1):
+            resp = self.session.request(method, url, allow_redirects=False, timeout=self.timeout, **kwargs)
+            if not resp.is_redirect:
+                return resp
+            target = urljoin(url, resp.headers["Location"])
+            resp.close()
+            if urlparse(target).scheme not in ("http", "https") or not _http_host_allowed(target):
+                raise requests.exceptions.InvalidURL(f"Redirect to a source not allowed: {target}")
+            url = target
+        raise requests.TooManyRedirects(f"Exceeded {self.session.max_redirects} redirects")
+
+    def metadata(self, url: str) -> Optional[dict]:
+        """ETag, Last-Modified y tamaño del recurso (memoizados HTTP_METADATA_TTL segundos)"""
+        if not _http_host_allowed(url):
             return None
-            
-        scopes = ["https://www.googleapis.com/auth/drive"]
-        creds = GCredentials.from_service_account_file(creds_path, scopes=scopes)
-        service = build("drive", "v3", credentials=creds, cache_discovery=False)
-        print("DEBUG: Google Drive service initialized successfully")
-        return service
-        
+        now = time.time()
+        with self._lock:
+            cached = self._metadata.get(url)
+            if cached and now - cached[0] < HTTP_METADATA_TTL:
+                return cached[1]
+        try:
+            resp = self._open("HEAD", url)
+            resp.raise_for_status()
+        except requests.RequestException as e:
+            print(f"DEBUG: Could not get HTTP metadata for {url}: {e}")
+            return None
+        length = resp.headers.get("Content-Length")
+        meta = {
+            "etag": resp.headers.get("ETag"),
+            "last_modified": resp.headers.get("Last-Modified"),
+            "size": int(length) if length and length.isdigit() else None,
+        }
+        with self._lock:
+            self._metadata[url] = (now, meta)
+            if len(self._metadata) > 1024:
+                for key in [k for k, (ts, _) in self._metadata.items() if now - ts >= HTTP_METADATA_TTL]:
+                    del self._metadata[key]
+        return meta
+
+    def version(self, url: str) -> Optional[str]:
+        meta = self.metadata(url)
+        validator = (meta or {}).get("etag") or (meta or {}).get("last_modified")
+        if not validator:
+            return None
+        return f"http:{url}:{validator}:{meta.get('size')}"
+
+    def download(self, url: str, out_path: str, progress=None, chunk_size: int = 1024 * 1024):
+        """Descarga en streaming a out_path, publicando los bytes escritos en progress"""
+        with self._open("GET", url, stream=True) as resp:
+            resp.raise_for_status()
+            length = resp.headers.get("Content-Length")
+            expected = int(length) if length and length.isdigit() else None
+            written = 0
+            with open(out_path, "wb") as f:
+                if progress is not None:
+                    progress.begin(out_path, expected)
+                for chunk in resp.iter_content(chunk_size=chunk_size):
+                    if progress is not None:
+                        progress.check_aborted()
+                    f.write(chunk)
+                    written += len(chunk)
+                    if progress is not None:
+                        f.flush()
+                        progress.advance(written)
+        if expected is not None and written != expected:
+            raise RuntimeError(f"Incomplete download: {written} of {expected} bytes")
+
+HTTP_FETCHER = HTTPFetcher(HTTP_POOL_SIZE, HTTP_TIMEOUT, HTTP_RETRIES)
+
+def source_origin(url: str) -> str:
+    """Origen de una URL de fuente: drive, http o file"""
+    parsed = urlparse(url)
+    host = (parsed.hostname or "").lower()
+    if parsed.scheme == "file":
+        return "file"
+    if host.endswith("drive.google.com") or host == "docs.google.com" or not parsed.scheme:
+        return "drive"
+    if parsed.scheme in ("http", "https"):
+        return "http"
+    raise RuntimeError(f"Unsupported source URL scheme: {parsed.scheme}")
+
+def _local_file_path(url: str) -> str:
+    """Ruta de una URL file:// dentro de FILE_SOURCE_ROOTS"""
+    path = os.path.realpath(unquote(urlparse(url).path))
+    if not any(path == root or path.startswith(root + os.sep) for root in FILE_SOURCE_ROOTS):
+        raise RuntimeError(f"Local source not allowed: {path}")
+    return path
+
+def _local_file_version(url: str) -> Optional[str]:
+    try:
+        path = _local_file_path(url)
+        st = os.stat(path)
+    except (OSError, RuntimeError):
+        return None
+    return f"file:{path}:{st.st_mtime_ns}-{st.st_size}"
+
+def _public_host(host: str) -> bool:
+    """True si el host resuelve solo a direcciones públicas (ni loopback, ni privadas, ni link-local)"""
+    try:
+        infos = socket.getaddrinfo(host, None)
+    except (socket.gaierror, UnicodeError, ValueError):
+        return False
+    for info in infos:
+        ip = ipaddress.ip_address(info[4][0].split("%")[0])
+        if ip.version == 6 and ip.ipv4_mapped:
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            return False
+    return bool(infos)
+
+def _http_host_allowed(url: str) -> bool:
+    """Con HTTP_SOURCE_HOSTS solo los hosts listados; sin ella, solo hosts con direcciones públicas.
+
+    Se comprueba en cada salto de redirección, así que una URL pública no puede
+    llevar al servidor a la red interna (metadata del cloud, servicios locales).
+    """
+    host = (urlparse(url).hostname or "").lower()
+    if HTTP_SOURCE_HOSTS:
+        return host in HTTP_SOURCE_HOSTS
+    return bool(host) and _public_host(host)
+
+def _download_via_http(url: str, out_path: str, progress=None) -> dict:
+    if not _http_host_allowed(url):
+        raise RuntimeError(f"HTTP source host not allowed: {urlparse(url).hostname}")
+    meta = HTTP_FETCHER.metadata(url)
+    version = HTTP_FETCHER.version(url)
+    url_id = hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    cache_key = f"http-{url_id}-{hashlib.sha1(version.encode()).hexdigest()[:16]}" if version else None
+    if progress is not None:
+        progress.source = {"origin": "http", "file_id": url_id, "version": version}
+    print(f"DEBUG: Downloading over HTTP: {url}")
+    cache_hit = False
+    try:
+        if DOWNLOAD_CACHE and cache_key:
+            cache_hit = DOWNLOAD_CACHE.fetch(cache_key, out_path, lambda tmp_path: HTTP_FETCHER.download(url, tmp_path, progress))
+        else:
+            HTTP_FETCHER.download(url, out_path, progress)
+        file_size = os.path.getsize(out_path)
+        if file_size == 0:
+            raise RuntimeError("Download failed - output file is empty")
     except Exception as e:
-        print(f"DEBUG: Could not init Drive service: {e}")
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        raise RuntimeError(f"HTTP download failed: {str(e)}")
+    print(f"DEBUG: HTTP download completed, {file_size} bytes (cache {'hit' if cache_hit else 'miss'})")
+    return {
+        "origin": "http", "file_id": url_id, "version": version, "cache_hit": cache_hit,
+        "size_bytes": file_size, "etag": (meta or {}).get("etag"),
+    }
+
+def _download_local_file(url: str, out_path: str) -> dict:
+    path = _local_file_path(url)
+    st = os.stat(path)
+    if st.st_size == 0:
+        raise RuntimeError("Local source is empty")
+    # Ya está en disco: se copia sin pasar por la caché de descargas
+    shutil.copyfile(path, out_path)
+    return {
+        "origin": "file", "file_id": path, "version": f"{st.st_mtime_ns}-{st.st_size}",
+        "cache_hit": False, "size_bytes": st.st_size,
+    }
+
+def download_source(url: str, out_path: str, progress=None) -> dict:
+    """Descarga una fuente según su origen (Drive, HTTP(S) o file://)"""
+    origin = source_origin(url)
+    if origin == "http":
+        return _download_via_http(url, out_path, progress)
+    if origin == "file":
+        return _download_local_file(url, out_path)
+    return _download_with_drive_confirm(url, out_path, progress)
+
+class ProbeCache:
+    """Caché LRU en memoria de metadatos de ffprobe, por origen, id y versión de la fuente"""
+    def __init__(self, max_entries: int):
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            meta = self._entries.get(key)
+            if meta is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return meta
+
+    def put(self, key: str, meta: dict):
+        with self._lock:
+            self._entries[key] = meta
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+PROBE_CACHE = ProbeCache(PROBE_CACHE_SIZE)
+
+def _content_key(path: str, block_size: int = 1024 * 1024) -> str:
+    """Hash del contenido completo del fichero, leído por bloques"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return f"sha1:{h.hexdigest()}"
+
+def _parse_rate(rate: Optional[str]) -> Optional[float]:
+    try:
+        num, den = (rate or "").split("/")
+        return round(float(num) / float(den), 3) if float(den) else None
+    except ValueError:
         return None
 
-def _download_via_drive_api(service, file_id: str, out_path: str):
-    request = service.files().get_media(fileId=file_id)
-    fh = io.FileIO(out_path, "wb")
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while not done:
-        status, done = downloader.next_chunk()
-        if status:
-            print(f"DEBUG: Drive API download {int(status.progress() * 100)}%")
-
-def ffprobe_duration(path: str) -> float:
-    """Obtener duración del archivo con mejor manejo de errores"""
-    print(f"DEBUG: Getting duration for: {path}")
-    
+def _parse_rotation(stream: dict) -> int:
+    """Rotación (grados) que ffmpeg aplicará al decodificar: displaymatrix o tag rotate"""
+    for side_data in stream.get("side_data_list") or []:
+        if "rotation" in side_data:
+            try:
+                return int(float(side_data["rotation"])) % 360
+            except (TypeError, ValueError):
+                pass
+    try:
+        return int((stream.get("tags") or {}).get("rotate", 0)) % 360
+    except (TypeError, ValueError):
+        return 0
+
+def _parse_probe(data: dict) -> dict:
+    """Convierte la salida JSON de ffprobe en un objeto de metadatos compacto"""
+    fmt = data.get("format", {})
+    streams = data.get("streams", [])
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+
+    duration = fmt.get("duration")
+    if duration in (None, "N/A"):
+        # Algunos contenedores solo informan la duración por stream
+        durations = [float(st["duration"]) for st in streams if st.get("duration") not in (None, "N/A")]
+        duration = max(durations) if durations else None
+    if duration is None:
+        raise ValueError("no duration in ffprobe output")
+
+    return {
+        "duration": float(duration),
+        "format_name": fmt.get("format_name"),
+        "size_bytes": int(fmt["size"]) if fmt.get("size") else None,
+        "bit_rate": int(fmt["bit_rate"]) if fmt.get("bit_rate") else None,
+        "video": {
+            "codec": video.get("codec_name"),
+            "width": video.get("width"),
+            "height": video.get("height"),
+            "fps": _parse_rate(video.get("avg_frame_rate")) or _parse_rate(video.get("r_frame_rate")),
+            "pix_fmt": video.get("pix_fmt"),
+            "rotation": _parse_rotation(video),
+        } if video else None,
+        "audio": {
+            "codec": audio.get("codec_name"),
+            "sample_rate": int(audio["sample_rate"]) if audio.get("sample_rate") else None,
+            "channels": audio.get("channels"),
+        } if audio else None,
+        "streams": [
+            {"index": st.get("index"), "codec_type": st.get("codec_type"), "codec_name": st.get("codec_name")}
+            for st in streams
+        ],
+    }
+
+def probe_media(path: str, cache_key: Optional[str] = None) -> dict:
+    """Metadatos del fichero con una sola llamada a ffprobe, memoizados por cache_key.
+
+    Sin cache_key (fuente sin versión conocida) no se usa la caché: hashear el fichero
+    entero costaría tanto como el propio probe.
+    """
     # Verificar que el archivo existe y no está vacío
     if not os.path.exists(path):
         raise RuntimeError(f"File does not exist: {path}")
@@ -196,43 +1477,57 @@ def ffprobe_duration(path: str) -> float:
     file_size = os.path.getsize(path)
     if file_size == 0:
         raise RuntimeError(f"File is empty: {path}")
-    
-    print(f"DEBUG: File size: {file_size} bytes")
-    
+
+    cached = PROBE_CACHE.get(cache_key) if cache_key else None
+    if cached is not None:
+        print(f"DEBUG: Probe cache hit for {cache_key}")
+        return cached
+
+    print(f"DEBUG: Probing {path} ({file_size} bytes)")
     try:
-        # Intentar obtener información básica del archivo primero
-        probe_cmd = f'ffprobe -v quiet -print_format json -show_format "{path}"'
-        out = run(probe_cmd)
-        print(f"DEBUG: ffprobe output: {out[:200]}...")
-        
-        # Luego obtener la duración
-        out = run(f'ffprobe -v error -show_entries format=duration -of default=nw=1:nk=1 "{path}"')
-        duration = float(out.strip())
-        print(f"DEBUG: Duration: {duration} seconds")
-        return duration
-    except ValueError as e:
-        print(f"DEBUG: Could not parse duration: {out.strip()}")
-        raise RuntimeError(f"Cannot parse duration from: {out.strip()}")
+        out = run(f'ffprobe -v error -print_format json -show_format -show_streams "{path}"')
+        meta = _parse_probe(json.loads(out))
+    except (ValueError, KeyError) as e:
+        print(f"DEBUG: Could not parse ffprobe output: {str(e)}")
+        raise RuntimeError(f"Cannot parse media metadata: {str(e)}")
     except Exception as e:
         print(f"DEBUG: ffprobe failed: {str(e)}")
-        # Intentar con más verbosidad para diagnosticar el problema
-        try:
-            debug_out = run(f'ffprobe -v debug "{path}"')
-            print(f"DEBUG: ffprobe debug output: {debug_out[:500]}...")
-        except:
-            pass
         raise RuntimeError(f"Cannot read file duration. File may be corrupted: {str(e)}")
 
-def get_random_audio_start(audio_path: str, video_duration: float) -> float:
-    """Obtiene un punto de inicio aleatorio para el audio que permita cubrir toda la duración del video"""
+    if cache_key:
+        PROBE_CACHE.put(cache_key, meta)
+    return meta
+
+def _probe_key(source: Optional[dict]) -> Optional[str]:
+    """Clave de probe para una fuente con versión conocida"""
+    if source and source.get("file_id") and source.get("version"):
+        return f"{source.get('origin', 'drive')}:{source['file_id']}:{source['version']}"
+    return None
+
+def ffprobe_duration(path: str, cache_key: Optional[str] = None) -> float:
+    """Obtener duración del archivo con mejor manejo de errores"""
+    print(f"DEBUG: Getting duration for: {path}")
+    duration = probe_media(path, cache_key)["duration"]
+    print(f"DEBUG: Duration: {duration} seconds")
+    return duration
+
+def get_random_audio_start(audio_path: str, video_duration: float, cache_key: Optional[str] = None,
+                           seed: Optional[str] = None, audio_duration: Optional[float] = None) -> float:
+    """Obtiene un punto de inicio aleatorio para el audio que permita cubrir toda la duración del video.
+
+    Con seed el resultado es reproducible (y el render se puede cachear). Con audio_duration
+    (la de un asset de audio preprocesado) no se hace probe.
+    """
     try:
-        audio_duration = ffprobe_duration(audio_path)
+        if audio_duration is None:
+            audio_duration = ffprobe_duration(audio_path, cache_key)
         if audio_duration <= video_duration:
             return 0.0  # Si el audio es más corto que el video, empezar desde el inicio
         
         # Calcular el rango válido para el inicio aleatorio
         max_start = audio_duration - video_duration
-        return random.uniform(0, max_start)
+        rng = random.Random(seed) if seed else random
+        return rng.uniform(0, max_start)
     except:
         return 0.0  # En caso de error, empezar desde el inicio
 
@@ -283,82 +1578,915 @@ def build_scale_pad(target: str) -> Optional[str]:
         return f"scale={w}:{h}:force_original_aspect_ratio=decrease,pad={w}:{h}:(ow-iw)/2:(oh-ih)/2:color=black"
     raise ValueError("Invalid target")
 
-@app.get("/health")
-def health():
-    return {"ok": True}
+def build_audio_trim_command(audio_path: str, out_path: str, start: float, duration: float) -> str:
+    """Recorte/normalización del audio a AAC 48 kHz estéreo (primer paso del modo two_pass)"""
+    return f'ffmpeg -y -ss {start:.3f} -i "{audio_path}" -t {duration:.3f} -ac 2 -ar 48000 -c:a aac "{out_path}"'
 
-@app.get("/download/{video_filename}")
-def download_video(video_filename: str):
-    """Descargar video por UUID (con o sin extensión .mp4)"""
-    # Si el filename ya termina en .mp4, removerlo para obtener el UUID
-    if video_filename.endswith('.mp4'):
-        video_uuid = video_filename[:-4]
-    else:
-        video_uuid = video_filename
-    
-    try:
-        # Validar formato UUID
-        uuid.UUID(video_uuid)
-    except ValueError:
-        raise HTTPException(status_code=400, detail="UUID inválido")
-    
-    filename = f"{video_uuid}.mp4"
-    file_path = os.path.join(VIDEOS_DIR, filename)
-    
-    if not os.path.exists(file_path):
-        raise HTTPException(status_code=404, detail="Video no encontrado")
-    
-    return FileResponse(
-        path=file_path,
-        media_type='video/mp4',
-        filename=filename,
-        headers={"Content-Disposition": f"attachment; filename={filename}"}
+def build_audio_asset_command(audio_path: str, out_path: str) -> str:
+    """Pista completa a AAC 48 kHz estéreo (M4A faststart) y, en el mismo decode, análisis loudnorm"""
+    return (
+        f'ffmpeg -y -nostats -i "{audio_path}" -filter_complex '
+        f'"[0:a]aresample=48000,aformat=channel_layouts=stereo,asplit=2[enc][ana];'
+        f'[ana]loudnorm=print_format=json[loud]" '
+        f'-map "[enc]" -c:a aac -b:a {AUDIO_ASSET_BITRATE} -movflags +faststart -f mp4 "{out_path}" '
+        f'-map "[loud]" -f null -'
     )
 
-@app.get("/videos")
-def list_videos(authorization: Optional[str] = Header(None)):
-    """Listar todos los videos disponibles (requiere autenticación)"""
-    check_auth(authorization)
-    
-    videos = []
-    try:
-        if os.path.exists(VIDEOS_DIR):
-            for filename in os.listdir(VIDEOS_DIR):
-                if filename.endswith('.mp4'):
-                    video_uuid = filename[:-4]  # Remover .mp4
-                    try:
-                        # Validar que es un UUID válido
-                        uuid.UUID(video_uuid)
-                        file_path = os.path.join(VIDEOS_DIR, filename)
-                        file_size = os.path.getsize(file_path)
-                        file_mtime = os.path.getmtime(file_path)
-                        
-                        videos.append({
-                            'uuid': video_uuid,
-                            'filename': filename,
-                            'size_bytes': file_size,
-                            'size_mb': round(file_size / (1024 * 1024), 2),
-                            'created_at': datetime.fromtimestamp(file_mtime).isoformat()
-                        })
-                    except ValueError:
-                        # Ignorar archivos que no tienen UUID válido como nombre
-                        continue
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error listando videos: {str(e)}")
-    
-    # Ordenar por fecha de creación (más recientes primero)
-    videos.sort(key=lambda x: x['created_at'], reverse=True)
-    
-    return {
-        "videos": videos,
-        "total_count": len(videos),
-        "timestamp": datetime.now().isoformat()
-    }
+def build_audio_loudness_command(audio_path: str) -> str:
+    """Solo el análisis EBU R128 (loudnorm) de una pista"""
+    return f'ffmpeg -nostats -i "{audio_path}" -map 0:a:0 -af loudnorm=print_format=json -f null -'
 
-@app.get("/video/{video_uuid}/info")
-def get_video_info(video_uuid: str, authorization: Optional[str] = Header(None)):
-    """Obtener información detallada de un video específico (requiere autenticación)"""
-    check_auth(authorization)
+def build_audio_cut_command(asset_path: str, out_path: str, start: float, duration: float) -> str:
+    """Recorte de una pista preprocesada con copia del stream, sin re-encode (modo two_pass)"""
+    return f'ffmpeg -y -ss {start:.3f} -i "{asset_path}" -t {duration:.3f} -map 0:a:0 -c copy "{out_path}"'
+
+def _parse_loudnorm(log: str) -> dict:
+    """Estadísticas de loudnorm (bloque JSON al final de stderr) en LUFS/dB"""
+    m = re.search(r'\{[^{}]*"input_i"[^{}]*\}', log)
+    if not m:
+        raise RuntimeError("loudnorm report not found")
+    report = json.loads(m.group(0))
+    stats = {}
+    for key, field in (("integrated_lufs", "input_i"), ("true_peak_db", "input_tp"),
+                       ("lra", "input_lra"), ("threshold_lufs", "input_thresh")):
+        try:
+            value = float(report[field])
+        except (KeyError, TypeError, ValueError):
+            value = None
+        # Pistas en silencio dan -inf
+        stats[key] = round(value, 2) if value is not None and math.isfinite(value) else None
+    return stats
+
+def _audio_asset_key(url: str) -> Optional[str]:
+    """Clave del asset de audio: versión de la fuente + formato del preprocesado"""
+    version = _source_version(url)
+    if not version:
+        return None
+    return hashlib.sha1(f"{version}:aac-48k-stereo:{AUDIO_ASSET_BITRATE}".encode()).hexdigest()
+
+def prepare_audio_asset(url: str, raw_path: str, asset_path: str, job=None, progress=None) -> Optional[dict]:
+    """Deja en asset_path la pista preprocesada de AUDIO_ASSET_CACHE y devuelve sus estadísticas.
+
+    Solo se descarga la fuente (en raw_path) si la pista no está en la caché; el encode y
+    el análisis de loudness se hacen una vez por versión, en un hueco de ENCODE_SLOTS y
+    asociados a job (cancelación y timeout). Con progress (un _GrowingSource) la descarga
+    se puede abortar. Devuelve None si la caché está desactivada o la fuente no tiene
+    versión conocida.
+    """
+    key = _audio_asset_key(url) if AUDIO_ASSET_CACHE else None
+    if not key:
+        return None
+    built = {}
+
+    def _ffmpeg(cmd: str) -> str:
+        try:
+            with encode_slot(job):
+                return run(cmd, job, return_stderr=True)
+        except Exception as e:
+            if job is not None and job.cancel_reason:
+                # Cancelado el trabajo, no la fuente: otro render que espere la pista la retoma
+                raise DownloadAborted(f"Audio asset aborted: {e}") from e
+            raise
+
+    def _encode(tmp_path: str):
+        built["source"] = download_source(url, raw_path, progress)
+        if progress is not None:
+            progress.check_aborted()
+        print(f"DEBUG: Preprocessing audio asset {key}")
+        built["loudness"] = _parse_loudnorm(_ffmpeg(build_audio_asset_command(raw_path, tmp_path)))
+
+    def _analyze(tmp_path: str):
+        # Solo se repite el análisis si las estadísticas se expulsaron antes que la pista
+        loudness = built.get("loudness") or _parse_loudnorm(_ffmpeg(build_audio_loudness_command(asset_path)))
+        stats = dict(loudness, duration=probe_media(asset_path)["duration"], source=built.get("source"))
+        with open(tmp_path, "w") as f:
+            json.dump(stats, f)
+
+    stats_path = f"{asset_path}.json"
+    hit = AUDIO_ASSET_CACHE.fetch(f"{key}.m4a", asset_path, _encode)
+    AUDIO_ASSET_CACHE.fetch(f"{key}.json", stats_path, _analyze)
+    with open(stats_path) as f:
+        stats = json.load(f)
+    stats.update(key=key, path=asset_path, cache_hit=hit)
+    print(f"DEBUG: Audio asset {key} ({'hit' if hit else 'miss'}): {stats['duration']:.3f}s, "
+          f"{stats['integrated_lufs']} LUFS")
+    return stats
+
+def music_gain_db(asset: Optional[dict]) -> Optional[float]:
+    """Ganancia (dB) de la música en mix_audio para llevarla a AUDIO_MIX_MUSIC_LUFS sin pasar de -1 dBTP"""
+    if not asset or not AUDIO_MIX_MUSIC_LUFS or asset.get("integrated_lufs") is None:
+        return None
+    gain = AUDIO_MIX_MUSIC_LUFS - asset["integrated_lufs"]
+    if asset.get("true_peak_db") is not None:
+        gain = min(gain, -1.0 - asset["true_peak_db"])
+    return round(max(-30.0, min(gain, 20.0)), 2)
+
+def parse_renditions(value: str) -> list:
+    """Renditions pedidas ("720p,480x854,poster") como [{name, ext, scale}]; ValueError si no son válidas"""
+    renditions = []
+    for name in [n.strip().lower() for n in (value or "").split(",") if n.strip()]:
+        if any(r["name"] == name for r in renditions):
+            continue
+        if name == "poster":
+            renditions.append({"name": name, "ext": "jpg", "scale": None})
+        elif name in RENDITION_LADDER:
+            side = RENDITION_LADDER[name]
+            # Lado corto = side (sin ampliar), el otro proporcional y par
+            renditions.append({"name": name, "ext": "mp4", "scale": (
+                f"scale='if(gt(iw,ih),-2,min(iw,{side}))':'if(gt(iw,ih),min(ih,{side}),-2)'"
+            )})
+        elif re.fullmatch(r"\d{2,4}x\d{2,4}", name):
+            w, h = (int(x) for x in name.split("x"))
+            if w % 2 or h % 2:
+                raise ValueError(f"rendition {name} must have even dimensions")
+            renditions.append({"name": name, "ext": "mp4", "scale": build_scale_pad(name)})
+        else:
+            raise ValueError(f"unknown rendition {name}")
+    if len(renditions) > RENDITIONS_MAX:
+        raise ValueError(f"at most {RENDITIONS_MAX} renditions")
+    return renditions
+
+def rendition_filenames(video_uuid: str, renditions: str) -> dict:
+    """Ficheros publicados de cada rendition de un video: {nombre: fichero}"""
+    try:
+        return {r["name"]: f"{video_uuid}_{r['name']}.{r['ext']}" for r in parse_renditions(renditions)}
+    except ValueError:
+        return {}
+
+def _rendition_frame_size(rendition: dict, frame: tuple) -> Optional[tuple]:
+    """Tamaño (ancho, alto) de una rendition de video a partir del frame principal, antes del límite del perfil"""
+    width, height = frame
+    if rendition["name"] in RENDITION_LADDER:
+        side = RENDITION_LADDER[rendition["name"]]
+        if width > height:
+            return width * min(height, side) / height, min(height, side)
+        return min(width, side), height * min(width, side) / width
+    if rendition["ext"] == "mp4":
+        w, h = rendition["name"].split("x")
+        return int(w), int(h)
+    return None
+
+def drop_capped_renditions(renditions: list, opts: dict, frame: Optional[tuple]) -> list:
+    """Quita las renditions de video que, con el límite de altura del perfil (draft), saldrían
+    con la proporción y el tamaño del video principal ya limitado (o mayores)"""
+    max_height = encoder_profile(opts)["max_height"]
+    if not max_height or not frame or frame[1] <= max_height:
+        return renditions
+    main_width = frame[0] * max_height / frame[1]
+    kept = []
+    for rendition in renditions:
+        size = _rendition_frame_size(rendition, frame)
+        if size:
+            width, height = size
+            if height > max_height:
+                width, height = width * max_height / height, max_height
+            # Mismo encuadre y tamaño que el principal (margen de 2 px por el redondeo a par de scale=-2);
+            # un WxH de otra proporción es otra salida aunque sea igual de grande
+            same_aspect = abs(width / height - frame[0] / frame[1]) < 0.01
+            if same_aspect and width >= main_width - 2 and height >= max_height:
+                print(f"DEBUG: Skipping rendition {rendition['name']}: not smaller than the {max_height}p output")
+                continue
+        kept.append(rendition)
+    return kept
+
+def _rendition_path(out_path: str, rendition: dict) -> str:
+    return f"{os.path.splitext(out_path)[0]}_{rendition['name']}.{rendition['ext']}"
+
+def _finish_video_parts(parts: list, final_in: str, cap: str, suffix: str, renditions: Optional[list],
+                        poster_at: float = 0.0):
+    """Salida [v{suffix}] y, con renditions, un split tras las etapas comunes hacia [v{suffix}_{i}]"""
+    if not renditions:
+        parts.append(f"{final_in}{cap}format=yuv420p[v{suffix}]")
+        return
+    labels = [f"[main{suffix}]"] + [f"[rin{suffix}_{i}]" for i in range(len(renditions))]
+    parts.append(f"{final_in}split={len(labels)}{''.join(labels)}")
+    parts.append(f"[main{suffix}]{cap}format=yuv420p[v{suffix}]")
+    for i, rendition in enumerate(renditions):
+        if rendition["ext"] == "jpg":
+            # Un solo fotograma: trim con fin cierra la rama y split deja de alimentarla
+            parts.append(
+                f"[rin{suffix}_{i}]trim=start={poster_at:.3f}:duration=0.5,setpts=PTS-STARTPTS[v{suffix}_{i}]"
+            )
+        else:
+            parts.append(f"[rin{suffix}_{i}]{rendition['scale']},{cap}format=yuv420p[v{suffix}_{i}]")
+
+def build_video_filter_parts(opts: dict, image_input: Optional[int] = None,
+                             video_in: str = "[0:v]", suffix: str = "",
+                             layer_input: Optional[int] = None, renditions: Optional[list] = None,
+                             poster_at: float = 0.0) -> list:
+    """Fragmentos del grafo de video con labels explícitas; la salida final es [v{suffix}].
+
+    video_in y suffix permiten colgar varias cadenas de un mismo video (render por lotes).
+    Con layer_input, la capa oscura, la carátula y el texto ya vienen pre-compuestos en
+    un PNG del tamaño del frame y basta un único overlay. Con renditions, el resultado de
+    las etapas comunes se reparte además entre [v{suffix}_{i}], una por rendition.
+    """
+    parts = []
+
+    # Límite de resolución del perfil (p. ej. draft); se aplica al final para que las capas
+    # pre-compuestas y las posiciones del texto no cambien
+    max_height = encoder_profile(opts)["max_height"]
+    cap = f"scale=-2:'min(ih,{max_height})'," if max_height else ""
+
+    if layer_input is not None:
+        scale = build_scale_pad(opts["target"])
+        base = f"{scale}," if scale else ""
+        parts.append(f"{video_in}{base}eq=saturation={opts['saturation_boost']}[base{suffix}]")
+        if not renditions:
+            parts.append(f"[base{suffix}][{layer_input}:v]overlay=0:0,{cap}format=yuv420p[v{suffix}]")
+            return parts
+        parts.append(f"[base{suffix}][{layer_input}:v]overlay=0:0[ovl{suffix}]")
+        _finish_video_parts(parts, f"[ovl{suffix}]", cap, suffix, renditions, poster_at)
+        return parts
+
+    # 1) La imagen ya está procesada (PNG con alpha). Solo asegurar formato rgba
+    if image_input is not None:
+        parts.append(f"[{image_input}:v]format=rgba[img{suffix}]")
+
+    # 2) Preparar el video base: si hay escala/pad, aplicarlo
+    scale = build_scale_pad(opts["target"])
+    if scale:
+        parts.append(f"{video_in}{scale},eq=saturation={opts['saturation_boost']}[base{suffix}]")
+    else:
+        parts.append(f"{video_in}eq=saturation={opts['saturation_boost']}[base{suffix}]")
+
+    # 3) Si se solicita, aplicar una capa oscura sobre el video base.
+    # La fuente color es infinita: shortest=1 corta la capa al terminar el video
+    base_label = f"base{suffix}"
+    if str(opts["dark_overlay"]).lower() == "true":
+        parts.append(f"color=black@{opts['dark_overlay_opacity']}:size=1080x1920[dark{suffix}]")
+        parts.append(f"[base{suffix}][dark{suffix}]overlay=shortest=1[base_dark{suffix}]")
+        base_label = f"base_dark{suffix}"
+
+    # 4) Hacer overlay de la imagen centrada
+    final_in = f"[{base_label}]"
+    if image_input is not None:
+        parts.append(f"{final_in}[img{suffix}]overlay=(W-w)/2:(H-h)/2[ov{suffix}]")
+        final_in = f"[ov{suffix}]"
+
+    # 5) Añadir texto si corresponde
+    if opts["overlay_text"]:
+        text_filter = build_drawtext_expr(opts["overlay_text"], opts["position"])
+        parts.append(f"{final_in}{text_filter}[txt{suffix}]")
+        final_in = f"[txt{suffix}]"
+
+    # 6) Formato final y label de salida (y renditions, si las hay)
+    _finish_video_parts(parts, final_in, cap, suffix, renditions, poster_at)
+    return parts
+
+def build_audio_filter_parts(mix: bool, single_pass: bool, start: float = 0.0, duration: float = 0.0,
+                             audio_input: int = 1, suffix: str = "", music_gain: Optional[float] = None):
+    """Fragmentos del grafo de audio y el -map correspondiente.
+
+    En modo single_pass el audio de entrada `audio_input` es el original: el seek, recorte y
+    remuestreo se hacen aquí en lugar de en un encode AAC previo. music_gain (dB, de
+    music_gain_db) sustituye al volumen fijo de la música en mix_audio.
+    """
+    parts = []
+    music = f"[{audio_input}:a]"
+    if single_pass:
+        parts.append(
+            f"[{audio_input}:a]atrim=start={start:.3f}:duration={duration:.3f},asetpts=PTS-STARTPTS,"
+            f"aresample=48000,aformat=channel_layouts=stereo[music{suffix}]"
+        )
+        music = f"[music{suffix}]"
+
+    if mix:
+        music_volume = f"volume={music_gain:.2f}dB" if music_gain is not None else f"volume={MIX_MUSIC_VOLUME}"
+        parts.append(
+            f"[0:a]volume=1.0[a0{suffix}];{music}{music_volume}[a1{suffix}];"
+            f"[a0{suffix}][a1{suffix}]amix=inputs=2:duration=shortest[aout{suffix}]"
+        )
+        return parts, f'"[aout{suffix}]"'
+    if single_pass:
+        return parts, f'"[music{suffix}]"'
+    return parts, f"{audio_input}:a:0"
+
+# Códecs de video que se pueden copiar tal cual a un contenedor MP4
+MP4_COPY_CODECS = ("h264", "hevc", "av1", "vp9", "mpeg4")
+
+def encoder_profile(opts: dict) -> dict:
+    """Perfil de encoder de la petición (o ENCODER_PROFILE si no se indica)"""
+    return ENCODER_PROFILES[opts.get("encoder_profile") or ENCODER_PROFILE]
+
+def is_video_passthrough(opts: dict, has_image: bool, video_meta: Optional[dict] = None) -> bool:
+    """True si el grafo de video no haría nada y se puede copiar el stream (-c:v copy)"""
+    if has_image or opts["overlay_text"] or opts.get("renditions"):
+        return False
+    if str(opts["dark_overlay"]).lower() == "true":
+        return False
+    if build_scale_pad(opts["target"]) is not None:
+        return False
+    try:
+        if float(opts["saturation_boost"]) != 1.0:
+            return False
+    except (TypeError, ValueError):
+        return False
+    if video_meta is not None:
+        codec = (video_meta.get("video") or {}).get("codec")
+        if codec not in MP4_COPY_CODECS:
+            return False
+        max_height = encoder_profile(opts)["max_height"]
+        if max_height and ((video_meta.get("video") or {}).get("height") or 0) > max_height:
+            return False
+    return True
+
+def build_video_codec_args(opts: dict, threads: int = 0) -> str:
+    """Argumentos de libx264 del perfil de encoder (threads=0: ENCODER_THREADS o los del perfil)"""
+    profile = encoder_profile(opts)
+    args = f'-c:v libx264 -preset {profile["preset"]}'
+    if profile["tune"]:
+        args += f' -tune {profile["tune"]}'
+    args += f' -crf {opts["crf"]}'
+    threads = threads or ENCODER_THREADS or profile["threads"]
+    if threads > 0:
+        args += f' -threads {threads}'
+    if profile["keyint"]:
+        args += f' -force_key_frames "expr:gte(t,n_forced*{profile["keyint"]})"'
+    return args
+
+def build_output_args(opts: dict, video_map: str, audio_map: str, out_path: str,
+                      video_copy: bool = False, output_args: str = "") -> str:
+    """Mapeo, códecs (según el perfil de encoder) y ruta de una salida del comando ffmpeg"""
+    profile = encoder_profile(opts)
+    if video_copy:
+        video_cmd = f'-map {video_map} -c:v copy'
+    else:
+        video_cmd = f'-map {video_map} {build_video_codec_args(opts)}'
+    output_cmd = f"{output_args} " if output_args else ""
+    if profile["faststart"] and "-movflags" not in output_args:
+        # moov al principio: el MP4 se puede reproducir antes de descargarse entero
+        output_cmd = f"-movflags +faststart {output_cmd}"
+    return (
+        f'{video_cmd} -map {audio_map} -c:a aac -b:a {profile["audio_bitrate"]} '
+        f'-shortest {output_cmd}"{out_path}"'
+    )
+
+def build_render_command(inputs: list, opts: dict, out_path: str, image_input: Optional[int] = None,
+                         single_pass: bool = False, audio_start: float = 0.0, duration: float = 0.0,
+                         video_copy: bool = False, output_args: str = "",
+                         layer_input: Optional[int] = None, renditions: Optional[list] = None,
+                         music_gain: Optional[float] = None) -> str:
+    """Comando ffmpeg del render principal; inputs = [video, audio, (imagen o capa)].
+
+    Con video_copy=True el video se remuxa sin re-encode y solo se procesa el audio.
+    output_args se añade justo antes de la salida (p. ej. flags de MP4 fragmentado).
+    Cada rendition se escribe junto a out_path (_rendition_path) desde el mismo decode.
+    """
+    renditions = [] if video_copy else (renditions or [])
+    inputs_cmd = " ".join(f'-i "{path}"' for path in inputs)
+    poster_at = min(POSTER_AT, duration / 2) if duration else 0.0
+    filter_parts = [] if video_copy else build_video_filter_parts(
+        opts, image_input, layer_input=layer_input, renditions=renditions, poster_at=poster_at
+    )
+    mix = (str(opts["mix_audio"]).lower() == "true")
+    audio_parts, audio_map = build_audio_filter_parts(mix, single_pass, audio_start, duration, music_gain=music_gain)
+    videos = [i for i, r in enumerate(renditions) if r["ext"] == "mp4"]
+    audio_maps = [audio_map] * (len(videos) + 1)
+    if videos and audio_map.startswith('"['):
+        # Una etiqueta del grafo solo se puede mapear una vez: repartir el audio con asplit
+        label = audio_map.strip('"[]')
+        audio_maps = [f'"[{label}_{n}]"' for n in range(len(videos) + 1)]
+        audio_parts.append(f"[{label}]asplit={len(audio_maps)}" + "".join(m.strip('"') for m in audio_maps))
+    filter_complex = ";".join(filter_parts + audio_parts)
+    filter_cmd = f'-filter_complex "{filter_complex}" ' if filter_complex else ""
+    video_map = "0:v:0" if video_copy else '"[v]"'
+    command = f'ffmpeg -y {inputs_cmd} {filter_cmd}' + build_output_args(
+        opts, video_map, audio_maps[0], out_path, video_copy=video_copy, output_args=output_args
+    )
+    for i, rendition in enumerate(renditions):
+        path = _rendition_path(out_path, rendition)
+        if rendition["ext"] == "jpg":
+            command += f' -map "[v_{i}]" -frames:v 1 -q:v 2 -an "{path}"'
+        else:
+            command += " " + build_output_args(opts, f'"[v_{i}]"', audio_maps[videos.index(i) + 1], path)
+    return command
+
+def build_batch_command(inputs: list, outputs: list) -> str:
+    """Un solo ffmpeg con varias salidas que comparten el video de entrada 0.
+
+    Cada salida es un dict con opts, out_path, audio_input, image_input, layer_input,
+    single_pass, audio_start, duration, video_copy y music_gain (opcional). El video se decodifica una vez y `split`
+    reparte los fotogramas entre las cadenas de filtros de cada salida.
+    """
+    inputs_cmd = " ".join(f'-i "{path}"' for path in inputs)
+    encoded = [i for i, out in enumerate(outputs) if not out["video_copy"]]
+    filter_parts = []
+    if len(encoded) > 1:
+        labels = "".join(f"[vin{i}]" for i in encoded)
+        filter_parts.append(f"[0:v]split={len(encoded)}{labels}")
+
+    outputs_cmd = []
+    for i, out in enumerate(outputs):
+        suffix = str(i)
+        if out["video_copy"]:
+            video_map = "0:v:0"
+        else:
+            video_in = f"[vin{i}]" if len(encoded) > 1 else "[0:v]"
+            filter_parts += build_video_filter_parts(
+                out["opts"], out["image_input"], video_in, suffix, layer_input=out.get("layer_input")
+            )
+            video_map = f'"[v{suffix}]"'
+        mix = (str(out["opts"]["mix_audio"]).lower() == "true")
+        audio_parts, audio_map = build_audio_filter_parts(
+            mix, out["single_pass"], out["audio_start"], out["duration"], out["audio_input"], suffix,
+            music_gain=out.get("music_gain"),
+        )
+        filter_parts += audio_parts
+        outputs_cmd.append(build_output_args(
+            out["opts"], video_map, audio_map, out["out_path"], video_copy=out["video_copy"]
+        ))
+
+    filter_complex = ";".join(filter_parts)
+    filter_cmd = f'-filter_complex "{filter_complex}" ' if filter_complex else ""
+    return f'ffmpeg -y {inputs_cmd} {filter_cmd}' + " ".join(outputs_cmd)
+
+def build_segment_command(video_path: str, opts: dict, out_path: str, start: float, length: float,
+                          overlay_path: Optional[str] = None, layer: bool = False, threads: int = 0) -> str:
+    """Encode solo de video del tramo [start, start+length) con el grafo de filtros completo.
+
+    El seek de entrada es exacto al transcodificar y cada segmento empieza en un keyframe.
+    overlay_path es la carátula o, con layer=True, la capa pre-compuesta (entrada 1).
+    """
+    overlay_cmd = f' -i "{overlay_path}"' if overlay_path else ""
+    image_input = 1 if overlay_path and not layer else None
+    layer_input = 1 if overlay_path and layer else None
+    filter_complex = ";".join(build_video_filter_parts(opts, image_input, layer_input=layer_input))
+    return (
+        f'ffmpeg -y -ss {start:.3f} -i "{video_path}"{overlay_cmd} -filter_complex "{filter_complex}" '
+        f'-map "[v]" {build_video_codec_args(opts, threads)} -t {length:.3f} -an "{out_path}"'
+    )
+
+def build_concat_mux_command(video_path: str, audio_path: str, list_path: str, opts: dict, out_path: str,
+                             single_pass: bool = False, audio_start: float = 0.0, duration: float = 0.0,
+                             music_gain: Optional[float] = None) -> str:
+    """Une los segmentos con el concat demuxer (sin re-encode) y procesa el audio una sola vez.
+
+    Entradas: 0 = video original (para mix_audio), 1 = audio, 2 = lista de segmentos.
+    """
+    mix = (str(opts["mix_audio"]).lower() == "true")
+    audio_parts, audio_map = build_audio_filter_parts(mix, single_pass, audio_start, duration, music_gain=music_gain)
+    filter_cmd = f'-filter_complex "{";".join(audio_parts)}" ' if audio_parts else ""
+    return (
+        f'ffmpeg -y -i "{video_path}" -i "{audio_path}" -f concat -safe 0 -i "{list_path}" {filter_cmd}'
+        + build_output_args(opts, "2:v:0", audio_map, out_path, video_copy=True)
+    )
+
+def chunk_bounds(duration: float, opts: dict, chunk_seconds: float = CHUNK_SECONDS) -> list:
+    """Tramos (inicio, duración) de longitud múltiplo del intervalo de keyframes del perfil"""
+    keyint = encoder_profile(opts)["keyint"] or 1
+    chunk = max(keyint, round(chunk_seconds / keyint) * keyint)
+    bounds = []
+    start = 0.0
+    while start < duration - 0.001:
+        bounds.append((start, min(chunk, duration - start)))
+        start += chunk
+    return bounds
+
+def run_chunked_encode(plan: dict, opts: dict, out_path: str, work_dir: str,
+                       chunk_seconds: float = CHUNK_SECONDS, workers: int = CHUNK_WORKERS, job=None) -> dict:
+    """Encode por segmentos en paralelo (un ffmpeg por segmento) y mux final con el audio.
+
+    plan usa las claves de _prepare_render: inputs, image_input, layer_input, single_pass,
+    audio_start, duration y music_gain (opcional). Con job, el progreso suma el avance de todos los segmentos.
+    """
+    video_path, audio_path = plan["inputs"][0], plan["inputs"][1]
+    overlay_path = plan["inputs"][2] if len(plan["inputs"]) > 2 else None
+    bounds = chunk_bounds(plan["duration"], opts, chunk_seconds)
+    workers = max(1, min(workers, len(bounds)))
+    # Repartir las CPUs entre los procesos en lugar de que cada x264 use todas
+    per_process = max(1, _available_cpus() // workers)
+    threads = ENCODER_THREADS or min(encoder_profile(opts)["threads"] or per_process, per_process)
+
+    segments = [os.path.join(work_dir, f"segment_{i:04d}.mp4") for i in range(len(bounds))]
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chunk") as pool:
+        futures = [
+            pool.submit(_run_encode, build_segment_command(
+                video_path, opts, seg, start, length, overlay_path,
+                layer=plan.get("layer_input") is not None, threads=threads,
+            ), job, length)
+            for seg, (start, length) in zip(segments, bounds)
+        ]
+        for fut in futures:
+            fut.result()
+    segments_seconds = time.perf_counter() - t0
+
+    list_path = os.path.join(work_dir, "segments.txt")
+    with open(list_path, "w") as f:
+        for seg in segments:
+            f.write(f"file '{seg}'\n")
+    t1 = time.perf_counter()
+    run(build_concat_mux_command(
+        video_path, audio_path, list_path, opts, out_path,
+        single_pass=plan["single_pass"], audio_start=plan["audio_start"], duration=plan["duration"],
+        music_gain=plan.get("music_gain"),
+    ), job)
+    print(f"DEBUG: Chunked encode: {len(bounds)} segments with {workers} workers in {segments_seconds:.2f}s")
+    return {
+        "segments": len(bounds),
+        "workers": workers,
+        "segments_seconds": round(segments_seconds, 3),
+        "mux_seconds": round(time.perf_counter() - t1, 3),
+    }
+
+class RenderError(Exception):
+    """Error del pipeline de render junto con el código HTTP a devolver"""
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.message = message
+        self.status_code = status_code
+
+class RenderSaveError(RenderError):
+    """El video se generó pero no se pudo publicar; conserva la ruta de staging para el fallback"""
+    def __init__(self, message: str, path: str):
+        super().__init__(message)
+        self.path = path
+
+class RenderCancelled(RenderError):
+    """El trabajo se canceló mientras estaba en cola o en ejecución"""
+    def __init__(self, message: str = "Render cancelled"):
+        super().__init__(message, status_code=409)
+
+class QueueFullError(Exception):
+    pass
+
+class RenderJob:
+    """Trabajo de render encolado en el pool de workers"""
+    def __init__(self, fn, kind: str = "render"):
+        self.id = str(uuid.uuid4())
+        self.kind = kind
+        self.status = "queued"
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self.error_status = None
+        self.exception = None
+        self.done = threading.Event()
+        self._fn = fn
+        # Progreso y cancelación: procesos ffmpeg asociados y su avance (-progress)
+        self.stage = None
+        self.progress = None
+        self.media_seconds = 0.0  # segundos de media que codificará el trabajo (base del %)
+        self.cancel_reason = None
+        self._procs = set()
+        self._downloads = set()  # _GrowingSource que se abortan al cancelar
+        self._running_progress = {}  # pid -> (out_time, fps, speed)
+        self._finished_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def attach(self, proc):
+        with self._lock:
+            self._procs.add(proc)
+            cancelled = self.cancel_reason is not None
+        if cancelled:
+            proc.kill()
+
+    def attach_download(self, source):
+        with self._lock:
+            self._downloads.add(source)
+            cancelled = self.cancel_reason is not None
+        if cancelled:
+            source.abort()
+
+    def detach(self, proc):
+        with self._lock:
+            self._procs.discard(proc)
+            entry = self._running_progress.pop(proc.pid, None)
+            if entry:
+                self._finished_seconds += entry[0]
+
+    def update_progress(self, key: int, out_time: float, fps: float, speed: float, duration: float):
+        with self._lock:
+            self._running_progress[key] = (min(out_time, duration), fps, speed)
+            total = self.media_seconds or duration
+            done = self._finished_seconds + sum(p[0] for p in self._running_progress.values())
+            self.progress = {
+                "percent": round(min(100.0, 100.0 * done / total), 1) if total else None,
+                "out_time": round(done, 3),
+                "fps": round(sum(p[1] for p in self._running_progress.values()), 1),
+                "speed": round(sum(p[2] for p in self._running_progress.values()), 2),
+            }
+
+    def set_stage(self, stage: str):
+        self.check()
+        self.stage = stage
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """Marca el trabajo como cancelado y mata sus procesos; False si ya había terminado"""
+        with self._lock:
+            if self.done.is_set() or self.cancel_reason:
+                return False
+            self.cancel_reason = reason
+            procs = list(self._procs)
+            downloads = list(self._downloads)
+            queued = self.status == "queued"
+            if queued:
+                # Aún no lo ha tomado un worker: termina ya y el worker lo descartará
+                self.status = "cancelled"
+                self.error = "Render cancelled"
+                self.error_status = 409
+                self.finished_at = time.time()
+        for proc in procs:
+            proc.kill()
+        for source in downloads:
+            source.abort()
+        if queued:
+            self.done.set()
+        print(f"DEBUG: Job {self.id} {reason} ({len(procs)} processes killed)")
+        return True
+
+    def check(self):
+        """Lanza la excepción correspondiente si el trabajo se canceló o superó RENDER_TIMEOUT"""
+        if self.cancel_reason == "timeout":
+            raise RenderError(f"Render timed out after {RENDER_TIMEOUT:g}s", status_code=504)
+        if self.cancel_reason:
+            raise RenderCancelled()
+
+    def to_dict(self) -> dict:
+        def _iso(ts):
+            return datetime.fromtimestamp(ts).isoformat() if ts else None
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": _iso(self.created_at),
+            "started_at": _iso(self.started_at),
+            "finished_at": _iso(self.finished_at),
+        }
+        if self.started_at:
+            end = self.finished_at or time.time()
+            data["elapsed_seconds"] = round(end - self.started_at, 3)
+        if self.status == "running":
+            data["stage"] = self.stage
+            data["progress"] = self.progress
+        if self.result is not None:
+            data["result"] = self.result
+        if self.error:
+            data["error"] = self.error
+        return data
+
+class RenderJobQueue:
+    """Cola acotada con un número fijo de workers para no sobresuscribir ffmpeg"""
+    def __init__(self, workers: int, max_queued: int, history_size: int):
+        self.workers = max(1, workers)
+        self.max_queued = max(1, max_queued)
+        self.history_size = max(1, history_size)
+        self._queue = queue.Queue(maxsize=self.max_queued)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+        self._running = 0
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"render-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            print(f"DEBUG: Started {self.workers} render workers (queue size {self.max_queued})")
+
+    def submit(self, fn, kind: str = "render") -> RenderJob:
+        """Encola un trabajo; lanza QueueFullError si la cola está llena"""
+        self._ensure_started()
+        job = RenderJob(fn, kind)
+        with self._lock:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                raise QueueFullError("Render queue is full")
+            self._jobs[job.id] = job
+            self._prune_history()
+        print(f"DEBUG: Job {job.id} queued ({self._queue.qsize()} waiting)")
+        return job
+
+    def get(self, job_id: str) -> Optional[RenderJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "running": self._running,
+                "queued": self._queue.qsize(),
+                "max_queued": self.max_queued,
+            }
+
+    def _prune_history(self):
+        # Solo se olvidan trabajos terminados, empezando por los más antiguos
+        excess = len(self._jobs) - self.history_size
+        if excess <= 0:
+            return
+        for job_id in [jid for jid, j in self._jobs.items() if j.done.is_set()][:excess]:
+            del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            with job._lock:
+                skip = job.cancel_reason is not None
+                if not skip:
+                    job.status = "running"
+                    job.started_at = time.time()
+            if skip:
+                # Cancelado mientras esperaba en la cola
+                RENDERS_TOTAL.labels(job.kind, "cancelled").inc()
+                self._queue.task_done()
+                continue
+            with self._lock:
+                self._running += 1
+            RENDER_STAGE_SECONDS.labels("queue_wait").observe(job.started_at - job.created_at)
+            timer = None
+            if RENDER_TIMEOUT > 0:
+                timer = threading.Timer(RENDER_TIMEOUT, job.cancel, args=("timeout",))
+                timer.daemon = True
+                timer.start()
+            try:
+                job.result = job._fn(job)
+                job.status = "done"
+            except RenderError as e:
+                job.status = "cancelled" if isinstance(e, RenderCancelled) else "failed"
+                job.error = e.message
+                job.error_status = e.status_code
+                job.exception = e
+            except Exception as e:
+                print(f"DEBUG: Job {job.id} crashed: {str(e)}")
+                job.status = "failed"
+                job.error = str(e)
+                job.error_status = 500
+                job.exception = e
+            finally:
+                if timer:
+                    timer.cancel()
+                job.finished_at = time.time()
+                with self._lock:
+                    self._running -= 1
+                if job.status in ("failed", "cancelled"):
+                    outcome = job.status
+                else:
+                    outcome = "cached" if (job.result or {}).get("cached") else "rendered"
+                RENDERS_TOTAL.labels(job.kind, outcome).inc()
+                job.done.set()
+                self._queue.task_done()
+                print(f"DEBUG: Job {job.id} finished with status {job.status}")
+
+JOB_QUEUE = RenderJobQueue(RENDER_WORKERS, RENDER_QUEUE_SIZE, JOBS_HISTORY_SIZE)
+
+def _queue_full_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=429,
+        content={"error": "Render queue is full, retry later"},
+        headers={"Retry-After": str(RENDER_RETRY_AFTER)},
+    )
+
+@app.get("/health")
+def health():
+    return {"ok": True}
+
+def _parse_range_header(value: str, size: int) -> Optional[list]:
+    """Rangos [(inicio, fin)] ordenados y fusionados de una cabecera Range.
+
+    Devuelve None si la cabecera no es válida (se ignora y se sirve el fichero
+    completo) y una lista vacía si ningún rango es satisfacible (416).
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        if not sep:
+            return None
+        try:
+            if not first.strip():
+                # Sufijo: los últimos N bytes ("bytes=--5" no es un sufijo válido)
+                if not last.strip().isdigit():
+                    return None
+                length = int(last)
+                if length <= 0:
+                    continue
+                ranges.append((max(0, size - length), size - 1))
+                continue
+            start = int(first)
+            end = int(last) if last.strip() else None
+        except ValueError:
+            return None
+        if start < 0 or (end is not None and start > end):
+            return None
+        end = size - 1 if end is None else end
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def _etag_matches(header: str, etag: str) -> bool:
+    """Comparación débil de If-None-Match (lista de etags o *)"""
+    tags = [t.strip() for t in header.split(",")]
+    return "*" in tags or etag in [t[2:] if t.startswith("W/") else t for t in tags]
+
+def _not_modified(request: Request, etag: str, mtime: float) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Si hay If-None-Match, If-Modified-Since se ignora
+        return _etag_matches(if_none_match, etag)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+class RangeFileResponse(Response):
+    """Fichero completo (200), un rango (206) o varios (206 multipart/byteranges).
+
+    Usa la extensión ASGI zerocopysend (sendfile) cuando el servidor la ofrece y,
+    si no, lee con pread en el threadpool en trozos de DOWNLOAD_CHUNK_KB.
+    """
+    def __init__(self, path: str, size: int, ranges: Optional[list], headers: dict, media_type: str):
+        self.path = path
+        self.background = None
+        self.status_code = 206 if ranges else 200
+        headers = dict(headers)
+        if not ranges:
+            self._parts = [(b"", 0, size - 1)] if size else []
+            self._trailer = b""
+            length = size
+            headers["Content-Type"] = media_type
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self._parts = [(b"", start, end)]
+            self._trailer = b""
+            length = end - start + 1
+            headers["Content-Type"] = media_type
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        else:
+            boundary = uuid.uuid4().hex
+            self._parts = [
+                ((b"\r\n" if i else b"") + (
+                    f"--{boundary}\r\nContent-Type: {media_type}\r\n"
+                    f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+                ).encode("latin-1"), start, end)
+                for i, (start, end) in enumerate(ranges)
+            ]
+            self._trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+            length = sum(len(prefix) + end - start + 1 for prefix, start, end in self._parts) + len(self._trailer)
+            headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+        headers["Content-Length"] = str(length)
+        self.init_headers(headers)
+
+    async def __call__(self, scope, receive, send):
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if scope["method"].upper() == "HEAD" or not self._parts:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+        zerocopy = "http.response.zerocopysend" in scope.get("extensions", {})
+        chunk_size = max(64, DOWNLOAD_CHUNK_KB) * 1024
+        f = await run_in_threadpool(open, self.path, "rb")
+        try:
+            for prefix, start, end in self._parts:
+                if prefix:
+                    await send({"type": "http.response.body", "body": prefix, "more_body": True})
+                if zerocopy:
+                    await send({
+                        "type": "http.response.zerocopysend", "file": f,
+                        "offset": start, "count": end - start + 1, "more_body": True,
+                    })
+                    continue
+                offset = start
+                while offset <= end:
+                    chunk = await run_in_threadpool(os.pread, f.fileno(), min(chunk_size, end - offset + 1), offset)
+                    if not chunk:
+                        raise RuntimeError(f"{self.path} is shorter than expected")
+                    offset += len(chunk)
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": self._trailer, "more_body": False})
+        finally:
+            f.close()
+
+@app.api_route("/download/{video_filename}", methods=["GET", "HEAD"])
+def download_video(video_filename: str, request: Request):
+    """Descargar video por UUID (con o sin extensión .mp4), con Range y GET condicional.
+
+    Las renditions se descargan como {uuid}_{nombre}.mp4 y el poster como {uuid}_poster.jpg.
+    """
+    match = re.fullmatch(r"([0-9a-fA-F-]+)(?:_([a-z0-9]+))?(?:\.(mp4|jpg))?", video_filename)
+    video_uuid = match.group(1) if match else video_filename
+    rendition = match.group(2) if match else None
+    ext = (match.group(3) if match else None) or ("jpg" if rendition == "poster" else "mp4")
     
     try:
         # Validar formato UUID
@@ -366,103 +2494,581 @@ def get_video_info(video_uuid: str, authorization: Optional[str] = Header(None))
     except ValueError:
         raise HTTPException(status_code=400, detail="UUID inválido")
     
-    filename = f"{video_uuid}.mp4"
+    filename = f"{video_uuid}_{rendition}.{ext}" if rendition else f"{video_uuid}.{ext}"
     file_path = os.path.join(VIDEOS_DIR, filename)
     
-    if not os.path.exists(file_path):
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Video no encontrado")
+
+    # Último acceso para la expulsión LRU de la retención
+    entry = None
+    try:
+        CATALOG.touch(video_uuid)
+        entry = CATALOG.get(video_uuid)
+    except Exception as e:
+        print(f"DEBUG: Could not update last access for {video_uuid}: {e}")
+
+    # ETag fuerte: el contenido de un UUID no cambia nunca; se deriva del hash del render si lo hay
+    etag = (entry or {}).get("render_key") or video_uuid
+    etag = f'"{etag}-{rendition}"' if rendition else f'"{etag}"'
+    last_modified = formatdate(st.st_mtime, usegmt=True)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": DOWNLOAD_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+    if _not_modified(request, etag, st.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    headers["Content-Disposition"] = f"attachment; filename={filename}"
+    ranges = None
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() in (etag, last_modified)):
+        ranges = _parse_range_header(range_header, st.st_size)
+        if ranges == []:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{st.st_size}"})
+        if ranges and len(ranges) > DOWNLOAD_MAX_RANGES:
+            ranges = None
+
+    media_type = "image/jpeg" if ext == "jpg" else "video/mp4"
+    return RangeFileResponse(file_path, st.st_size, ranges, headers, media_type=media_type)
+
+def _catalog_entry_response(entry: dict) -> dict:
+    return {
+        'uuid': entry['uuid'],
+        'filename': entry['filename'],
+        'size_bytes': entry['size_bytes'],
+        'size_mb': round(entry['size_bytes'] / (1024 * 1024), 2),
+        'created_at': datetime.fromtimestamp(entry['created_at']).isoformat(),
+        'duration': entry['duration'],
+        'render_key': entry['render_key'],
+        'params': entry['params'],
+        'sources': entry['sources'],
+    }
+
+def _parse_date_param(value: Optional[str], name: str) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"{name} inválido (ISO 8601)")
+
+@app.get("/videos")
+def list_videos(
+    authorization: Optional[str] = Header(None),
+    limit: int = 100,
+    cursor: Optional[str] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+):
+    """Listar videos del catálogo, más recientes primero, con paginación por cursor (requiere autenticación)"""
+    check_auth(authorization)
+
+    limit = max(1, min(limit, 1000))
+    since_ts = _parse_date_param(since, "since")
+    until_ts = _parse_date_param(until, "until")
+    try:
+        entries, next_cursor = CATALOG.list(limit, cursor, since_ts, until_ts)
+        total_count = CATALOG.count(since_ts, until_ts)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor inválido")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error listando videos: {str(e)}")
+    
+    return {
+        "videos": [_catalog_entry_response(entry) for entry in entries],
+        "total_count": total_count,
+        "next_cursor": next_cursor,
+        "timestamp": datetime.now().isoformat()
+    }
+
+@app.get("/video/{video_uuid}/info")
+def get_video_info(video_uuid: str, authorization: Optional[str] = Header(None)):
+    """Obtener información detallada de un video específico (requiere autenticación)"""
+    check_auth(authorization)
     
     try:
-        file_size = os.path.getsize(file_path)
-        file_mtime = os.path.getmtime(file_path)
-        
-        return {
-            "uuid": video_uuid,
-            "filename": filename,
-            "size_bytes": file_size,
-            "size_mb": round(file_size / (1024 * 1024), 2),
-            "created_at": datetime.fromtimestamp(file_mtime).isoformat(),
-            "download_url": f"/download/{video_uuid}.mp4",
-            "timestamp": datetime.now().isoformat()
-        }
+        # Validar formato UUID
+        uuid.UUID(video_uuid)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="UUID inválido")
+    
+    try:
+        entry = CATALOG.get(video_uuid)
+        if not entry:
+            # Videos publicados antes del catálogo o copiados a mano: registrarlos al consultarlos
+            file_path = os.path.join(VIDEOS_DIR, f"{video_uuid}.mp4")
+            if os.path.exists(file_path):
+                CATALOG.add_file(file_path)
+                entry = CATALOG.get(video_uuid)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error obteniendo información del video: {str(e)}")
 
-def _maybe_get_drive_service():
-    """Obtiene el servicio de Google Drive priorizando credenciales JSON"""
-    try:
-        creds_path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
-        
-        # Priorizar credenciales locales en el repo (solo para desarrollo local)
-        if not creds_path or not os.path.exists(creds_path):
-            # Intentar buscar archivos de credenciales en el directorio actual
+    if not entry:
+        raise HTTPException(status_code=404, detail="Video no encontrado")
+    
+    data = _catalog_entry_response(entry)
+    data["download_url"] = f"/download/{video_uuid}.mp4"
+    renditions = rendition_filenames(video_uuid, (entry["params"] or {}).get("renditions"))
+    if renditions:
+        data["renditions"] = {name: f"/download/{fn}" for name, fn in renditions.items()}
+    data["timestamp"] = datetime.now().isoformat()
+    return data
+
+class VideoCatalog:
+    """Catálogo SQLite de videos publicados con sus metadatos de render"""
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS videos (
+                    uuid TEXT PRIMARY KEY,
+                    filename TEXT NOT NULL,
+                    size_bytes INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL,
+                    duration REAL,
+                    render_key TEXT,
+                    video_path TEXT,
+                    params TEXT,
+                    sources TEXT
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_created ON videos(created_at, uuid)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_render_key ON videos(render_key)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_videos_last_access ON videos(last_access)")
+
+    @staticmethod
+    def _row(row) -> Optional[dict]:
+        if row is None:
+            return None
+        entry = dict(row)
+        entry["params"] = json.loads(entry["params"]) if entry["params"] else None
+        entry["sources"] = json.loads(entry["sources"]) if entry["sources"] else None
+        return entry
+
+    def add(self, video_uuid: str, filename: str, size_bytes: int, created_at: float,
+            duration: Optional[float] = None, render_key: Optional[str] = None,
+            video_path: Optional[str] = None, params: Optional[dict] = None, sources: Optional[dict] = None):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO videos (uuid, filename, size_bytes, created_at, last_access, duration,"
+                " render_key, video_path, params, sources) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (video_uuid, filename, size_bytes, created_at, created_at, duration, render_key, video_path,
+                 json.dumps(params) if params is not None else None,
+                 json.dumps(sources) if sources is not None else None),
+            )
+
+    def add_file(self, file_path: str):
+        """Registra un .mp4 existente usando solo los datos del filesystem"""
+        filename = os.path.basename(file_path)
+        st = os.stat(file_path)
+        self.add(filename[:-4], filename, st.st_size, st.st_mtime)
+
+    def get(self, video_uuid: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM videos WHERE uuid = ?", (video_uuid,)).fetchone()
+        return self._row(row)
+
+    def find_by_render_key(self, render_key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM videos WHERE render_key = ? ORDER BY created_at DESC LIMIT 1", (render_key,)
+            ).fetchone()
+        return self._row(row)
+
+    def remove(self, video_uuid: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM videos WHERE uuid = ?", (video_uuid,))
+
+    def touch(self, video_uuid: str, min_interval: float = 60.0):
+        """Actualiza el último acceso (como mucho una escritura por minuto y video)"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE videos SET last_access = ? WHERE uuid = ? AND (last_access IS NULL OR last_access < ?)",
+                (now, video_uuid, now - min_interval),
+            )
+
+    def usage(self) -> dict:
+        with self._lock:
+            count, total = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM videos").fetchone()
+        return {"videos": count, "total_bytes": total}
+
+    def created_before(self, ts: float, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM videos WHERE created_at < ? ORDER BY created_at LIMIT ?", (ts, limit)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def least_recently_used(self, limit: int) -> list:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM videos ORDER BY COALESCE(last_access, created_at) LIMIT ?", (limit,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    @staticmethod
+    def _range_clause(since: Optional[float], until: Optional[float]):
+        clauses, args = [], []
+        if since is not None:
+            clauses.append("created_at >= ?")
+            args.append(since)
+        if until is not None:
+            clauses.append("created_at < ?")
+            args.append(until)
+        return clauses, args
+
+    def list(self, limit: int, cursor: Optional[str] = None, since: Optional[float] = None,
+             until: Optional[float] = None):
+        """Página de videos (más recientes primero) y cursor de la siguiente página"""
+        clauses, args = self._range_clause(since, until)
+        if cursor:
+            # Paginación por clave (created_at, uuid): no depende de OFFSET
+            created_at, last_uuid = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+            clauses.append("(created_at < ? OR (created_at = ? AND uuid < ?))")
+            args.extend([float(created_at), float(created_at), last_uuid])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM videos {where} ORDER BY created_at DESC, uuid DESC LIMIT ?", args + [limit + 1]
+            ).fetchall()
+        entries = [self._row(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            last = entries[-1]
+            next_cursor = base64.urlsafe_b64encode(f"{last['created_at']!r}|{last['uuid']}".encode()).decode()
+        return entries, next_cursor
+
+    def count(self, since: Optional[float] = None, until: Optional[float] = None) -> int:
+        clauses, args = self._range_clause(since, until)
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        with self._lock:
+            return self._conn.execute(f"SELECT COUNT(*) FROM videos {where}", args).fetchone()[0]
+
+    def backfill(self, videos_dir: str):
+        """Importa los .mp4 existentes la primera vez que se crea el catálogo"""
+        if self.count() > 0:
+            return
+        added = 0
+        for filename in os.listdir(videos_dir):
+            if not filename.endswith('.mp4'):
+                continue
             try:
-                # Buscar archivos de credenciales en el directorio de trabajo actual
-                current_dir = os.getcwd()
-                candidates = glob.glob(os.path.join(current_dir, "video-generator-*-*.json"))
-                # También buscar en el directorio padre (por si estamos en /app)
-                parent_dir = os.path.dirname(current_dir)
-                candidates.extend(glob.glob(os.path.join(parent_dir, "video-generator-*-*.json")))
-                
-                for cand in candidates:
-                    if os.path.exists(cand):
-                        creds_path = cand
-                        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = creds_path
-                        print(f"DEBUG: Using local Drive credentials: {cand}")
-                        break
+                # Ignorar archivos que no tienen UUID válido como nombre
+                uuid.UUID(filename[:-4])
+                self.add_file(os.path.join(videos_dir, filename))
+                added += 1
+            except (ValueError, OSError):
+                continue
+        if added:
+            print(f"DEBUG: Catalog backfilled with {added} existing videos")
+
+CATALOG = VideoCatalog(CATALOG_PATH)
+CATALOG.backfill(VIDEOS_DIR)
+
+class RetentionManager:
+    """Hilo en segundo plano que aplica la retención de VIDEOS_DIR por edad y tamaño total.
+
+    Cada pasada borra como mucho `batch` videos por regla, así que el trabajo se
+    reparte en pasadas cortas y nunca bloquea a las peticiones.
+    """
+    def __init__(self, max_bytes: int, max_age_s: float, interval_s: float, batch: int, staging_max_age_s: float):
+        self.max_bytes = max_bytes
+        self.max_age_s = max_age_s
+        self.interval_s = interval_s
+        self.batch = max(1, batch)
+        self.staging_max_age_s = staging_max_age_s
+        self._stop = threading.Event()
+        self._thread = None
+        self.runs = 0
+        self.expired_videos = 0
+        self.evicted_videos = 0
+        self.evicted_bytes = 0
+        self.orphans_removed = 0
+        self.last_run_at = None
+        self.last_error = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="retention", daemon=True)
+        self._thread.start()
+        print(f"DEBUG: Retention manager started (max {self.max_bytes} bytes, max age {self.max_age_s}s)")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
             except Exception as e:
-                print(f"DEBUG: Error searching for local credentials: {e}")
-        
-        if not creds_path or not os.path.exists(creds_path):
-            print("DEBUG: No Google Drive credentials found")
-            return None
-            
-        # Crear credenciales desde el archivo
-        creds = GCredentials.from_service_account_file(
-            creds_path,
-            scopes=['https://www.googleapis.com/auth/drive']
-        )
-        
-        # Crear el servicio
-        service = build('drive', 'v3', credentials=creds)
-        print(f"DEBUG: Google Drive service created successfully using: {creds_path}")
-        return service
-        
-    except Exception as e:
-        print(f"DEBUG: Error creating Google Drive service: {e}")
-        return None
+                self.last_error = str(e)
+                print(f"DEBUG: Retention pass failed: {e}")
+            self._stop.wait(self.interval_s)
+
+    def _delete(self, entry: dict) -> int:
+        renditions = rendition_filenames(entry["uuid"], (entry["params"] or {}).get("renditions"))
+        for filename in [entry["filename"]] + list(renditions.values()):
+            try:
+                os.remove(os.path.join(VIDEOS_DIR, filename))
+            except FileNotFoundError:
+                pass
+        CATALOG.remove(entry["uuid"])
+        return entry["size_bytes"]
+
+    def run_once(self):
+        now = time.time()
+
+        # 1) Videos más antiguos que la edad máxima
+        if self.max_age_s > 0:
+            for entry in CATALOG.created_before(now - self.max_age_s, self.batch):
+                self._delete(entry)
+                self.expired_videos += 1
+                print(f"DEBUG: Retention expired {entry['uuid']}")
+
+        # 2) Cuota de disco: expulsar por último acceso (descarga) hasta quedar bajo el límite
+        if self.max_bytes > 0:
+            total = CATALOG.usage()["total_bytes"]
+            if total > self.max_bytes:
+                for entry in CATALOG.least_recently_used(self.batch):
+                    if total <= self.max_bytes:
+                        break
+                    total -= self._delete(entry)
+                    self.evicted_videos += 1
+                    self.evicted_bytes += entry["size_bytes"]
+                    print(f"DEBUG: Retention evicted {entry['uuid']} ({entry['size_bytes']} bytes)")
+
+        # 3) Salidas de staging huérfanas (renders interrumpidos por un reinicio o un crash)
+        #    y descargas parciales de Drive que nadie ha reanudado
+        for directory in (STAGING_DIR, DRIVE_PARTIAL_DIR):
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                path = os.path.join(directory, name)
+                try:
+                    if now - os.path.getmtime(path) > self.staging_max_age_s:
+                        os.remove(path)
+                        self.orphans_removed += 1
+                        print(f"DEBUG: Retention removed orphaned staging file {name}")
+                except OSError:
+                    continue
 
-def _save_video_locally(video_data: bytes, base_url: str):
-    """Guarda un video localmente con un UUID como nombre y devuelve la URL de descarga"""
+        self.runs += 1
+        self.last_run_at = now
+
+    def stats(self) -> dict:
+        usage = CATALOG.usage()
+        return {
+            "videos": usage["videos"],
+            "total_bytes": usage["total_bytes"],
+            "max_bytes": self.max_bytes,
+            "max_age_seconds": self.max_age_s,
+            "runs": self.runs,
+            "expired_videos": self.expired_videos,
+            "evicted_videos": self.evicted_videos,
+            "evicted_bytes": self.evicted_bytes,
+            "orphans_removed": self.orphans_removed,
+            "last_run_at": datetime.fromtimestamp(self.last_run_at).isoformat() if self.last_run_at else None,
+            "last_error": self.last_error,
+        }
+
+RETENTION = RetentionManager(
+    VIDEOS_MAX_TOTAL_MB * 1024 * 1024,
+    VIDEOS_MAX_AGE_HOURS * 3600,
+    RETENTION_INTERVAL,
+    RETENTION_BATCH,
+    STAGING_MAX_AGE_HOURS * 3600,
+)
+
+@app.on_event("startup")
+def _start_retention():
+    RETENTION.start()
+
+@app.on_event("shutdown")
+def _stop_retention():
+    RETENTION.stop()
+
+@app.get("/storage")
+def storage_usage(authorization: Optional[str] = Header(None)):
+    """Uso de disco de los videos generados y contadores de retención (requiere autenticación)"""
+    check_auth(authorization)
+    data = RETENTION.stats()
+    data["timestamp"] = datetime.now().isoformat()
+    return data
+
+def _staging_path(video_uuid: str) -> str:
+    """Ruta donde ffmpeg escribe la salida antes de publicarla (mismo filesystem que VIDEOS_DIR)"""
+    return os.path.join(STAGING_DIR, f"{video_uuid}.mp4")
+
+def _publish_video(staging_path: str, video_uuid: str, base_url: str, render_info: Optional[dict] = None,
+                   renditions: Optional[dict] = None):
+    """Publica el video de staging con un rename atómico, lo registra en el catálogo y devuelve la URL de descarga.
+
+    renditions ({nombre: ruta en staging}) se publican antes que el video principal y
+    cuentan en su tamaño, de modo que la retención los trata como un solo render. Si
+    el video principal no llega a publicarse, vuelven a staging.
+    """
+    moved = []  # (publicada, staging) de las renditions ya movidas
     try:
-        # Generar UUID único para el archivo
-        video_uuid = str(uuid.uuid4())
         filename = f"{video_uuid}.mp4"
         file_path = os.path.join(VIDEOS_DIR, filename)
+
+        extra_size = 0
+        rendition_urls = {}
+        for name, path in (renditions or {}).items():
+            published = os.path.join(VIDEOS_DIR, os.path.basename(path))
+            os.replace(path, published)
+            moved.append((published, path))
+            extra_size += os.path.getsize(published)
+            rendition_urls[name] = f"{base_url}/download/{os.path.basename(path)}"
         
-        # Guardar el video
-        print(f"DEBUG: Guardando video localmente como {filename}")
-        with open(file_path, 'wb') as f:
-            f.write(video_data)
+        # El rename es atómico: /download nunca ve un fichero a medio escribir
+        print(f"DEBUG: Publicando video como {filename}")
+        os.replace(staging_path, file_path)
+        moved = []
         
         file_size = os.path.getsize(file_path)
         print(f"DEBUG: Video guardado exitosamente. Tamaño: {file_size} bytes")
+
+        # Un fallo del catálogo no debe perder un video ya publicado
+        info = render_info or {}
+        try:
+            CATALOG.add(
+                video_uuid, filename, file_size + extra_size, time.time(),
+                duration=info.get("duration"), render_key=info.get("render_key"),
+                video_path=info.get("video_path"), params=info.get("params"), sources=info.get("sources"),
+            )
+        except Exception as e:
+            print(f"DEBUG: Could not register {video_uuid} in catalog: {e}")
         
         # Construir URL de descarga con extensión .mp4
         download_url = f"{base_url}/download/{video_uuid}.mp4"
         
-        return {
+        result = {
             'video_uuid': video_uuid,
             'filename': filename,
             'download_url': download_url,
             'file_size_bytes': file_size,
             'file_size_mb': round(file_size / (1024 * 1024), 2)
         }
+        if rendition_urls:
+            result['renditions'] = rendition_urls
+        return result
         
     except Exception as e:
         print(f"DEBUG: Error guardando video localmente: {e}")
+        # Sin video principal las renditions publicadas quedarían huérfanas
+        for published, path in moved:
+            try:
+                os.replace(published, path)
+            except OSError as rollback_error:
+                print(f"DEBUG: Could not roll back rendition {published}: {rollback_error}")
+                with contextlib.suppress(OSError):
+                    os.remove(published)
         raise Exception(f"Error guardando video localmente: {str(e)}")
 
+def _music_level(params: dict) -> Optional[dict]:
+    """Cómo se nivela la música en mix_audio con la configuración actual (None sin mezcla).
+
+    Con AUDIO_ASSET_CACHE y AUDIO_MIX_MUSIC_LUFS la música se lleva a ese objetivo
+    (music_gain_db); si no, se usa el volumen fijo MIX_MUSIC_VOLUME. En _render_cache_key las
+    fuentes siempre tienen versión, así que el asset existe si la caché está activa.
+    """
+    if str(params["mix_audio"]).lower() != "true":
+        return None
+    if AUDIO_ASSET_CACHE and AUDIO_MIX_MUSIC_LUFS:
+        return {"mode": "lufs", "target": AUDIO_MIX_MUSIC_LUFS}
+    return {"mode": "fixed", "volume": MIX_MUSIC_VOLUME}
+
+def _render_cache_key(params: dict) -> Optional[str]:
+    """Hash de los parámetros normalizados y las versiones de las fuentes (None si no es cacheable)"""
+    random_start = str(params["random_audio_start"]).lower() == "true"
+    if random_start and not params["seed"]:
+        # Sin semilla el inicio del audio no es determinista
+        return None
+
+    sources = {}
+    for name in ("video_url", "audio_url", "overlay_image_url"):
+        if not params[name]:
+            continue
+        version = _source_version(params[name])
+        if not version:
+            return None
+        sources[name] = version
+
+    dark = str(params["dark_overlay"]).lower() == "true"
+    normalized = {
+        "schema": 2,
+        "sources": sources,
+        "overlay_text": params["overlay_text"],
+        "position": params["position"] if params["overlay_text"] else None,
+        "target": params["target"] or "original",
+        "crf": int(params["crf"]),
+        "mix_audio": str(params["mix_audio"]).lower() == "true",
+        "music_level": _music_level(params),
+        # La pista preprocesada de AUDIO_ASSET_CACHE sustituye al audio original en el encode
+        "audio_asset": AUDIO_ASSET_BITRATE if AUDIO_ASSET_CACHE else None,
+        "dark_overlay": dark,
+        "dark_overlay_opacity": round(float(params["dark_overlay_opacity"]), 4) if dark else None,
+        "saturation_boost": round(float(params["saturation_boost"]), 4),
+        "audio_mode": params["audio_mode"],
+        "encoder_profile": params["encoder_profile"],
+        "random_audio_start": random_start,
+        "seed": params["seed"] if random_start else None,
+    }
+    if params.get("renditions"):
+        # Solo si se piden, para no invalidar las claves de los renders ya publicados
+        normalized["renditions"] = params["renditions"]
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _lookup_render(render_key: str, base_url: str) -> Optional[dict]:
+    """Resultado de un render idéntico ya publicado, si el video sigue existiendo"""
+    entry = CATALOG.find_by_render_key(render_key)
+    if not entry:
+        return None
+    if not os.path.exists(os.path.join(VIDEOS_DIR, entry["filename"])):
+        CATALOG.remove(entry["uuid"])
+        return None
+    result = {
+        "video_uuid": entry["uuid"],
+        "download_url": f"{base_url}/download/{entry['uuid']}.mp4",
+        "audio_mode": (entry["params"] or {}).get("audio_mode"),
+        "video_path": entry["video_path"],
+        "render_key": render_key,
+        "cached": True,
+    }
+    renditions = rendition_filenames(entry["uuid"], (entry["params"] or {}).get("renditions"))
+    if renditions:
+        result["renditions"] = {name: f"{base_url}/download/{fn}" for name, fn in renditions.items()}
+    return result
+
+def _render_info(params: dict, plan: dict, render_key: Optional[str]) -> dict:
+    """Metadatos de render que se guardan en el catálogo junto al video"""
+    return {
+        "duration": plan["duration"],
+        "render_key": render_key,
+        "video_path": plan["video_path"],
+        "params": {k: v for k, v in params.items() if k != "force_render"},
+        "sources": {
+            name: {"file_id": info.get("file_id"), "version": info.get("version")}
+            for name, info in plan["sources"].items() if info
+        },
+    }
+
 @app.get("/validate-credentials")
 def validate_credentials(authorization: Optional[str] = Header(None)):
     """Validar credenciales de Google Drive"""
@@ -513,7 +3119,7 @@ def validate_credentials(authorization: Optional[str] = Header(None)):
             # Hacer una prueba real de acceso
             try:
                 # Intentar listar archivos (con límite pequeño para ser eficiente)
-                files_result = service.files().list(pageSize=1, fields="files(id,name)").execute()
+                files_result = DRIVE_CLIENT.execute(service.files().list(pageSize=1, fields="files(id,name)"))
                 result["test_access"] = True
                 result["message"] = "Credenciales válidas y acceso a Google Drive confirmado"
             except Exception as access_error:
@@ -528,6 +3134,7 @@ def validate_credentials(authorization: Optional[str] = Header(None)):
         result["error"] = str(e)
         result["message"] = "Error validando credenciales"
     
+    result["drive_client"] = DRIVE_CLIENT.stats()
     return result
 
 @app.get("/test-download")
@@ -570,10 +3177,267 @@ def test_download(
     
     return result
 
-@app.post("/render")
-def render(
-    request: Request,
-    authorization: Optional[str] = Header(None),
+def _prepare_overlay_image(ipath: str, tmp: str) -> str:
+    """Redondea la imagen de carátula y la centra en un lienzo 400x400 (PNG con alpha)"""
+    # Preprocesar imagen: redondear 8px, escalar dentro de 400x400 y centrar sobre lienzo 400x400
+    try:
+        name = os.path.splitext(os.path.basename(ipath))[0]
+        rounded_path = os.path.join(tmp, f"{name}_rounded.png")
+        with Image.open(ipath) as im:
+            im = im.convert("RGBA")
+            max_w, max_h = 400, 400
+            im.thumbnail((max_w, max_h))
+            w, h = im.size
+            radius = 24
+            mask = Image.new("L", (w, h), 0)
+            draw = ImageDraw.Draw(mask)
+            draw.rounded_rectangle((0, 0, w, h), radius=radius, fill=255)
+            im.putalpha(mask)
+            canvas = Image.new("RGBA", (max_w, max_h), (0, 0, 0, 0))
+            canvas.paste(im, ((max_w - w) // 2, (max_h - h) // 2), im)
+            canvas.save(rounded_path)
+        print(f"DEBUG: Image preprocessing completed")
+        return rounded_path
+    except Exception as e:
+        print(f"DEBUG: Image preprocessing failed: {str(e)}")
+        # Si Pillow falla, continuar con la imagen original
+        return ipath
+
+def _output_frame_size(target: str, video_meta: Optional[dict]) -> Optional[tuple]:
+    """Tamaño (ancho, alto) de los frames tras build_scale_pad, o None si no se conoce"""
+    if target == "vertical" or target == "9:16":
+        return 1080, 1920
+    if target and "x" in target:
+        w, h = target.split("x", 1)
+        return int(w), int(h)
+    video = (video_meta or {}).get("video") or {}
+    if not video.get("width") or not video.get("height"):
+        return None
+    if video.get("rotation") in (90, 270):
+        return video["height"], video["width"]
+    return video["width"], video["height"]
+
+def render_overlay_layer(out_path: str, size: tuple, opts: dict, image_path: Optional[str] = None):
+    """Compone en un PNG RGBA las capas estáticas en el mismo orden que el grafo de filtros:
+    capa oscura, carátula centrada y texto con caja (equivalente a drawtext)"""
+    width, height = size
+    canvas = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+
+    if str(opts["dark_overlay"]).lower() == "true":
+        # Como la fuente color=...:size=1080x1920 superpuesta en (0,0)
+        alpha = round(float(opts["dark_overlay_opacity"]) * 255)
+        canvas.paste((0, 0, 0, alpha), (0, 0, min(width, 1080), min(height, 1920)))
+
+    if image_path:
+        with Image.open(image_path) as im:
+            im = im.convert("RGBA")
+            canvas.alpha_composite(im, ((width - im.width) // 2, (height - im.height) // 2))
+
+    if opts["overlay_text"]:
+        text = re.sub(r'[^\x00-\x7F]+', '', opts["overlay_text"])  # Solo ASCII, como drawtext
+        font = ImageFont.truetype(FONT_PATH, 48)
+        left, top, right, bottom = font.getbbox(text)
+        text_w, text_h = right - left, bottom - top
+        x = (width - text_w) // 2
+        if opts["position"] == "top":
+            y = 40
+        elif opts["position"] == "center":
+            y = (height - text_h) // 2 - 100
+        else:
+            y = height - text_h - 200
+        border = 10
+        box = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+        ImageDraw.Draw(box).rectangle(
+            (x - border, y - border, x + text_w + border - 1, y + text_h + border - 1), fill=(0, 0, 0, 115)
+        )
+        glyphs = Image.new("RGBA", (width, height), (255, 255, 255, 0))
+        ImageDraw.Draw(glyphs).text((x - left, y - top), text, font=font, fill=(255, 255, 255, 255))
+        canvas.alpha_composite(box)
+        canvas.alpha_composite(glyphs)
+
+    canvas.save(out_path, format="PNG")
+
+def _overlay_layer_key(size: tuple, opts: dict, image_path: Optional[str]) -> str:
+    dark = str(opts["dark_overlay"]).lower() == "true"
+    normalized = {
+        "schema": 1,
+        "size": list(size),
+        "image": _content_key(image_path) if image_path else None,
+        "text": opts["overlay_text"] or None,
+        "position": opts["position"] if opts["overlay_text"] else None,
+        "font": FONT_PATH if opts["overlay_text"] else None,
+        "dark_overlay_opacity": round(float(opts["dark_overlay_opacity"]), 4) if dark else None,
+    }
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _prepare_overlay_layer(opts: dict, image_path: Optional[str], video_meta: Optional[dict],
+                           out_path: str) -> Optional[str]:
+    """PNG con las capas estáticas pre-compuestas (desde LAYER_CACHE si existe), o None para
+    usar la cadena de filtros por frame (sin capas, tamaño desconocido o fallo de Pillow)"""
+    if not PRERENDER_LAYERS:
+        return None
+    has_layers = bool(image_path or opts["overlay_text"] or str(opts["dark_overlay"]).lower() == "true")
+    size = _output_frame_size(opts["target"], video_meta) if has_layers else None
+    if not size:
+        return None
+    try:
+        if LAYER_CACHE:
+            key = _overlay_layer_key(size, opts, image_path)
+            hit = LAYER_CACHE.fetch(key, out_path, lambda tmp_path: render_overlay_layer(tmp_path, size, opts, image_path))
+            print(f"DEBUG: Overlay layer {key[:12]} ({'cache hit' if hit else 'rendered'})")
+        else:
+            render_overlay_layer(out_path, size, opts, image_path)
+        return out_path
+    except Exception as e:
+        print(f"DEBUG: Overlay layer failed, using per-frame filters: {e}")
+        return None
+
+def _fetch_render_inputs(sources: dict, tmp: str, streaming: Optional[dict] = None,
+                         job: Optional[RenderJob] = None) -> dict:
+    """Descarga en paralelo las fuentes {nombre: (url, ruta)} y mide cada una.
+
+    La imagen de carátula se preprocesa en su propio hilo en cuanto termina su
+    descarga, sin esperar al video ni al audio. El audio sale de AUDIO_ASSET_CACHE
+    si está (sin descargarlo) y queda en "assets". Las fuentes de streaming
+    ({nombre: _GrowingSource}) no se esperan: quedan en "pending" y se completan
+    con _finish_fetch. Con job, el preprocesado del audio se asocia al trabajo.
+
+    Cada descarga tiene su _GrowingSource para poder abortarla: si otra fuente falla
+    o se cancela el trabajo, las demás paran en el siguiente trozo.
+    """
+    streaming = streaming or {}
+    timings = {}
+    infos = {}
+    paths = {}
+    assets = {}
+    progresses = {name: streaming.get(name) or _GrowingSource() for name in sources}
+    if job is not None:
+        for progress in progresses.values():
+            job.attach_download(progress)
+
+    def _fetch(name: str, url: str, out_path: str):
+        print(f"DEBUG: Starting download of {name} from: {url}")
+        t0 = time.perf_counter()
+        progress = progresses[name]
+        streamed = name in streaming
+        try:
+            asset = None
+            if name.startswith("audio") and not streamed:
+                asset = prepare_audio_asset(url, out_path, os.path.join(tmp, f"{name}_asset.m4a"), job, progress)
+            if asset:
+                infos[name] = dict(asset.get("source") or {})
+                if asset["cache_hit"]:
+                    infos[name].update(cache_hit=True, size_bytes=os.path.getsize(asset["path"]))
+                assets[name] = asset
+                out_path = asset["path"]
+            else:
+                infos[name] = download_source(url, out_path, progress)
+        except Exception as e:
+            if streamed:
+                progress.finish(e)
+            raise
+        finally:
+            # Las fuentes que no se leen por un pipe no necesitan el descriptor
+            if not streamed:
+                progress.close()
+        if streamed:
+            progress.finish()
+        timings[f"download_{name}"] = round(time.perf_counter() - t0, 3)
+        info = infos[name] or {}
+        DOWNLOAD_BYTES.labels(
+            name.split("_")[0], info.get("origin", "drive"), "hit" if info.get("cache_hit") else "miss"
+        ).inc(
+            info.get("size_bytes") or os.path.getsize(out_path)
+        )
+        print(f"DEBUG: {name.capitalize()} download completed in {timings[f'download_{name}']}s")
+        if name.startswith("image"):
+            t1 = time.perf_counter()
+            out_path = _prepare_overlay_image(out_path, tmp)
+            timings[name.replace("image", "image_preprocess", 1)] = round(time.perf_counter() - t1, 3)
+        paths[name] = out_path
+
+    t_start = time.perf_counter()
+    pool = ThreadPoolExecutor(max_workers=len(sources), thread_name_prefix="fetch")
+    futures = {name: pool.submit(_fetch, name, url, out_path) for name, (url, out_path) in sources.items()}
+    try:
+        done, _ = wait([f for name, f in futures.items() if name not in streaming], return_when=FIRST_EXCEPTION)
+        for fut in done:
+            if fut.exception():
+                # Cancelar lo que no haya empezado y abortar las descargas en curso
+                for other in futures.values():
+                    other.cancel()
+                for progress in progresses.values():
+                    progress.abort()
+                pool.shutdown(wait=True)
+                for progress in streaming.values():
+                    progress.close()
+                raise fut.exception()
+    finally:
+        pool.shutdown(wait=False)
+    fetched = {
+        "paths": paths, "timings": timings, "sources": infos, "started": t_start, "streaming": streaming,
+        "pending": {name: futures[name] for name in streaming}, "assets": assets,
+    }
+    if not streaming:
+        timings["download_total"] = round(time.perf_counter() - t_start, 3)
+        print(f"DEBUG: Inputs fetched: {timings}")
+    return fetched
+
+def _finish_fetch(fetched: dict, job: Optional[RenderJob] = None, timeout: Optional[float] = None):
+    """Espera a las descargas en streaming pendientes y propaga su error como RenderError.
+
+    Si el trabajo se canceló mientras tanto se lanza su error (cancelado o timeout)
+    en lugar del de la descarga abortada.
+    """
+    try:
+        for fut in fetched["pending"].values():
+            fut.result(timeout=timeout)
+    except Exception as e:
+        if job is not None:
+            job.check()
+        print(f"DEBUG: Download failed: {str(e)}")
+        raise RenderError(f"Download failed: {str(e)}")
+    finally:
+        fetched["pending"] = {}
+        for progress in fetched["streaming"].values():
+            progress.close()
+    if "download_total" not in fetched["timings"]:
+        fetched["timings"]["download_total"] = round(time.perf_counter() - fetched["started"], 3)
+        print(f"DEBUG: Inputs fetched: {fetched['timings']}")
+
+def _abandon_fetch(fetched: dict):
+    """Aborta las descargas pendientes y las espera (sin propagar errores) antes de borrar el directorio temporal.
+
+    Una descarga abortada para en el siguiente trozo; la espera se limita al
+    timeout de una petición por si la conexión se queda colgada.
+    """
+    for progress in fetched["streaming"].values():
+        progress.abort()
+    try:
+        _finish_fetch(fetched, timeout=max(HTTP_TIMEOUT, DRIVE_HTTP_TIMEOUT))
+    except RenderError:
+        pass
+
+def _probe_header(head: bytes, size: Optional[int], tmp: str, cache_key: Optional[str] = None) -> dict:
+    """Metadatos de un MP4 a partir de su cabecera (ftyp + moov) mientras el resto se descarga"""
+    cached = PROBE_CACHE.get(cache_key) if cache_key else None
+    if cached is not None:
+        print(f"DEBUG: Probe cache hit for {cache_key}")
+        return cached
+    path = os.path.join(tmp, "video_header.mp4")
+    with open(path, "wb") as f:
+        f.write(head)
+    print(f"DEBUG: Probing partial header {path} ({len(head)} bytes)")
+    meta = _parse_probe(json.loads(run(f'ffprobe -v error -print_format json -show_format -show_streams "{path}"')))
+    # Tamaño y bitrate del fichero completo, no de la cabecera
+    meta["size_bytes"] = size
+    meta["bit_rate"] = int(size * 8 / meta["duration"]) if size and meta["duration"] else None
+    if cache_key:
+        PROBE_CACHE.put(cache_key, meta)
+    return meta
+
+def _render_form(
     # Solo URLs (fuentes obligatorias)
     video_url: str = Form(...),
     audio_url: str = Form(...),
@@ -583,242 +3447,1100 @@ def render(
     position: str = Form("bottom"),
     mix_audio: str = Form("false"),
     target: str = Form("original"),
-    crf: int = Form(18),
+    crf: Optional[int] = Form(None),
     random_audio_start: str = Form("false"),
     dark_overlay: str = Form("false"),
     dark_overlay_opacity: float = Form(0.4),
     saturation_boost: float = Form(1.06),
-):
-    check_auth(authorization)
+    audio_mode: str = Form(""),
+    seed: str = Form(""),
+    force_render: str = Form("false"),
+    encoder_profile: str = Form(""),
+    chunked: str = Form("auto"),
+    renditions: str = Form(""),
+) -> dict:
+    """Parámetros de formulario comunes a /render y /jobs"""
+    return {
+        "video_url": video_url,
+        "audio_url": audio_url,
+        "overlay_image_url": overlay_image_url,
+        "overlay_text": overlay_text,
+        "position": position,
+        "mix_audio": mix_audio,
+        "target": target,
+        "crf": crf,
+        "random_audio_start": random_audio_start,
+        "dark_overlay": dark_overlay,
+        "dark_overlay_opacity": dark_overlay_opacity,
+        "saturation_boost": saturation_boost,
+        "audio_mode": audio_mode or RENDER_AUDIO_MODE,
+        "seed": seed,
+        "force_render": force_render,
+        "encoder_profile": encoder_profile or ENCODER_PROFILE,
+        "chunked": chunked,
+        "renditions": renditions,
+    }
+
+# Valores por defecto de _render_form para los parámetros que llegan en JSON (/render/batch)
+RENDER_DEFAULTS = {
+    "video_url": "",
+    "audio_url": "",
+    "overlay_image_url": "",
+    "overlay_text": "",
+    "position": "bottom",
+    "mix_audio": "false",
+    "target": "original",
+    "crf": None,
+    "random_audio_start": "false",
+    "dark_overlay": "false",
+    "dark_overlay_opacity": 0.4,
+    "saturation_boost": 1.06,
+    "audio_mode": "",
+    "seed": "",
+    "force_render": "false",
+    "encoder_profile": "",
+    "chunked": "auto",
+    "renditions": "",
+}
 
-    if position not in ("top", "center", "bottom"):
-        return JSONResponse(status_code=400, content={"error": "position invalid"})
+def _batch_variant_params(defaults: dict, variant: dict) -> dict:
+    """Parámetros de una variante: variante > defaults del lote > defaults de /render"""
+    params = dict(RENDER_DEFAULTS)
+    for source in (defaults, variant):
+        params.update({k: v for k, v in source.items() if k in RENDER_DEFAULTS and v is not None})
+    for name in ("video_url", "audio_url", "overlay_image_url", "overlay_text", "position",
+                 "target", "audio_mode", "seed", "encoder_profile", "chunked", "renditions"):
+        params[name] = str(params[name])
+    params["audio_mode"] = params["audio_mode"] or RENDER_AUDIO_MODE
+    params["encoder_profile"] = params["encoder_profile"] or ENCODER_PROFILE
+    return params
+
+def _render_params_error(params: dict) -> Optional[str]:
+    """Mensaje de error de validación de los parámetros de render, o None si son válidos"""
+    if params["position"] not in ("top", "center", "bottom"):
+        return "position invalid"
+    if params["audio_mode"] not in AUDIO_MODES:
+        return "audio_mode invalid"
+    if params["encoder_profile"] not in ENCODER_PROFILES:
+        return "encoder_profile invalid"
+    params["chunked"] = str(params["chunked"]).lower() or "auto"
+    if params["chunked"] not in ("auto", "true", "false"):
+        return "chunked invalid"
+    try:
+        # Forma canónica: misma petición, misma clave de render y mismos ficheros
+        params["renditions"] = ",".join(r["name"] for r in parse_renditions(params.get("renditions", "")))
+    except ValueError as e:
+        return f"renditions invalid: {e}"
     try:
-        crf = int(crf)
+        # Sin crf explícito se usa el del perfil de encoder
+        crf = params["crf"]
+        params["crf"] = int(crf) if crf not in (None, "") else ENCODER_PROFILES[params["encoder_profile"]]["crf"]
     except:
-        return JSONResponse(status_code=400, content={"error": "crf invalid"})
+        return "crf invalid"
+    try:
+        params["dark_overlay_opacity"] = float(params["dark_overlay_opacity"])
+        params["saturation_boost"] = float(params["saturation_boost"])
+    except (TypeError, ValueError):
+        return "dark_overlay_opacity and saturation_boost must be numbers"
 
     # Validación: URLs obligatorias
-    if not video_url:
-        return JSONResponse(status_code=400, content={"error": "video_url required"})
-    if not audio_url:
-        return JSONResponse(status_code=400, content={"error": "audio_url required"})
+    if not params["video_url"]:
+        return "video_url required"
+    if not params["audio_url"]:
+        return "audio_url required"
+    for name in ("video_url", "audio_url", "overlay_image_url"):
+        try:
+            if params.get(name):
+                source_origin(params[name])
+        except RuntimeError:
+            return f"{name} has an unsupported scheme"
+    return None
 
-    with tempfile.TemporaryDirectory() as tmp:
-        vpath = os.path.join(tmp, "in_video.mp4")
-        apath = os.path.join(tmp, "in_audio.mp3")
-        taac  = os.path.join(tmp, "trim_audio.aac")
-        # Prepara ruta de imagen si viene como archivo o URL
-        ipath = os.path.join(tmp, "overlay_image.jpg") if overlay_image_url else None
-        out   = os.path.join(tmp, "out_final.mp4")
+def _validate_render_params(params: dict) -> Optional[JSONResponse]:
+    error = _render_params_error(params)
+    if error:
+        return JSONResponse(status_code=400, content={"error": error})
+    return None
 
-        try:
-            # Descargar archivos
-            print(f"DEBUG: Starting download of video from: {video_url}")
-            _download_with_drive_confirm(video_url, vpath)
-            print(f"DEBUG: Video download completed")
-            
-            print(f"DEBUG: Starting download of audio from: {audio_url}")
-            _download_with_drive_confirm(audio_url, apath)
-            print(f"DEBUG: Audio download completed")
-            
-            # Guardar imagen si se proporciona
-            if overlay_image_url:
-                print(f"DEBUG: Starting download of image from: {overlay_image_url}")
-                _download_with_drive_confirm(overlay_image_url, ipath)
-                print(f"DEBUG: Image download completed")
-                
-                # Preprocesar imagen: redondear 8px, escalar dentro de 400x400 y centrar sobre lienzo 400x400
-                try:
-                    rounded_path = os.path.join(tmp, "overlay_image_rounded.png")
-                    with Image.open(ipath) as im:
-                        im = im.convert("RGBA")
-                        max_w, max_h = 400, 400
-                        im.thumbnail((max_w, max_h))
-                        w, h = im.size
-                        radius = 24
-                        mask = Image.new("L", (w, h), 0)
-                        draw = ImageDraw.Draw(mask)
-                        draw.rounded_rectangle((0, 0, w, h), radius=radius, fill=255)
-                        im.putalpha(mask)
-                        canvas = Image.new("RGBA", (max_w, max_h), (0, 0, 0, 0))
-                        canvas.paste(im, ((max_w - w) // 2, (max_h - h) // 2), im)
-                        canvas.save(rounded_path)
-                    ipath = rounded_path
-                    print(f"DEBUG: Image preprocessing completed")
-                except Exception as e:
-                    print(f"DEBUG: Image preprocessing failed: {str(e)}")
-                    # Si Pillow falla, continuar con la imagen original
-                    pass
+def _prepare_render(params: dict, tmp: str, job: Optional[RenderJob] = None, pipelined: bool = False) -> dict:
+    """Descarga, probe y recorte de audio; devuelve el plan del encode sin ejecutarlo.
 
-        except Exception as e:
-            print(f"DEBUG: Download failed: {str(e)}")
-            return JSONResponse(status_code=500, content={"error": f"Download failed: {str(e)}"})
+    Con pipelined=True un video MP4 con moov al principio no se espera: el plan lo
+    lee por un pipe (plan["pipe_source"]) mientras termina de descargarse y el
+    llamador debe cerrar la descarga con _finish_fetch(plan["fetch"]).
+    """
+    video_url = params["video_url"]
+    audio_url = params["audio_url"]
+    overlay_image_url = params["overlay_image_url"]
+    random_audio_start = params["random_audio_start"]
 
-        # Verificar archivos descargados
-        if not os.path.exists(vpath) or os.path.getsize(vpath) == 0:
-            return JSONResponse(status_code=500, content={"error": "Video download failed or file is empty"})
-        if not os.path.exists(apath) or os.path.getsize(apath) == 0:
-            return JSONResponse(status_code=500, content={"error": "Audio download failed or file is empty"})
+    vpath = os.path.join(tmp, "in_video.mp4")
+    apath = os.path.join(tmp, "in_audio.mp3")
+    taac  = os.path.join(tmp, "trim_audio.aac")
+    # Prepara ruta de imagen si viene como archivo o URL
+    ipath = os.path.join(tmp, "overlay_image.jpg") if overlay_image_url else None
 
-        # Duración vídeo
-        try:
-            dur = ffprobe_duration(vpath)
-            dur_s = f"{dur:.3f}"
-            print(f"DEBUG: Video duration: {dur} seconds")
-        except Exception as e:
-            print(f"DEBUG: Failed to get video duration: {str(e)}")
-            return JSONResponse(status_code=500, content={"error": f"Cannot process video file: {str(e)}"})
+    # Descargar todas las fuentes en paralelo (la imagen se preprocesa al terminar su descarga)
+    sources = {"video": (video_url, vpath), "audio": (audio_url, apath)}
+    if overlay_image_url:
+        sources["image"] = (overlay_image_url, ipath)
+    growing = _GrowingSource() if pipelined and PIPELINED_INPUT and params["chunked"] != "true" else None
+    try:
+        fetched = _fetch_render_inputs(sources, tmp, {"video": growing} if growing else None, job)
+    except Exception as e:
+        if job is not None:
+            job.check()
+        print(f"DEBUG: Download failed: {str(e)}")
+        raise RenderError(f"Download failed: {str(e)}")
+    try:
+        plan = _prepare_render_plan(params, tmp, job, fetched, growing, vpath, apath, taac, ipath)
+    except BaseException:
+        _abandon_fetch(fetched)
+        raise
+    if not plan["pipe_source"]:
+        _finish_fetch(fetched, job)
+    return plan
+
+def _prepare_render_plan(params: dict, tmp: str, job: Optional[RenderJob], fetched: dict,
+                         growing: Optional[_GrowingSource], vpath: str, apath: str, taac: str,
+                         ipath: Optional[str]) -> dict:
+    random_audio_start = params["random_audio_start"]
+    timings = fetched["timings"]
+    if ipath:
+        ipath = fetched["paths"]["image"]
+    # Pista preprocesada (AUDIO_ASSET_CACHE): duración y loudness ya calculadas
+    asset = fetched["assets"].get("audio")
+    if asset:
+        apath = asset["path"]
 
-        # Obtener punto de inicio aleatorio del audio si se solicita
-        audio_start = 0.0
-        if str(random_audio_start).lower() == "true":
-            audio_start = get_random_audio_start(apath, dur)
-            print(f"DEBUG: Using random audio start at {audio_start:.3f} seconds")
+    # Video que aún se descarga: si es un MP4 faststart, el probe usa solo la cabecera
+    head = None
+    if growing:
+        t0 = time.perf_counter()
+        head = growing.header(job)
+        if head:
+            timings["video_header_wait"] = round(time.perf_counter() - t0, 3)
+            print(f"DEBUG: Video has moov first, encoding while it downloads ({len(head)} header bytes)")
+        else:
+            _finish_fetch(fetched, job)
+
+    # Verificar archivos descargados
+    if not head and (not os.path.exists(vpath) or os.path.getsize(vpath) == 0):
+        raise RenderError("Video download failed or file is empty")
+    if not os.path.exists(apath) or os.path.getsize(apath) == 0:
+        raise RenderError("Audio download failed or file is empty")
 
-        # Recorte/normalización audio con punto de inicio aleatorio
+    # Duración vídeo
+    t0 = time.perf_counter()
+    try:
+        if head:
+            video_meta = _probe_header(head, growing.size, tmp, _probe_key(growing.source))
+        else:
+            video_meta = probe_media(vpath, _probe_key(fetched["sources"].get("video")))
+        dur = video_meta["duration"]
+        print(f"DEBUG: Video duration: {dur} seconds")
+    except Exception as e:
+        print(f"DEBUG: Failed to get video duration: {str(e)}")
+        raise RenderError(f"Cannot process video file: {str(e)}")
+
+    # Obtener punto de inicio aleatorio del audio si se solicita
+    audio_start = 0.0
+    if str(random_audio_start).lower() == "true":
+        audio_start = get_random_audio_start(
+            apath, dur, _probe_key(fetched["sources"].get("audio")), seed=params["seed"] or None,
+            audio_duration=asset["duration"] if asset else None,
+        )
+        print(f"DEBUG: Using random audio start at {audio_start:.3f} seconds")
+    timings["probe"] = round(time.perf_counter() - t0, 3)
+
+    # Si no hay ningún filtro de video efectivo, remuxar el video sin re-encode
+    video_copy = is_video_passthrough(params, bool(ipath), video_meta)
+    video_path = "copy" if video_copy else "encode"
+    print(f"DEBUG: Video path: {video_path}")
+
+    # En remux el audio va siempre en el mismo ffmpeg: un recorte previo duraría más que la copia
+    single_pass = params["audio_mode"] == "single_pass" or video_copy
+    if single_pass:
+        # El recorte y remuestreo del audio se hacen dentro del grafo principal
+        audio_input = apath
+    else:
+        # Recorte/normalización audio con punto de inicio aleatorio (copia del stream si ya está preprocesado)
         try:
-            cmd_trim = f'ffmpeg -y -ss {audio_start:.3f} -i "{apath}" -t {dur_s} -ac 2 -ar 48000 -c:a aac "{taac}"'
+            t0 = time.perf_counter()
+            if asset:
+                taac = os.path.join(tmp, "trim_audio.m4a")
+                cmd_trim = build_audio_cut_command(apath, taac, audio_start, dur)
+            else:
+                cmd_trim = build_audio_trim_command(apath, taac, audio_start, dur)
             print(f"DEBUG: Trimming audio with command: {cmd_trim}")
-            run(cmd_trim)
+            run(cmd_trim, job)
+            timings["audio_trim"] = round(time.perf_counter() - t0, 3)
             print(f"DEBUG: Audio trimming completed")
+        except RenderError:
+            raise
         except Exception as e:
             print(f"DEBUG: Audio trimming failed: {str(e)}")
-            return JSONResponse(status_code=500, content={"error": f"Audio processing failed: {str(e)}"})
+            raise RenderError(f"Audio processing failed: {str(e)}")
+        audio_input = taac
 
-        # Construir comando FFmpeg - versión simplificada pero funcional
-        
-        # Con imagen - construir grafo con labels explícitas y sin filtros vacíos
-        if ipath:
-            inputs_cmd = f'-i "{vpath}" -i "{taac}" -i "{ipath}"'
+    # Capa oscura, carátula y texto pre-compuestos: un solo overlay en lugar de filtros por frame
+    layer = None
+    if not video_copy:
+        t0 = time.perf_counter()
+        layer = _prepare_overlay_layer(params, ipath, video_meta, os.path.join(tmp, "overlay_layer.png"))
+        if layer:
+            timings["overlay_layer"] = round(time.perf_counter() - t0, 3)
+    overlay_input = layer or ipath
 
-            # Preparar fragmentos de filtro de forma determinista
-            parts = []
+    # Videos largos: encode por segmentos en paralelo (automático por encima de CHUNKED_MIN_DURATION)
+    chunked = False
+    renditions = [] if video_copy else parse_renditions(params.get("renditions", ""))
+    if renditions:
+        renditions = drop_capped_renditions(renditions, params, _output_frame_size(params["target"], video_meta))
+        # El catálogo y las URLs de la respuesta solo listan las renditions generadas
+        params["renditions"] = ",".join(r["name"] for r in renditions)
+    if not video_copy and not renditions and len(chunk_bounds(dur, params)) > 1:
+        if params["chunked"] == "true":
+            chunked = True
+        elif params["chunked"] == "auto":
+            chunked = CHUNKED_MIN_DURATION > 0 and dur >= CHUNKED_MIN_DURATION and CHUNK_WORKERS > 1
+    if chunked:
+        print(f"DEBUG: Using chunked encode for {dur:.1f}s video")
+        if head:
+            # Los segmentos necesitan buscar en el fichero: esperar a la descarga completa
+            _finish_fetch(fetched, job)
+            head = None
 
-            # 1) La imagen ya está procesada (PNG con alpha). Solo asegurar formato rgba
-            parts.append("[2:v]format=rgba[img]")
+    return {
+        "inputs": ["pipe:0" if head else vpath, audio_input] + ([overlay_input] if overlay_input else []),
+        "video_file": vpath,
+        "pipe_source": growing if head else None,
+        "fetch": fetched,
+        "image_input": 2 if ipath and not layer else None,
+        "layer_input": 2 if layer else None,
+        "chunked": chunked,
+        "renditions": renditions,
+        "single_pass": single_pass,
+        "audio_start": audio_start,
+        "music_gain": music_gain_db(asset),
+        "duration": dur,
+        "video_copy": video_copy,
+        "video_path": video_path,
+        "video_meta": video_meta,
+        "sources": fetched["sources"],
+        "timings": timings,
+    }
 
-            # 2) Preparar el video base: si hay escala/pad, aplicarlo; si no, usar 'null'
-            scale = build_scale_pad(target)
-            if scale:
-                parts.append(f"[0:v]{scale},eq=saturation={saturation_boost}[base]")
-            else:
-                parts.append(f"[0:v]eq=saturation={saturation_boost}[base]")
-
-            # 3) Si se solicita, aplicar una capa oscura sobre el video base
-            base_label = "base"
-            if str(dark_overlay).lower() == "true":
-                parts.append(f"color=black@{dark_overlay_opacity}:size=1080x1920[dark]")
-                parts.append("[base][dark]overlay[base_dark]")
-                base_label = "base_dark"
-
-            # 4) Hacer overlay de la imagen centrada
-            parts.append(f"[{base_label}][img]overlay=(W-w)/2:(H-h)/2[ov]")
-
-            # 5) Añadir texto si corresponde
-            if overlay_text:
-                text_filter = build_drawtext_expr(overlay_text, position)
-                # Encadena drawtext correctamente sobre la etiqueta previa
-                parts.append(f"[ov]{text_filter}[ov2]")
-                final_in = "[ov2]"
-            else:
-                final_in = "[ov]"
+def _plan_command(plan: dict, params: dict, out_path: str, output_args: str = "") -> str:
+    return build_render_command(
+        plan["inputs"], params, out_path, image_input=plan["image_input"],
+        single_pass=plan["single_pass"], audio_start=plan["audio_start"], duration=plan["duration"],
+        video_copy=plan["video_copy"], output_args=output_args, layer_input=plan["layer_input"],
+        renditions=plan.get("renditions"), music_gain=plan.get("music_gain"),
+    )
 
-            # 6) Formato final y label de salida (sin coma tras la etiqueta)
-            parts.append(f"{final_in}format=yuv420p[v]")
+# Claves de timings que corresponden a una etapa del histograma video_render_stage_seconds
+TIMING_STAGES = {
+    "download_total": "download",
+    "image_preprocess": "image_preprocess",
+    "probe": "probe",
+    "audio_trim": "audio_trim",
+    "overlay_layer": "overlay_layer",
+    "encode": "encode",
+    "publish": "publish",
+    "total": "total",
+}
 
-            filter_parts = [';'.join(parts)]
-            
-        else:
-            # Sin imagen - aplicar escala, capa oscura opcional y texto con labels explícitas
-            inputs_cmd = f'-i "{vpath}" -i "{taac}"'
+def _observe_timings(timings: dict):
+    # Las etapas por miembro (image_preprocess_0, image_preprocess_1...) cuentan en su etapa base
+    for key, value in timings.items():
+        stage = TIMING_STAGES.get(re.sub(r"_\d+$", "", key))
+        if stage and isinstance(value, (int, float)):
+            RENDER_STAGE_SECONDS.labels(stage).observe(value)
 
-            parts = []
-            scale = build_scale_pad(target)
-            if scale:
-                parts.append(f"[0:v]{scale},eq=saturation={saturation_boost}[base]")
-            else:
-                parts.append(f"[0:v]eq=saturation={saturation_boost}[base]")
-
-            base_label = "base"
-            if str(dark_overlay).lower() == "true":
-                parts.append(f"color=black@{dark_overlay_opacity}:size=1080x1920[dark]")
-                parts.append("[base][dark]overlay[base_dark]")
-                base_label = "base_dark"
-
-            final_in = f"[{base_label}]"
-            if overlay_text:
-                text_filter = build_drawtext_expr(overlay_text, position)
-                parts.append(f"{final_in}{text_filter}[txt]")
-                final_in = "[txt]"
-
-            parts.append(f"{final_in}format=yuv420p[v]")
-            filter_parts = [';'.join(parts)]
-        
-        # Audio
-        mix = (str(mix_audio).lower() == "true")
-        if mix:
-            filter_parts.append("[0:a]volume=1.0[a0];[1:a]volume=0.35[a1];[a0][a1]amix=inputs=2:duration=shortest[aout]")
-            audio_map = "[aout]"
-        else:
-            audio_map = "1:a:0"
-        
-        # Comando final
-        filter_complex = ";".join(filter_parts)
-        cmd = (
-            f'ffmpeg -y {inputs_cmd} -filter_complex "{filter_complex}" '
-            f'-map "[v]" -map {audio_map} -c:v libx264 -preset veryfast -crf {crf} '
-            f'-c:a aac -b:a 192k -shortest "{out}"'
-        )
+def _encode_stats(out_path: str, params: dict, duration: float, video_meta: Optional[dict],
+                  seconds: float) -> dict:
+    """Perfil, velocidad del encode (fps aprox. a partir de duración y fps de la fuente) y bitrate de salida"""
+    size = os.path.getsize(out_path)
+    fps = ((video_meta or {}).get("video") or {}).get("fps")
+    stats = {
+        "encoder_profile": params["encoder_profile"],
+        "crf": params["crf"],
+        "encode_seconds": round(seconds, 3),
+        "encode_fps": round(duration * fps / seconds, 1) if fps and seconds > 0 else None,
+        "output_bitrate_kbps": round(size * 8 / duration / 1000) if duration else None,
+    }
+    print(f"DEBUG: Encode stats: {stats}")
+    if stats["encode_fps"]:
+        ENCODE_FPS.labels(stats["encoder_profile"]).observe(stats["encode_fps"])
+    if stats["output_bitrate_kbps"]:
+        OUTPUT_BITRATE_KBPS.labels(stats["encoder_profile"]).observe(stats["output_bitrate_kbps"])
+    return stats
+
+def _run_render(params: dict, base_url: str, job: Optional[RenderJob] = None,
+                stream_fallback: bool = False) -> dict:
+    """Pipeline completo de render: descarga, probe, recorte de audio, encode y guardado.
+
+    Con stream_fallback=True, si la publicación falla se conserva el fichero de
+    staging y se lanza RenderSaveError para que el llamador lo sirva directamente.
+    """
+    # Un render idéntico (mismos parámetros y versiones de las fuentes) ya publicado se reutiliza
+    render_key = _render_cache_key(params)
+    if render_key and str(params["force_render"]).lower() != "true":
+        cached = _lookup_render(render_key, base_url)
+        if cached:
+            print(f"DEBUG: Render cache hit {render_key} -> {cached['video_uuid']}")
+            return cached
+
+    t_start = time.perf_counter()
+    if job:
+        job.set_stage("preparing")
+    with tempfile.TemporaryDirectory() as tmp:
+        plan = _prepare_render(params, tmp, job, pipelined=True)
+
+        # ffmpeg escribe directamente en staging dentro de VIDEOS_DIR
+        video_uuid = str(uuid.uuid4())
+        out = _staging_path(video_uuid)
+        cmd = _plan_command(plan, params, out)
+        renditions = {r["name"]: _rendition_path(out, r) for r in plan["renditions"]}
 
         try:
-            print(f"DEBUG: Executing FFmpeg command: {cmd}")
-            run(cmd)
+            if job:
+                job.media_seconds = plan["duration"]
+                job.set_stage("encoding")
+            if plan["chunked"]:
+                # Cada segmento reserva su propio hueco de encode
+                t0 = time.perf_counter()
+                plan["timings"]["chunks"] = run_chunked_encode(plan, params, out, tmp, job=job)
+            else:
+                with encode_slot(job):
+                    t0 = time.perf_counter()
+                    if plan["pipe_source"]:
+                        print(f"DEBUG: Executing pipelined FFmpeg command: {cmd}")
+                        _run_pipelined(plan, params, out, cmd, job)
+                    else:
+                        print(f"DEBUG: Executing FFmpeg command: {cmd}")
+                        run(cmd, job, plan["duration"])
+            encode_seconds = time.perf_counter() - t0
             print(f"DEBUG: FFmpeg completed successfully")
+
+            # Verificar que el archivo se creó
+            if not os.path.exists(out):
+                print(f"DEBUG: Output file does not exist: {out}")
+                raise RenderError("Video processing failed - output file not created")
+            
+            file_size = os.path.getsize(out)
+            print(f"DEBUG: Output file created successfully, size: {file_size} bytes")
+            
+            if file_size == 0:
+                raise RenderError("Video processing failed - output file is empty")
+            for name, path in renditions.items():
+                if not os.path.exists(path) or os.path.getsize(path) == 0:
+                    raise RenderError(f"Video processing failed - rendition {name} not created")
+            encode = _encode_stats(out, params, plan["duration"], plan["video_meta"], encode_seconds)
+            plan["timings"]["encode"] = encode["encode_seconds"]
         except Exception as e:
+            _abandon_fetch(plan["fetch"])
+            for path in [out] + list(renditions.values()):
+                if os.path.exists(path):
+                    os.remove(path)
+            if isinstance(e, RenderError):
+                raise
             print(f"DEBUG: FFmpeg failed with error: {str(e)}")
-            return JSONResponse(status_code=500, content={"error": f"FFmpeg error: {str(e)}"})
+            raise RenderError(f"FFmpeg error: {str(e)}")
 
-        # Verificar que el archivo se creó
-        if not os.path.exists(out):
-            print(f"DEBUG: Output file does not exist: {out}")
-            return JSONResponse(status_code=500, content={"error": "Video processing failed - output file not created"})
-        
-        file_size = os.path.getsize(out)
-        print(f"DEBUG: Output file created successfully, size: {file_size} bytes")
-        
-        if file_size == 0:
-            return JSONResponse(status_code=500, content={"error": "Video processing failed - output file is empty"})
-
-        # Leer el archivo completo antes de que se elimine el directorio temporal
-        print(f"DEBUG: Reading output file into memory")
-        with open(out, "rb") as f:
-            video_data = f.read()
-        print(f"DEBUG: File read successfully, {len(video_data)} bytes in memory")
-
-    # Guardar video localmente con UUID
+    # Publicar el video con su UUID (rename atómico, sin pasar por memoria)
+    if job:
+        job.stage = "publishing"
     try:
-        # Construir URL base del servidor
-        base_url = f"{request.url.scheme}://{request.url.netloc}"
-        
-        # Guardar video localmente
-        print(f"DEBUG: Guardando video generado localmente")
-        local_result = _save_video_locally(video_data, base_url)
-        
-        # Devolver directamente la URL de descarga
+        t0 = time.perf_counter()
+        local_result = _publish_video(
+            out, video_uuid, base_url, _render_info(params, plan, render_key), renditions=renditions
+        )
+        plan["timings"]["publish"] = round(time.perf_counter() - t0, 3)
         print(f"DEBUG: Video guardado exitosamente. URL: {local_result['download_url']}")
-        return JSONResponse({
-            "download_url": local_result['download_url']
-        })
-        
     except Exception as save_error:
         print(f"ERROR: Error guardando localmente: {save_error}")
-        
-        # Si falla el guardado, devolver el archivo como streaming (fallback)
-        def iterfile():
-            chunk_size = 1024 * 1024  # 1MB chunks
-            for i in range(0, len(video_data), chunk_size):
-                yield video_data[i:i + chunk_size]
-
-        headers = {"Content-Disposition": 'attachment; filename="out_final.mp4"'}
-        return StreamingResponse(iterfile(), media_type="video/mp4", headers=headers)
\ No newline at end of file
+        for path in renditions.values():
+            if os.path.exists(path):
+                os.remove(path)
+        if stream_fallback:
+            raise RenderSaveError(f"Error saving video: {save_error}", out)
+        if os.path.exists(out):
+            os.remove(out)
+        raise RenderError(f"Error saving video: {save_error}")
+
+    plan["timings"]["total"] = round(time.perf_counter() - t_start, 3)
+    _observe_timings(plan["timings"])
+    return {
+        "video_uuid": local_result['video_uuid'],
+        "download_url": local_result['download_url'],
+        "audio_mode": params["audio_mode"],
+        "video_path": plan["video_path"],
+        "render_key": render_key,
+        "cached": False,
+        "encode": encode,
+        "timings": plan["timings"],
+        **({"renditions": local_result["renditions"]} if "renditions" in local_result else {}),
+    }
+
+def _run_pipelined(plan: dict, params: dict, out: str, cmd: str, job: Optional[RenderJob] = None):
+    """Encode leyendo el video por stdin mientras se descarga.
+
+    Si ffmpeg no puede leer el MP4 de forma secuencial (p. ej. mal entrelazado),
+    se repite el encode desde el fichero una vez descargado.
+    """
+    failure = None
+    try:
+        run(cmd, job, plan["duration"], stdin_source=plan["pipe_source"])
+    except RenderError:
+        raise
+    except Exception as e:
+        failure = e
+    # Una descarga fallida deja la entrada truncada: el resultado no vale aunque ffmpeg acabe bien
+    _finish_fetch(plan["fetch"], job)
+    plan["pipe_source"] = None
+    if failure is None:
+        return
+    print(f"DEBUG: Pipelined encode failed, retrying from the downloaded file: {str(failure)[-300:]}")
+    plan["inputs"][0] = plan["video_file"]
+    run(_plan_command(plan, params, out), job, plan["duration"])
+
+class _StreamSink:
+    """Puente entre el worker que lee la salida de ffmpeg y la respuesta HTTP en streaming"""
+    def __init__(self, max_chunks: int):
+        self.chunks = queue.Queue(maxsize=max_chunks)
+        self.client_gone = threading.Event()
+        # Fin del stream: siempre se señala, aunque se hayan descartado trozos
+        self.finished = threading.Event()
+        self.error = None
+
+    def push(self, item: bytes):
+        # Si el cliente deja de leer, el render sigue (se publica igualmente) sin bloquear el worker
+        if self.client_gone.is_set():
+            return
+        try:
+            self.chunks.put(item, timeout=STREAM_CLIENT_TIMEOUT)
+        except queue.Full:
+            print("DEBUG: Stream client is not reading, detaching from render")
+            self.client_gone.set()
+
+    def finish(self, error: Optional["RenderError"] = None):
+        self.error = error
+        self.finished.set()
+
+    def next(self, job, timeout: float = 1.0):
+        """Siguiente trozo; None cuando el render terminó (o el trabajo acabó) y no queda nada"""
+        while True:
+            try:
+                return self.chunks.get(timeout=timeout)
+            except queue.Empty:
+                if (self.finished.is_set() or job.done.is_set()) and self.chunks.empty():
+                    return None
+
+def _run_render_stream(params: dict, base_url: str, job: Optional[RenderJob],
+                       sink: _StreamSink, video_uuid: str) -> dict:
+    """Render con MP4 fragmentado a un pipe: cada trozo va al cliente y a staging a la vez"""
+    out = _staging_path(video_uuid)
+    t_start = time.perf_counter()
+    try:
+        if job:
+            job.set_stage("preparing")
+        with tempfile.TemporaryDirectory() as tmp:
+            plan = _prepare_render(params, tmp, job)
+            cmd = _plan_command(plan, params, "pipe:1", output_args=FRAGMENTED_MP4_ARGS)
+            print(f"DEBUG: Executing streaming FFmpeg command: {cmd}")
+            if job:
+                job.media_seconds = plan["duration"]
+                job.set_stage("encoding")
+
+            with encode_slot(job):
+                # stderr a fichero para que un log largo no bloquee el pipe
+                t0 = time.perf_counter()
+                args = shlex.split(cmd)
+                read_fd, write_fd = _progress_args(args, job, plan["duration"])
+                with tempfile.TemporaryFile() as err, open(out, "wb") as f, \
+                        ACTIVE_PROCESSES.labels("ffmpeg").track_inprogress():
+                    proc = subprocess.Popen(
+                        args, stdout=subprocess.PIPE, stderr=err,
+                        pass_fds=(write_fd,) if write_fd is not None else (),
+                    )
+                    if write_fd is not None:
+                        os.close(write_fd)
+                        threading.Thread(
+                            target=_read_progress, args=(read_fd, job, proc.pid, plan["duration"]), daemon=True
+                        ).start()
+                    if job:
+                        job.attach(proc)
+                    try:
+                        while True:
+                            data = proc.stdout.read1(STREAM_CHUNK_SIZE)
+                            if not data:
+                                break
+                            f.write(data)
+                            sink.push(data)
+                    finally:
+                        proc.stdout.close()
+                        returncode = proc.wait()
+                        if job:
+                            job.detach(proc)
+                    if job:
+                        job.check()
+                    if returncode != 0:
+                        raise RenderError(f"FFmpeg error: {_stderr_tail(err)}")
+
+        if os.path.getsize(out) == 0:
+            raise RenderError("Video processing failed - output file is empty")
+        encode = _encode_stats(out, params, plan["duration"], plan["video_meta"], time.perf_counter() - t0)
+        plan["timings"]["encode"] = encode["encode_seconds"]
+        if job:
+            job.stage = "publishing"
+        # Sin render_key: el MP4 fragmentado (sin faststart) no debe servir a un /render idéntico
+        t0 = time.perf_counter()
+        local_result = _publish_video(out, video_uuid, base_url, _render_info(params, plan, None))
+        plan["timings"]["publish"] = round(time.perf_counter() - t0, 3)
+    except Exception as e:
+        if os.path.exists(out):
+            os.remove(out)
+        sink.finish(e if isinstance(e, RenderError) else RenderError(str(e)))
+        raise
+
+    sink.finish()
+    plan["timings"]["total"] = round(time.perf_counter() - t_start, 3)
+    _observe_timings(plan["timings"])
+    print(f"DEBUG: Streamed render published at {local_result['download_url']}")
+    return {
+        "video_uuid": video_uuid,
+        "download_url": local_result['download_url'],
+        "audio_mode": params["audio_mode"],
+        "video_path": plan["video_path"],
+        "encode": encode,
+        "timings": plan["timings"],
+    }
+
+def _batch_encode(video_path: str, members: list, base_url: str, job: Optional[RenderJob] = None) -> list:
+    """Un ffmpeg para varias variantes sobre el mismo video; publica cada salida.
+
+    Una variante que no se puede publicar vuelve como {"status": "failed", "error"} sin
+    detener a las demás, y ninguna salida sin publicar queda en staging.
+    """
+    inputs = [video_path]
+    input_index = {video_path: 0}
+
+    def _input(path: str) -> int:
+        if path not in input_index:
+            input_index[path] = len(inputs)
+            inputs.append(path)
+        return input_index[path]
+
+    outputs = []
+    for m in members:
+        m["video_uuid"] = str(uuid.uuid4())
+        outputs.append({
+            "opts": m["params"],
+            "out_path": _staging_path(m["video_uuid"]),
+            "audio_input": _input(m["audio_input"]),
+            "image_input": _input(m["image_path"]) if m["image_path"] and not m["layer_path"] else None,
+            "layer_input": _input(m["layer_path"]) if m["layer_path"] else None,
+            "single_pass": m["single_pass"],
+            "audio_start": m["audio_start"],
+            "music_gain": m["music_gain"],
+            "duration": m["duration"],
+            "video_copy": m["video_copy"],
+        })
+
+    cmd = build_batch_command(inputs, outputs)
+    try:
+        print(f"DEBUG: Executing batch FFmpeg command ({len(outputs)} outputs): {cmd}")
+        with encode_slot(job):
+            t0 = time.perf_counter()
+            run(cmd, job, members[0]["duration"])
+        encode_seconds = time.perf_counter() - t0
+        for out in outputs:
+            if not os.path.exists(out["out_path"]) or os.path.getsize(out["out_path"]) == 0:
+                raise RenderError("Video processing failed - output file is empty")
+    except Exception as e:
+        for out in outputs:
+            if os.path.exists(out["out_path"]):
+                os.remove(out["out_path"])
+        raise e if isinstance(e, RenderError) else RenderError(f"FFmpeg error: {str(e)}")
+
+    results = []
+    try:
+        for m, out in zip(members, outputs):
+            try:
+                encode = _encode_stats(out["out_path"], m["params"], m["duration"], m["video_meta"], encode_seconds)
+                published = _publish_video(out["out_path"], m["video_uuid"], base_url,
+                                           _render_info(m["params"], m["plan"], m["render_key"]))
+            except Exception as e:
+                print(f"ERROR: Error guardando la variante {m['video_uuid']}: {e}")
+                results.append({"status": "failed", "error": f"Error saving video: {e}"})
+                continue
+            results.append({
+                "video_uuid": m["video_uuid"],
+                "download_url": published["download_url"],
+                "audio_mode": m["params"]["audio_mode"],
+                "video_path": m["plan"]["video_path"],
+                "render_key": m["render_key"],
+                "cached": False,
+                "encode": encode,
+            })
+    finally:
+        # Las salidas que no llegaron a publicarse (fallo o cancelación) no se quedan en staging
+        for out in outputs:
+            if os.path.exists(out["out_path"]):
+                os.remove(out["out_path"])
+    return results
+
+def _run_render_batch(variants: list, base_url: str, job: Optional[RenderJob] = None) -> dict:
+    """Render de muchas variantes compartiendo descargas, probes, recortes de audio y decodificación.
+
+    Las fuentes distintas se descargan y analizan una sola vez. Las variantes que usan el
+    mismo video se agrupan en procesos ffmpeg con varias salidas (hasta
+    BATCH_OUTPUTS_PER_PROCESS) y los procesos se ejecutan en paralelo (hasta BATCH_PARALLELISM).
+    """
+    t_start = time.perf_counter()
+    results = [None] * len(variants)
+
+    # 1) Renders ya publicados y variantes repetidas dentro del lote
+    pending = OrderedDict()  # render_key (o índice si no es cacheable) -> índices
+    render_keys = {}
+    for i, params in enumerate(variants):
+        render_key = _render_cache_key(params)
+        if render_key and str(params["force_render"]).lower() != "true":
+            cached = _lookup_render(render_key, base_url)
+            if cached:
+                results[i] = dict(cached, index=i, status="done")
+                continue
+        render_keys[i] = render_key
+        pending.setdefault(render_key or f"variant:{i}", []).append(i)
+
+    timings = {}
+    processes = 0
+    if pending:
+        if job:
+            job.set_stage("preparing")
+        with tempfile.TemporaryDirectory() as tmp:
+            # 2) Descargar cada fuente distinta una vez
+            names = {}  # (tipo, url) -> nombre de la descarga
+            sources = {}
+            for indexes in pending.values():
+                params = variants[indexes[0]]
+                for kind, url_key, ext in (("video", "video_url", "mp4"), ("audio", "audio_url", "mp3"),
+                                           ("image", "overlay_image_url", "jpg")):
+                    url = params[url_key]
+                    if url and (kind, url) not in names:
+                        name = f"{kind}_{len(names)}"
+                        names[(kind, url)] = name
+                        sources[name] = (url, os.path.join(tmp, f"{name}.{ext}"))
+            try:
+                fetched = _fetch_render_inputs(sources, tmp, job=job)
+            except Exception as e:
+                if job is not None:
+                    job.check()
+                print(f"DEBUG: Batch download failed: {str(e)}")
+                raise RenderError(f"Download failed: {str(e)}")
+            timings.update(fetched["timings"])
+
+            # 3) Probe de cada video distinto
+            t0 = time.perf_counter()
+            video_meta = {}
+            for (kind, url), name in names.items():
+                if kind != "video":
+                    continue
+                try:
+                    video_meta[url] = probe_media(fetched["paths"][name], _probe_key(fetched["sources"].get(name)))
+                except Exception as e:
+                    raise RenderError(f"Cannot process video file: {str(e)}")
+            timings["probe"] = round(time.perf_counter() - t0, 3)
+
+            # 4) Plan por variante; el recorte AAC (two_pass) se comparte entre variantes iguales
+            members = []
+            trims = {}  # (audio_url, inicio, duración) -> ruta del AAC
+            for render_key, indexes in pending.items():
+                params = variants[indexes[0]]
+                meta = video_meta[params["video_url"]]
+                dur = meta["duration"]
+                audio_name = names[("audio", params["audio_url"])]
+                apath = fetched["paths"][audio_name]
+                asset = fetched["assets"].get(audio_name)
+                audio_start = 0.0
+                if str(params["random_audio_start"]).lower() == "true":
+                    audio_start = get_random_audio_start(
+                        apath, dur, _probe_key(fetched["sources"].get(audio_name)), seed=params["seed"] or None,
+                        audio_duration=asset["duration"] if asset else None,
+                    )
+                image_name = names.get(("image", params["overlay_image_url"])) if params["overlay_image_url"] else None
+                image_path = fetched["paths"][image_name] if image_name else None
+                video_copy = is_video_passthrough(params, bool(image_path), meta)
+                # Una variante en remux procesa el audio en el grafo principal, sin recorte previo
+                single_pass = params["audio_mode"] == "single_pass" or video_copy
+                audio_input = apath
+                if not single_pass:
+                    trim_key = (params["audio_url"], round(audio_start, 3), round(dur, 3))
+                    if trim_key not in trims:
+                        trims[trim_key] = os.path.join(tmp, f"trim_{len(trims)}.{'m4a' if asset else 'aac'}")
+                    audio_input = trims[trim_key]
+                layer_path = None if video_copy else _prepare_overlay_layer(
+                    params, image_path, meta, os.path.join(tmp, f"layer_{len(members)}.png")
+                )
+                members.append({
+                    "indexes": indexes,
+                    "params": params,
+                    "render_key": render_keys[indexes[0]],
+                    "audio_input": audio_input,
+                    "image_path": image_path,
+                    "layer_path": layer_path,
+                    "single_pass": single_pass,
+                    "audio_start": audio_start,
+                    "music_gain": music_gain_db(asset),
+                    "duration": dur,
+                    "video_copy": video_copy,
+                    "video_meta": meta,
+                    "plan": {
+                        "duration": dur,
+                        "video_path": "copy" if video_copy else "encode",
+                        "sources": {
+                            kind: fetched["sources"].get(names[(kind, params[url_key])])
+                            for kind, url_key in (("video", "video_url"), ("audio", "audio_url"),
+                                                  ("image", "overlay_image_url"))
+                            if params[url_key]
+                        },
+                    },
+                })
+
+            workers = max(1, BATCH_PARALLELISM)
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch") as pool:
+                t0 = time.perf_counter()
+                trim_futures = []
+                for (audio_url, start, dur), out_path in trims.items():
+                    audio_name = names[("audio", audio_url)]
+                    apath = fetched["paths"][audio_name]
+                    if audio_name in fetched["assets"]:
+                        cmd_trim = build_audio_cut_command(apath, out_path, start, dur)
+                    else:
+                        cmd_trim = build_audio_trim_command(apath, out_path, start, dur)
+                    trim_futures.append(pool.submit(run, cmd_trim, job))
+                for fut in trim_futures:
+                    try:
+                        fut.result()
+                    except RenderError:
+                        raise
+                    except Exception as e:
+                        raise RenderError(f"Audio processing failed: {str(e)}")
+                timings["audio_trim"] = round(time.perf_counter() - t0, 3)
+
+                # 5) Agrupar por video y repartir en procesos ffmpeg con varias salidas
+                groups = OrderedDict()
+                for m in members:
+                    groups.setdefault(m["params"]["video_url"], []).append(m)
+                chunk = max(1, BATCH_OUTPUTS_PER_PROCESS)
+                t0 = time.perf_counter()
+                parts = []
+                for video_url, group in groups.items():
+                    video_path = fetched["paths"][names[("video", video_url)]]
+                    for start in range(0, len(group), chunk):
+                        parts.append((video_path, group[start:start + chunk]))
+                if job:
+                    job.media_seconds = sum(part[0]["duration"] for _, part in parts)
+                    job.set_stage("encoding")
+                futures = {
+                    pool.submit(_batch_encode, video_path, part, base_url, job): part for video_path, part in parts
+                }
+                processes = len(futures)
+                for fut, part in futures.items():
+                    try:
+                        encoded = fut.result()
+                    except Exception as e:
+                        error = e.message if isinstance(e, RenderError) else str(e)
+                        print(f"DEBUG: Batch encode failed: {error}")
+                        encoded = [None] * len(part)
+                    for m, result in zip(part, encoded):
+                        for i in m["indexes"]:
+                            if result is None:
+                                results[i] = {"index": i, "status": "failed", "error": error}
+                            elif result.get("status") == "failed":
+                                results[i] = dict(result, index=i)
+                            else:
+                                results[i] = dict(result, index=i, status="done")
+                timings["encode"] = round(time.perf_counter() - t0, 3)
+                if job:
+                    # Las variantes ya publicadas se conservan, pero el trabajo queda cancelado
+                    job.check()
+
+    timings["total"] = round(time.perf_counter() - t_start, 3)
+    _observe_timings(timings)
+    done = [r for r in results if r["status"] == "done"]
+    return {
+        "variants": results,
+        "rendered": sum(1 for r in done if not r["cached"]),
+        "cached": sum(1 for r in done if r["cached"]),
+        "failed": len(results) - len(done),
+        "processes": processes,
+        "timings": timings,
+    }
+
+def _base_url(request: Request) -> str:
+    return f"{request.url.scheme}://{request.url.netloc}"
+
+@app.post("/render")
+def render(
+    request: Request,
+    authorization: Optional[str] = Header(None),
+    params: dict = Depends(_render_form),
+):
+    check_auth(authorization)
+
+    invalid = _validate_render_params(params)
+    if invalid:
+        return invalid
+
+    # El render se ejecuta en el pool de workers; esta petición espera al resultado
+    base_url = _base_url(request)
+    try:
+        job = JOB_QUEUE.submit(lambda j: _run_render(params, base_url, j, stream_fallback=True))
+    except QueueFullError:
+        return _queue_full_response()
+    job.done.wait()
+
+    if job.status in ("failed", "cancelled"):
+        if isinstance(job.exception, RenderSaveError):
+            # Si falla el guardado, servir el fichero de staging desde disco y borrarlo al terminar
+            path = job.exception.path
+            job.exception = None
+            headers = {"Content-Disposition": 'attachment; filename="out_final.mp4"'}
+            return FileResponse(
+                path, media_type="video/mp4", headers=headers,
+                background=BackgroundTask(os.remove, path),
+            )
+        return JSONResponse(status_code=job.error_status or 500, content={"error": job.error})
+
+    # Devolver directamente la URL de descarga
+    return JSONResponse({
+        "download_url": job.result['download_url'],
+        "video_path": job.result['video_path'],
+        "cached": job.result['cached'],
+        "encode": job.result.get('encode'),
+        "timings": job.result.get('timings'),
+        **({"renditions": job.result["renditions"]} if job.result.get("renditions") else {}),
+    })
+
+@app.post("/render/stream")
+def render_stream(
+    request: Request,
+    authorization: Optional[str] = Header(None),
+    params: dict = Depends(_render_form),
+):
+    """Render con respuesta progresiva: el MP4 fragmentado se envía mientras se codifica"""
+    check_auth(authorization)
+
+    invalid = _validate_render_params(params)
+    if invalid:
+        return invalid
+    if params["renditions"]:
+        return JSONResponse(status_code=400, content={"error": "renditions are not supported in /render/stream"})
+    if params["chunked"] == "true":
+        # El MP4 fragmentado sale de un único ffmpeg hacia el pipe: no hay segmentos que unir
+        return JSONResponse(status_code=400, content={"error": "chunked=true is not supported in /render/stream"})
+
+    base_url = _base_url(request)
+    video_uuid = str(uuid.uuid4())
+    sink = _StreamSink(STREAM_BUFFER_CHUNKS)
+    try:
+        job = JOB_QUEUE.submit(lambda j: _run_render_stream(params, base_url, j, sink, video_uuid), kind="stream")
+    except QueueFullError:
+        return _queue_full_response()
+
+    # Esperar al primer trozo para poder devolver los errores previos al encode como JSON
+    first = sink.next(job)
+    if first is None:
+        if sink.error is not None:
+            return JSONResponse(status_code=sink.error.status_code, content={"error": sink.error.message})
+        if not sink.finished.is_set():
+            # Cancelado en la cola: el render nunca llegó a empezar
+            return JSONResponse(status_code=job.error_status or 500, content={"error": job.error})
+        return JSONResponse(status_code=500, content={"error": "Video processing failed - output file is empty"})
+
+    def body():
+        try:
+            item = first
+            while item is not None:
+                yield item
+                if sink.client_gone.is_set():
+                    # Se descartaron trozos por un cliente lento: la respuesta ya no es válida
+                    print("DEBUG: Stream client fell behind, ending response")
+                    return
+                item = sink.next(job)
+            if sink.error is not None:
+                # Ya se enviaron cabeceras: solo se puede cortar la respuesta
+                print(f"DEBUG: Streaming render failed mid-stream: {sink.error.message}")
+        finally:
+            sink.client_gone.set()
+
+    headers = {
+        "Content-Disposition": f'inline; filename="{video_uuid}.mp4"',
+        "X-Video-UUID": video_uuid,
+        "X-Job-ID": job.id,
+        "X-Download-URL": f"{base_url}/download/{video_uuid}.mp4",
+    }
+    return StreamingResponse(body(), media_type="video/mp4", headers=headers)
+
+@app.post("/render/batch")
+def render_batch(
+    request: Request,
+    authorization: Optional[str] = Header(None),
+    payload: dict = Body(...),
+):
+    """Encolar un lote de variantes (JSON: {"defaults": {...}, "variants": [{...}, ...]})"""
+    check_auth(authorization)
+
+    defaults = payload.get("defaults") or {}
+    variants = payload.get("variants")
+    if not isinstance(defaults, dict) or not isinstance(variants, list) or not variants:
+        return JSONResponse(status_code=400, content={"error": "variants must be a non-empty list"})
+    if len(variants) > BATCH_MAX_VARIANTS:
+        return JSONResponse(status_code=400, content={"error": f"At most {BATCH_MAX_VARIANTS} variants per batch"})
+
+    all_params = []
+    for i, variant in enumerate(variants):
+        if not isinstance(variant, dict):
+            return JSONResponse(status_code=400, content={"error": f"variants[{i}] must be an object"})
+        params = _batch_variant_params(defaults, variant)
+        error = _render_params_error(params)
+        if not error and params["renditions"]:
+            error = "renditions are not supported in /render/batch"
+        if not error and params["chunked"] == "true":
+            error = "chunked=true is not supported in /render/batch"
+        if error:
+            return JSONResponse(status_code=400, content={"error": f"variants[{i}]: {error}"})
+        all_params.append(params)
+
+    base_url = _base_url(request)
+    try:
+        job = JOB_QUEUE.submit(lambda j: _run_render_batch(all_params, base_url, j), kind="batch")
+    except QueueFullError:
+        return _queue_full_response()
+
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status": job.status,
+        "variants": len(all_params),
+        "status_url": f"{base_url}/jobs/{job.id}",
+    })
+
+@app.post("/jobs")
+def submit_job(
+    request: Request,
+    authorization: Optional[str] = Header(None),
+    params: dict = Depends(_render_form),
+):
+    """Encolar un render y devolver inmediatamente el id del trabajo"""
+    check_auth(authorization)
+
+    invalid = _validate_render_params(params)
+    if invalid:
+        return invalid
+
+    base_url = _base_url(request)
+    try:
+        job = JOB_QUEUE.submit(lambda j: _run_render(params, base_url, j))
+    except QueueFullError:
+        return _queue_full_response()
+
+    return JSONResponse(status_code=202, content={
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"{base_url}/jobs/{job.id}",
+    })
+
+@app.get("/jobs/{job_id}")
+def get_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """Consultar estado y resultado de un trabajo de render"""
+    check_auth(authorization)
+
+    job = JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    data = job.to_dict()
+    data["queue"] = JOB_QUEUE.stats()
+    return data
+
+@app.get("/jobs/{job_id}/events")
+def job_events(job_id: str, authorization: Optional[str] = Header(None)):
+    """Server-Sent Events con el estado y progreso del trabajo hasta que termina"""
+    check_auth(authorization)
+
+    job = JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+
+    def events():
+        last = None
+        while True:
+            finished = job.done.is_set()
+            payload = json.dumps(job.to_dict())
+            if finished:
+                yield f"event: end\ndata: {payload}\n\n"
+                return
+            if payload != last:
+                yield f"event: progress\ndata: {payload}\n\n"
+                last = payload
+            job.done.wait(JOB_EVENTS_INTERVAL)
+
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return StreamingResponse(events(), media_type="text/event-stream", headers=headers)
+
+@app.post("/jobs/{job_id}/cancel")
+def cancel_job(job_id: str, authorization: Optional[str] = Header(None)):
+    """Cancelar un trabajo en cola o en ejecución (mata sus procesos ffmpeg)"""
+    check_auth(authorization)
+
+    job = JOB_QUEUE.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Trabajo no encontrado")
+    if not job.cancel():
+        return JSONResponse(status_code=409, content={"error": f"Job already {job.status}", "status": job.status})
+    return JSONResponse(status_code=202, content={"job_id": job.id, "status": "cancelling"})
+
+class _RenderStateCollector:
+    """Estado de cachés y cola leído en cada scrape de /metrics"""
+    def collect(self):
+        queue_stats = JOB_QUEUE.stats()
+        depth = GaugeMetricFamily("video_render_queue_jobs", "Trabajos de render por estado", labels=["state"])
+        depth.add_metric(["queued"], queue_stats["queued"])
+        depth.add_metric(["running"], queue_stats["running"])
+        yield depth
+        yield GaugeMetricFamily("video_render_workers", "Workers de render", value=queue_stats["workers"])
+
+        hits = CounterMetricFamily("video_render_cache_hits", "Aciertos por caché", labels=["cache"])
+        misses = CounterMetricFamily("video_render_cache_misses", "Fallos por caché", labels=["cache"])
+        size = GaugeMetricFamily("video_render_cache_bytes", "Bytes ocupados por caché en disco", labels=["cache"])
+        for name, cache in (("download", DOWNLOAD_CACHE), ("layer", LAYER_CACHE),
+                            ("audio", AUDIO_ASSET_CACHE), ("probe", PROBE_CACHE)):
+            if cache is None:
+                continue
+            cache_stats = cache.stats()
+            hits.add_metric([name], cache_stats["hits"])
+            misses.add_metric([name], cache_stats["misses"])
+            if "total_bytes" in cache_stats:
+                size.add_metric([name], cache_stats["total_bytes"])
+        yield hits
+        yield misses
+        yield size
+
+        drive_stats = DRIVE_CLIENT.stats()
+        drive = CounterMetricFamily("video_render_drive_client_events", "Eventos del cliente de Google Drive",
+                                    labels=["event"])
+        for event in ("builds", "token_refreshes", "http_clients", "requests", "retries"):
+            drive.add_metric([event], drive_stats[event])
+        yield drive
+        yield GaugeMetricFamily("video_render_drive_pooled_http_clients", "Conexiones HTTP de Drive libres en el pool",
+                                value=drive_stats["pooled_http_clients"])
+
+REGISTRY.register(_RenderStateCollector())
+
+@app.get("/metrics")
+def metrics():
+    """Métricas en formato Prometheus (sin autenticación, como /health)"""
+    return Response(generate_latest(REGISTRY), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,81 @@
+"""Benchmark de los modos de audio del render: two_pass frente a single_pass.
+
+Genera fuentes sintéticas con ffmpeg (testsrc + sine), construye los mismos
+comandos que usa /render y mide el tiempo total de cada modo (en two_pass se
+incluye el encode previo a trim_audio.aac).
+
+Uso:
+    python bench/audio_modes.py --duration 30 --runs 3 --target vertical
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DOWNLOAD_CACHE_MAX_MB", "0")
+
+from app.main import build_audio_trim_command, build_render_command, run  # noqa: E402
+
+
+def make_sources(tmp: str, duration: float, size: str):
+    video = os.path.join(tmp, "src_video.mp4")
+    audio = os.path.join(tmp, "src_audio.mp3")
+    run(
+        f'ffmpeg -y -f lavfi -i testsrc=size={size}:rate=30 -f lavfi -i sine=frequency=440:sample_rate=44100 '
+        f'-t {duration} -c:v libx264 -preset ultrafast -pix_fmt yuv420p -c:a aac "{video}"'
+    )
+    # Pista de música más larga que el video para poder recortar con offset
+    run(f'ffmpeg -y -f lavfi -i sine=frequency=220:sample_rate=44100 -t {duration * 2} -c:a libmp3lame "{audio}"')
+    return video, audio
+
+
+def render_once(tmp: str, video: str, audio: str, opts: dict, mode: str, duration: float, start: float) -> float:
+    out = os.path.join(tmp, f"out_{mode}.mp4")
+    t0 = time.perf_counter()
+    if mode == "single_pass":
+        run(build_render_command([video, audio], opts, out, single_pass=True, audio_start=start, duration=duration))
+    else:
+        taac = os.path.join(tmp, "trim_audio.aac")
+        run(build_audio_trim_command(audio, taac, start, duration))
+        run(build_render_command([video, taac], opts, out))
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=20.0)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--target", default="original")
+    parser.add_argument("--mix-audio", action="store_true")
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    opts = {
+        "overlay_text": "",
+        "position": "bottom",
+        "mix_audio": "true" if args.mix_audio else "false",
+        "target": args.target,
+        "crf": 18,
+        "dark_overlay": "false",
+        "dark_overlay_opacity": 0.4,
+        "saturation_boost": 1.06,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video, audio = make_sources(tmp, args.duration, args.size)
+        results = {}
+        for mode in ("two_pass", "single_pass"):
+            times = [render_once(tmp, video, audio, opts, mode, args.duration, 1.5) for _ in range(args.runs)]
+            results[mode] = statistics.median(times)
+            print(f"{mode:12s} median {results[mode]:.3f}s  runs={[round(t, 3) for t in times]}")
+
+    speedup = results["two_pass"] / results["single_pass"]
+    print(f"single_pass speedup: {speedup:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
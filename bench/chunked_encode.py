@@ -0,0 +1,104 @@
+"""Benchmark del encode por segmentos en paralelo frente al encode en un solo proceso.
+
+Genera fuentes sintéticas con ffmpeg (testsrc + sine), recorta el audio como en el
+modo two_pass y mide el encode del video completo con un único ffmpeg y con
+run_chunked_encode (segmentos en paralelo + concat demuxer + mux del audio).
+
+Uso:
+    python bench/chunked_encode.py --duration 240 --workers 2 4 --chunk-seconds 30 --target vertical
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("DOWNLOAD_CACHE_MAX_MB", "0")
+os.environ.setdefault("LAYER_CACHE_MAX_MB", "0")
+
+from app.main import (  # noqa: E402
+    _available_cpus, build_audio_trim_command, build_render_command, chunk_bounds, run, run_chunked_encode,
+)
+
+
+def make_sources(tmp: str, duration: float, size: str):
+    video = os.path.join(tmp, "src_video.mp4")
+    audio = os.path.join(tmp, "src_audio.mp3")
+    run(
+        f'ffmpeg -y -f lavfi -i testsrc=size={size}:rate=30 -f lavfi -i sine=frequency=440:sample_rate=44100 '
+        f'-t {duration} -c:v libx264 -preset ultrafast -pix_fmt yuv420p -c:a aac "{video}"'
+    )
+    run(f'ffmpeg -y -f lavfi -i sine=frequency=220:sample_rate=44100 -t {duration} -c:a libmp3lame "{audio}"')
+    taac = os.path.join(tmp, "trim_audio.aac")
+    run(build_audio_trim_command(audio, taac, 0.0, duration))
+    return video, taac
+
+
+def encode_single(tmp: str, video: str, taac: str, opts: dict) -> float:
+    out = os.path.join(tmp, "out_single.mp4")
+    t0 = time.perf_counter()
+    run(build_render_command([video, taac], opts, out))
+    return time.perf_counter() - t0
+
+
+def encode_chunked(tmp: str, video: str, taac: str, opts: dict, duration: float,
+                   chunk_seconds: float, workers: int) -> float:
+    work_dir = tempfile.mkdtemp(dir=tmp)
+    plan = {
+        "inputs": [video, taac],
+        "image_input": None,
+        "layer_input": None,
+        "single_pass": False,
+        "audio_start": 0.0,
+        "duration": duration,
+    }
+    t0 = time.perf_counter()
+    run_chunked_encode(plan, opts, os.path.join(work_dir, "out_chunked.mp4"), work_dir,
+                       chunk_seconds=chunk_seconds, workers=workers)
+    return time.perf_counter() - t0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=240.0)
+    parser.add_argument("--size", default="1280x720")
+    parser.add_argument("--target", default="vertical")
+    parser.add_argument("--profile", default="social")
+    parser.add_argument("--chunk-seconds", type=float, default=30.0)
+    parser.add_argument("--workers", type=int, nargs="+", default=[_available_cpus()])
+    parser.add_argument("--runs", type=int, default=1)
+    args = parser.parse_args()
+
+    opts = {
+        "overlay_text": "Benchmark",
+        "position": "bottom",
+        "mix_audio": "false",
+        "target": args.target,
+        "crf": 18,
+        "dark_overlay": "false",
+        "dark_overlay_opacity": 0.4,
+        "saturation_boost": 1.06,
+        "encoder_profile": args.profile,
+    }
+    segments = len(chunk_bounds(args.duration, opts, args.chunk_seconds))
+    print(f"CPUs disponibles: {_available_cpus()}  segmentos: {segments}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        video, taac = make_sources(tmp, args.duration, args.size)
+        times = [encode_single(tmp, video, taac, opts) for _ in range(args.runs)]
+        single = statistics.median(times)
+        print(f"{'single':12s} median {single:.3f}s  runs={[round(t, 3) for t in times]}")
+        for workers in args.workers:
+            times = [
+                encode_chunked(tmp, video, taac, opts, args.duration, args.chunk_seconds, workers)
+                for _ in range(args.runs)
+            ]
+            chunked = statistics.median(times)
+            print(f"{f'chunked x{workers}':12s} median {chunked:.3f}s  runs={[round(t, 3) for t in times]}  "
+                  f"speedup {single / chunked:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+"""Benchmark del pipeline completo de render (_run_render) sobre fuentes sintéticas.
+
+Genera con ffmpeg (testsrc + sine) un video por cada duración y resolución, una pista
+de música y una carátula, y ejecuta _run_render con un fetcher de Drive simulado que
+copia esos ficheros. Cada caso de la matriz de opciones (carátula, texto, capa oscura,
+mix_audio, target, crf) corre en un proceso nuevo con caché y directorio de salida
+propios, así que las medidas son en frío y el pico de RSS es el de ese caso.
+
+El informe JSON recoge por caso la mediana de los timings por etapa, los fps del
+encode, el pico de RSS (ffmpeg y proceso Python) y el tamaño de la salida. Con
+--baseline compara contra un informe anterior y termina con código 1 si algún caso
+empeora más allá de la tolerancia; la matriz de casos se toma de la configuración de
+la baseline salvo las opciones que se pasen explícitamente. bench/baseline.json es la
+baseline del repositorio; su bloque "host" indica la máquina y el ffmpeg con que se
+generó, y solo es comparable en un host equivalente.
+
+Uso:
+    python bench/render_pipeline.py --durations 10 30 --sizes 1280x720 --matrix oat --out report.json
+    python bench/render_pipeline.py --baseline bench/baseline.json --tolerance 0.15
+    python bench/render_pipeline.py --save-baseline bench/baseline.json
+"""
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_FONT = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
+
+# Ejes de la matriz; el primer valor de cada eje es el del caso base
+AXES = ("image", "text", "dark_overlay", "mix_audio", "target", "crf")
+
+# Sin credenciales: _source_version no consulta Drive por los ids sintéticos
+DRIVE_ENV = ("GOOGLE_APPLICATION_CREDENTIALS", "GDRIVE_SERVICE_ACCOUNT_JSON")
+
+# Opciones que definen los casos; con --baseline se heredan de su configuración
+MATRIX_OPTIONS = ("durations", "sizes", "targets", "crfs", "profile", "matrix", "runs")
+
+# Métricas comparadas con la baseline: (clave, True si más alto es peor)
+COMPARED = (
+    ("total_seconds", True),
+    ("encode_seconds", True),
+    ("encode_fps", False),
+    ("peak_rss_mb", True),
+    ("output_bytes", True),
+)
+
+
+def fixture_name(size: str, duration: float) -> str:
+    # Solo caracteres válidos en un file id de Drive
+    return f"video_{size}_{duration:g}s".replace(".", "_")
+
+
+def make_fixtures(fixtures_dir: str, durations: list, sizes: list) -> dict:
+    """Videos testsrc con audio sine por (resolución, duración), música y carátula"""
+    from app.main import run
+
+    fixtures = {}
+    for size, duration in itertools.product(sizes, durations):
+        name = fixture_name(size, duration)
+        path = os.path.join(fixtures_dir, f"{name}.mp4")
+        run(
+            f'ffmpeg -y -f lavfi -i testsrc=size={size}:rate=30 -f lavfi -i sine=frequency=440:sample_rate=44100 '
+            f'-t {duration} -c:v libx264 -preset ultrafast -pix_fmt yuv420p -c:a aac -movflags +faststart "{path}"'
+        )
+        fixtures[name] = path
+    # Pista de música más larga que el video más largo para el recorte con offset
+    audio = os.path.join(fixtures_dir, "audio.mp3")
+    run(f'ffmpeg -y -f lavfi -i sine=frequency=220:sample_rate=44100 -t {max(durations) * 2} -c:a libmp3lame "{audio}"')
+    fixtures["audio"] = audio
+    image = os.path.join(fixtures_dir, "image.jpg")
+    run(f'ffmpeg -y -f lavfi -i testsrc=size=800x800 -frames:v 1 "{image}"')
+    fixtures["image"] = image
+    return fixtures
+
+
+def build_cases(args) -> list:
+    """Combinaciones de opciones: una a una sobre el caso base (oat) o producto completo (full)"""
+    axes = {
+        "image": [False, True],
+        "text": [False, True],
+        "dark_overlay": [False, True],
+        "mix_audio": [False, True],
+        "target": args.targets,
+        "crf": args.crfs,
+    }
+    base = {axis: values[0] for axis, values in axes.items()}
+    if args.matrix == "full":
+        combos = [dict(zip(AXES, values)) for values in itertools.product(*(axes[a] for a in AXES))]
+    else:
+        combos = [base]
+        for axis in AXES:
+            combos += [dict(base, **{axis: value}) for value in axes[axis][1:]]
+    cases = []
+    for size, duration in itertools.product(args.sizes, args.durations):
+        for options in combos:
+            cases.append({"fixture": fixture_name(size, duration), "options": options})
+    return cases
+
+
+def case_key(case: dict) -> str:
+    o = case["options"]
+    flags = [name for name in ("image", "text", "dark_overlay", "mix_audio") if o[name]]
+    return f"{case['fixture']}/{'+'.join(flags) or 'plain'}/{o['target']}/crf{o['crf']}"
+
+
+def drive_url(name: str) -> str:
+    return f"https://drive.google.com/file/d/{name}/view"
+
+
+def case_params(case: dict, profile: str) -> dict:
+    o = case["options"]
+    return {
+        "video_url": drive_url(case["fixture"]),
+        "audio_url": drive_url("audio"),
+        "overlay_image_url": drive_url("image") if o["image"] else "",
+        "overlay_text": "Benchmark" if o["text"] else "",
+        "dark_overlay": "true" if o["dark_overlay"] else "false",
+        "mix_audio": "true" if o["mix_audio"] else "false",
+        "target": o["target"],
+        "crf": o["crf"],
+        "random_audio_start": "true",
+        "seed": "bench",
+        "force_render": "true",
+        "encoder_profile": profile,
+    }
+
+
+def worker(spec_path: str):
+    """Un render en este proceso (cwd = directorio de trabajo del caso); escribe el resultado en JSON"""
+    with open(spec_path) as f:
+        spec = json.load(f)
+    os.chdir(spec["work_dir"])
+    sys.path.insert(0, ROOT)
+    import app.main as m
+
+    m.FONT_PATH = spec["font"]
+    fixtures = spec["fixtures"]
+
+    def _fetch(url: str, out_path: str, progress=None) -> dict:
+        # Sustituto de la descarga de Drive: copia la fuente sintética
+        file_id = m._drive_file_id(url)
+        shutil.copyfile(fixtures[file_id], out_path)
+        return {"file_id": file_id, "version": None, "cache_hit": False,
+                "size_bytes": os.path.getsize(out_path), "origin": "drive"}
+
+    m._download_with_drive_confirm = _fetch
+    params = m._batch_variant_params({}, spec["params"])
+    error = m._render_params_error(params)
+    if error:
+        raise SystemExit(f"invalid params: {error}")
+    # El pipeline escribe su log DEBUG en stdout; solo interesa el resultado
+    with open(os.path.join(spec["work_dir"], "render.log"), "w") as log, contextlib.redirect_stdout(log):
+        t0 = time.perf_counter()
+        result = m._run_render(params, "http://bench")
+        wall = time.perf_counter() - t0
+    out_path = os.path.join(m.VIDEOS_DIR, f"{result['video_uuid']}.mp4")
+    report = {
+        "wall_seconds": round(wall, 3),
+        "timings": {k: v for k, v in result["timings"].items() if isinstance(v, (int, float))},
+        "encode_fps": result["encode"]["encode_fps"],
+        "output_bytes": os.path.getsize(out_path),
+        "video_path": result["video_path"],
+        # ru_maxrss en KB (Linux): el de los hijos es el ffmpeg/ffprobe más grande del caso, con
+        # el RSS heredado en el fork como mínimo (nunca baja de python_rss_mb)
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        "python_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    with open(spec["result_path"], "w") as f:
+        json.dump(report, f)
+
+
+def run_case(case: dict, args, fixtures: dict, tmp: str) -> dict:
+    """Mediana de args.runs ejecuciones del caso, cada una en un proceso nuevo"""
+    runs = []
+    for n in range(args.runs):
+        work_dir = tempfile.mkdtemp(dir=tmp)
+        spec = {
+            "work_dir": work_dir,
+            "font": args.font,
+            "fixtures": fixtures,
+            "params": case_params(case, args.profile),
+            "result_path": os.path.join(work_dir, "result.json"),
+        }
+        spec_path = os.path.join(work_dir, "spec.json")
+        with open(spec_path, "w") as f:
+            json.dump(spec, f)
+        env = {k: v for k, v in os.environ.items() if k not in DRIVE_ENV}
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", spec_path],
+                              capture_output=True, text=True, env=env)
+        if proc.returncode != 0:
+            log_path = os.path.join(work_dir, "render.log")
+            log = open(log_path).read()[-2000:] if os.path.exists(log_path) else ""
+            raise RuntimeError(f"{case_key(case)} failed:\n{proc.stderr[-2000:]}\n{log}")
+        with open(spec["result_path"]) as f:
+            runs.append(json.load(f))
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stages = sorted({k for r in runs for k in r["timings"]})
+    timings = {k: round(statistics.median(r["timings"][k] for r in runs if k in r["timings"]), 3) for k in stages}
+    fps = [r["encode_fps"] for r in runs if r["encode_fps"]]
+    return {
+        "key": case_key(case),
+        "fixture": case["fixture"],
+        "options": case["options"],
+        "runs": len(runs),
+        "video_path": runs[0]["video_path"],
+        "timings": timings,
+        "total_seconds": timings.get("total"),
+        "encode_seconds": timings.get("encode"),
+        "encode_fps": round(statistics.median(fps), 1) if fps else None,
+        "peak_rss_mb": max(r["peak_rss_mb"] for r in runs),
+        "python_rss_mb": max(r["python_rss_mb"] for r in runs),
+        "output_bytes": int(statistics.median(r["output_bytes"] for r in runs)),
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> dict:
+    """Diferencias relativas contra la baseline por caso y métrica; regresiones fuera de la tolerancia"""
+    previous = {case["key"]: case for case in baseline.get("cases", [])}
+    changes, regressions, missing = [], [], []
+    for case in report["cases"]:
+        old = previous.get(case["key"])
+        if old is None:
+            missing.append(case["key"])
+            continue
+        for metric, higher_is_worse in COMPARED:
+            new_value, old_value = case.get(metric), old.get(metric)
+            if not new_value or not old_value:
+                continue
+            delta = (new_value - old_value) / old_value
+            change = {"key": case["key"], "metric": metric, "baseline": old_value,
+                      "current": new_value, "delta": round(delta, 3)}
+            changes.append(change)
+            if (delta if higher_is_worse else -delta) > tolerance:
+                regressions.append(change)
+    return {"tolerance": tolerance, "changes": changes, "regressions": regressions, "not_in_baseline": missing}
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor()
+
+
+def ffmpeg_version() -> str:
+    try:
+        out = subprocess.run(["ffmpeg", "-version"], capture_output=True, text=True).stdout
+        return out.splitlines()[0] if out else ""
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--durations", type=float, nargs="+", default=[10.0, 30.0])
+    parser.add_argument("--sizes", nargs="+", default=["1280x720", "1920x1080"])
+    parser.add_argument("--targets", nargs="+", default=["vertical", "original"])
+    parser.add_argument("--crfs", type=int, nargs="+", default=[23, 18])
+    parser.add_argument("--profile", default="social")
+    parser.add_argument("--matrix", choices=("oat", "full"), default="oat",
+                        help="oat: cada opción por separado sobre el caso base; full: producto completo")
+    parser.add_argument("--runs", type=int, default=1)
+    parser.add_argument("--font", default=DEFAULT_FONT)
+    parser.add_argument("--out", default="render_bench.json", help="Ruta del informe JSON")
+    parser.add_argument("--baseline", help="Informe anterior con el que comparar")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Empeoramiento relativo admitido (0.10 = 10%%)")
+    parser.add_argument("--save-baseline", help="Guardar además el informe como baseline en esta ruta")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    known, _ = parser.parse_known_args()
+    baseline = None
+    if known.baseline:
+        # Misma matriz que la baseline salvo lo que se indique en la línea de órdenes
+        with open(known.baseline) as f:
+            baseline = json.load(f)
+        parser.set_defaults(**{k: v for k, v in baseline.get("config", {}).items() if k in MATRIX_OPTIONS})
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker)
+        return
+
+    for name in ("out", "baseline", "save_baseline"):
+        if getattr(args, name):
+            setattr(args, name, os.path.abspath(getattr(args, name)))
+    cwd = os.getcwd()
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        # app.main crea sus directorios de caché y salida en el cwd al importarse
+        os.chdir(tmp)
+        sys.path.insert(0, ROOT)
+        from app.main import _available_cpus
+
+        cases = build_cases(args)
+        print(f"CPUs disponibles: {_available_cpus()}  casos: {len(cases)}  runs por caso: {args.runs}")
+        fixtures_dir = os.path.join(tmp, "fixtures")
+        os.makedirs(fixtures_dir)
+        t0 = time.perf_counter()
+        fixtures = make_fixtures(fixtures_dir, args.durations, args.sizes)
+        print(f"Fuentes sintéticas generadas en {time.perf_counter() - t0:.1f}s")
+        for case in cases:
+            result = run_case(case, args, fixtures, tmp)
+            results.append(result)
+            print(f"{result['key']:60s} total {result['total_seconds']:.3f}s  encode {result['encode_seconds']:.3f}s  "
+                  f"fps {result['encode_fps']}  rss {result['peak_rss_mb']}MB  size {result['output_bytes']}")
+        os.chdir(cwd)
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "host": {
+            "cpus": _available_cpus(),
+            "machine": platform.machine(),
+            "cpu_model": cpu_model(),
+            "system": platform.platform(),
+            "python": platform.python_version(),
+            "ffmpeg": ffmpeg_version(),
+        },
+        "config": {k: v for k, v in vars(args).items() if k not in ("worker", "out", "baseline", "save_baseline")},
+        "cases": results,
+    }
+    exit_code = 0
+    if args.baseline:
+        for field in ("cpus", "cpu_model", "ffmpeg"):
+            if baseline.get("host", {}).get(field) != report["host"][field]:
+                print(f"AVISO: la baseline es de otro host ({field}: {baseline.get('host', {}).get(field)!r} "
+                      f"frente a {report['host'][field]!r}); las diferencias no son solo del código")
+        report["comparison"] = compare(report, baseline, args.tolerance)
+        regressions = report["comparison"]["regressions"]
+        for change in regressions:
+            print(f"REGRESIÓN {change['key']} {change['metric']}: {change['baseline']} -> {change['current']} "
+                  f"({change['delta']:+.1%})")
+        for key in report["comparison"]["not_in_baseline"]:
+            print(f"Sin baseline: {key}")
+        print(f"{len(regressions)} regresiones sobre {args.baseline} (tolerancia {args.tolerance:.0%})")
+        exit_code = 1 if regressions else 0
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Informe: {args.out}")
+    if args.save_baseline:
+        shutil.copyfile(args.out, args.save_baseline)
+        print(f"Baseline guardada en {args.save_baseline}")
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,10 @@
+import os
+import sys
+import tempfile
+
+# app.main crea sus directorios (videos, caché, catálogo) al importarse: aislarlos en un temporal
+_WORKDIR = tempfile.mkdtemp(prefix="video-render-tests-")
+os.chdir(_WORKDIR)
+os.environ.setdefault("CACHE_DIR", os.path.join(_WORKDIR, "cache"))
+os.environ.setdefault("API_KEY", "test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+from app import main
+
+
+@pytest.fixture
+def asset_env(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "AUDIO_ASSET_CACHE", main.DownloadCache(str(tmp_path / "audio"), 1024 * 1024, label="audio"))
+    monkeypatch.setattr(main, "_audio_asset_key", lambda url: "track")
+    monkeypatch.setattr(main, "download_source", lambda url, out_path, progress=None: open(out_path, "wb").write(b"mp3") and {})
+    monkeypatch.setattr(main, "_parse_loudnorm", lambda text: {"integrated_lufs": -14.0, "true_peak_db": -1.5})
+    monkeypatch.setattr(main, "probe_media", lambda path, cache_key=None: {"duration": 3.0})
+    slots = threading.BoundedSemaphore(1)
+    monkeypatch.setattr(main, "ENCODE_SLOTS", slots)
+    return tmp_path, slots
+
+
+def test_asset_encode_runs_inside_an_encode_slot(asset_env, monkeypatch):
+    tmp_path, slots = asset_env
+    held = []
+
+    def fake_run(cmd, job=None, duration=0.0, stdin_source=None, return_stderr=False):
+        # Con un solo hueco, tomarlo aquí falla si el encode ya lo tiene
+        held.append(not slots.acquire(blocking=False))
+        if not held[-1]:
+            slots.release()
+        for arg in cmd.split():
+            if arg.strip("'\"").endswith(".part"):
+                open(arg.strip("'\""), "wb").write(b"m4a")
+        return ""
+
+    monkeypatch.setattr(main, "run", fake_run)
+    stats = main.prepare_audio_asset("file:///a.mp3", str(tmp_path / "raw.mp3"), str(tmp_path / "a.m4a"))
+    assert stats["integrated_lufs"] == -14.0
+    assert held and all(held)
+
+
+def test_cancel_while_waiting_for_a_slot_aborts_the_asset(asset_env, monkeypatch):
+    tmp_path, slots = asset_env
+    monkeypatch.setattr(main, "run", lambda *a, **k: pytest.fail("ffmpeg must not start"))
+    job = main.RenderJob(lambda j: None)
+    job.status = "running"
+    slots.acquire()
+    errors = []
+
+    def prepare():
+        try:
+            main.prepare_audio_asset("file:///a.mp3", str(tmp_path / "raw.mp3"), str(tmp_path / "a.m4a"), job)
+        except Exception as e:
+            errors.append(e)
+
+    t = threading.Thread(target=prepare)
+    t.start()
+    job.cancel()
+    t.join(5)
+    slots.release()
+    assert not t.is_alive()
+    # El abort no queda como error de la entrada: otro render puede retomarla
+    assert isinstance(errors[0], main.DownloadAborted)
@@ -0,0 +1,93 @@
+import base64
+
+import pytest
+
+from app import main
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    return main.VideoCatalog(str(tmp_path / "catalog.db"))
+
+
+def _add(catalog, uuid, created_at):
+    catalog.add(uuid, f"{uuid}.mp4", 10, created_at)
+
+
+def _pages(catalog, limit, **kwargs):
+    pages, cursor = [], None
+    while True:
+        entries, cursor = catalog.list(limit, cursor, **kwargs)
+        pages.append([e["uuid"] for e in entries])
+        if not cursor:
+            return pages
+
+
+def test_empty_catalog(catalog):
+    assert catalog.list(10) == ([], None)
+
+
+def test_no_cursor_when_page_is_exactly_full(catalog):
+    for i in range(3):
+        _add(catalog, f"v{i}", 100.0 + i)
+    entries, cursor = catalog.list(3)
+    assert [e["uuid"] for e in entries] == ["v2", "v1", "v0"]
+    assert cursor is None
+
+
+def test_pages_cover_every_video_once(catalog):
+    for i in range(7):
+        _add(catalog, f"v{i}", 100.0 + i)
+    assert _pages(catalog, 3) == [["v6", "v5", "v4"], ["v3", "v2", "v1"], ["v0"]]
+
+
+def test_same_created_at_across_page_boundary(catalog):
+    # Mismo instante: el uuid desempata y ningún video se repite ni se salta
+    for uuid in ("a", "b", "c", "d"):
+        _add(catalog, uuid, 100.0)
+    _add(catalog, "z", 50.0)
+    assert _pages(catalog, 2) == [["d", "c"], ["b", "a"], ["z"]]
+
+
+def test_fractional_timestamps_round_trip(catalog):
+    # El cursor guarda repr(created_at): sin pérdida de precisión no se repite el mismo video
+    _add(catalog, "a", 1700000000.7654321)
+    _add(catalog, "b", 1700000000.765432)
+    _add(catalog, "c", 1700000000.1)
+    assert _pages(catalog, 1) == [["a"], ["b"], ["c"]]
+
+
+def test_cursor_with_date_range(catalog):
+    for i in range(6):
+        _add(catalog, f"v{i}", 100.0 + i)
+    assert _pages(catalog, 2, since=101.0, until=105.0) == [["v4", "v3"], ["v2", "v1"]]
+    assert catalog.count(since=101.0, until=105.0) == 4
+
+
+def test_video_added_after_first_page_is_not_returned_later(catalog):
+    for i in range(4):
+        _add(catalog, f"v{i}", 100.0 + i)
+    first, cursor = catalog.list(2)
+    _add(catalog, "new", 200.0)
+    rest, cursor = catalog.list(2, cursor)
+    assert [e["uuid"] for e in first + rest] == ["v3", "v2", "v1", "v0"]
+    assert cursor is None
+
+
+@pytest.mark.parametrize("cursor", [
+    "not base64!",
+    base64.urlsafe_b64encode(b"no separator").decode(),
+    base64.urlsafe_b64encode(b"abc|v1").decode(),
+    base64.urlsafe_b64encode(b"\xff\xfe|v1").decode(),
+])
+def test_invalid_cursor(catalog, cursor):
+    _add(catalog, "v1", 100.0)
+    with pytest.raises(ValueError):
+        catalog.list(10, cursor)
+
+
+def test_invalid_cursor_is_a_bad_request():
+    from fastapi.testclient import TestClient
+    r = TestClient(main.app).get("/videos", params={"cursor": "abc|"},
+                                 headers={"Authorization": f"Bearer {main.API_KEY}"})
+    assert r.status_code == 400
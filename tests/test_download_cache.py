@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+from app import main
+
+
+def test_cancelled_leader_hands_over_to_waiter(tmp_path):
+    cache = main.DownloadCache(str(tmp_path / "cache"), 10 * 1024 * 1024)
+    leader_started = threading.Event()
+    job = main.RenderJob(lambda j: None)
+    source = main._GrowingSource()
+    job.attach_download(source)
+
+    def aborted_download(tmp):
+        # Descarga del trabajo A: escribe trozos hasta que A se cancela
+        with open(tmp, "wb") as fh:
+            writer = main._ProgressWriter(fh, source)
+            writer.write(b"partial")
+            leader_started.set()
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline:
+                writer.write(b".")
+                time.sleep(0.01)
+
+    def full_download(tmp):
+        with open(tmp, "wb") as f:
+            f.write(b"complete")
+
+    errors = {}
+
+    def leader():
+        try:
+            cache.fetch("video", str(tmp_path / "a.mp4"), aborted_download)
+        except Exception as e:
+            errors["leader"] = e
+
+    results = {}
+
+    def waiter():
+        results["hit"] = cache.fetch("video", str(tmp_path / "b.mp4"), full_download)
+
+    t_leader = threading.Thread(target=leader)
+    t_leader.start()
+    assert leader_started.wait(5)
+    t_waiter = threading.Thread(target=waiter)
+    t_waiter.start()
+    while cache.coalesced == 0:
+        t_waiter.join(0.01)
+    job.cancel()
+    t_leader.join(5)
+    t_waiter.join(5)
+
+    assert isinstance(errors["leader"], main.DownloadAborted)
+    # El que esperaba retoma la descarga en lugar de heredar el abort
+    assert results["hit"] is False
+    assert (tmp_path / "b.mp4").read_bytes() == b"complete"
+    assert cache.misses == 2
+
+
+def test_failed_leader_error_reaches_waiter(tmp_path):
+    cache = main.DownloadCache(str(tmp_path / "cache"), 10 * 1024 * 1024)
+    leader_started = threading.Event()
+    release = threading.Event()
+
+    def failing_download(tmp):
+        leader_started.set()
+        release.wait(5)
+        raise RuntimeError("HTTP 404")
+
+    t_leader = threading.Thread(target=lambda: pytest.raises(RuntimeError, cache.fetch, "k", str(tmp_path / "a"), failing_download))
+    t_leader.start()
+    assert leader_started.wait(5)
+    errors = {}
+
+    def waiter():
+        try:
+            cache.fetch("k", str(tmp_path / "b"), failing_download)
+        except RuntimeError as e:
+            errors["waiter"] = str(e)
+
+    t_waiter = threading.Thread(target=waiter)
+    t_waiter.start()
+    while cache.coalesced == 0:
+        t_waiter.join(0.01)
+    release.set()
+    t_leader.join(5)
+    t_waiter.join(5)
+    assert errors["waiter"] == "HTTP 404"
+    assert cache.misses == 1
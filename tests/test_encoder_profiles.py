@@ -0,0 +1,51 @@
+import pytest
+
+from app import main
+
+
+def _opts(profile):
+    return {"encoder_profile": profile, "crf": 23}
+
+
+@pytest.mark.parametrize("name", sorted(main.ENCODER_PROFILES))
+def test_every_profile_declares_threads(name):
+    assert isinstance(main.ENCODER_PROFILES[name]["threads"], int)
+
+
+def test_threads_come_from_the_profile(monkeypatch):
+    monkeypatch.setattr(main, "ENCODER_THREADS", 0)
+    assert "-threads 2" in main.build_video_codec_args(_opts("draft"))
+    assert "-threads" not in main.build_video_codec_args(_opts("social"))
+
+
+def test_env_overrides_profile_threads(monkeypatch):
+    monkeypatch.setattr(main, "ENCODER_THREADS", 6)
+    assert "-threads 6" in main.build_video_codec_args(_opts("draft"))
+    assert "-threads 6" in main.build_video_codec_args(_opts("archive"))
+
+
+def test_explicit_threads_win(monkeypatch):
+    monkeypatch.setattr(main, "ENCODER_THREADS", 6)
+    assert "-threads 3" in main.build_video_codec_args(_opts("draft"), threads=3)
+
+
+@pytest.fixture
+def client():
+    from fastapi.testclient import TestClient
+    return TestClient(main.app)
+
+
+def test_stream_rejects_chunked_true(client):
+    r = client.post("/render/stream", headers={"Authorization": f"Bearer {main.API_KEY}"},
+                    data={"video_url": "https://cdn.example.com/v.mp4", "audio_url": "https://cdn.example.com/a.mp3",
+                          "chunked": "true"})
+    assert r.status_code == 400
+    assert "chunked" in r.json()["error"]
+
+
+def test_batch_rejects_chunked_true(client):
+    r = client.post("/render/batch", headers={"Authorization": f"Bearer {main.API_KEY}"},
+                    json={"defaults": {"audio_url": "https://cdn.example.com/a.mp3"},
+                          "variants": [{"video_url": "https://cdn.example.com/v.mp4", "chunked": "true"}]})
+    assert r.status_code == 400
+    assert "chunked" in r.json()["error"]
@@ -0,0 +1,81 @@
+import socket
+
+import pytest
+import requests
+
+from app import main
+
+
+@pytest.mark.parametrize("url", [
+    "http://127.0.0.1/video.mp4",
+    "http://169.254.169.254/latest/meta-data/",
+    "http://10.0.0.5/video.mp4",
+    "http://192.168.1.10/video.mp4",
+    "http://[::1]/video.mp4",
+    "http://[::ffff:127.0.0.1]/video.mp4",
+    "http:///video.mp4",
+])
+def test_internal_addresses_rejected_by_default(monkeypatch, url):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", [])
+    assert not main._http_host_allowed(url)
+
+
+def test_public_address_allowed_by_default(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", [])
+    assert main._http_host_allowed("https://93.184.216.34/video.mp4")
+
+
+def test_hostname_resolving_to_private_address_rejected(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", [])
+    monkeypatch.setattr(socket, "getaddrinfo", lambda host, port: [
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("93.184.216.34", 0)),
+        (socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.1.2.3", 0)),
+    ])
+    assert not main._http_host_allowed("https://media.example.com/video.mp4")
+
+
+def test_allowlist_admits_listed_internal_host_only(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", ["minio.internal"])
+    assert main._http_host_allowed("http://minio.internal:9000/bucket/video.mp4")
+    assert not main._http_host_allowed("https://93.184.216.34/video.mp4")
+
+
+class _FakeResponse:
+    def __init__(self, status, location=None):
+        self.status_code = status
+        self.headers = {"Location": location} if location else {}
+        self.is_redirect = location is not None
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_redirect_to_internal_host_is_not_followed(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", ["cdn.example.com"])
+    fetcher = main.HTTPFetcher(1, 5, 0)
+    requested = []
+
+    def fake_request(method, url, **kwargs):
+        requested.append(url)
+        return _FakeResponse(302, "http://169.254.169.254/latest/meta-data/")
+
+    monkeypatch.setattr(fetcher.session, "request", fake_request)
+    with pytest.raises(requests.exceptions.InvalidURL):
+        fetcher._open("GET", "https://cdn.example.com/video.mp4")
+    assert requested == ["https://cdn.example.com/video.mp4"]
+
+
+def test_relative_redirect_on_allowed_host_is_followed(monkeypatch):
+    monkeypatch.setattr(main, "HTTP_SOURCE_HOSTS", ["cdn.example.com"])
+    fetcher = main.HTTPFetcher(1, 5, 0)
+    responses = [_FakeResponse(301, "/v2/video.mp4"), _FakeResponse(200)]
+    requested = []
+
+    def fake_request(method, url, **kwargs):
+        requested.append(url)
+        return responses.pop(0)
+
+    monkeypatch.setattr(fetcher.session, "request", fake_request)
+    assert fetcher._open("HEAD", "https://cdn.example.com/video.mp4").status_code == 200
+    assert requested == ["https://cdn.example.com/video.mp4", "https://cdn.example.com/v2/video.mp4"]
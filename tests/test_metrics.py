@@ -0,0 +1,33 @@
+from fastapi.testclient import TestClient
+
+from app import main
+
+
+def _stage_count(stage):
+    for metric in main.RENDER_STAGE_SECONDS.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_count") and sample.labels.get("stage") == stage:
+                return sample.value
+    return 0
+
+
+def test_indexed_stage_keys_are_observed_in_base_stage():
+    before = _stage_count("image_preprocess")
+    main._observe_timings({"image_preprocess_0": 0.2, "image_preprocess_1": 0.3, "download_image_0": 1.0,
+                           "encode": 2.0})
+    assert _stage_count("image_preprocess") == before + 2
+
+
+def test_unknown_keys_are_ignored():
+    before = _stage_count("download")
+    main._observe_timings({"download_video": 1.0, "video_header_wait": 0.1})
+    assert _stage_count("download") == before
+
+
+def test_drive_client_counters_exported(monkeypatch):
+    monkeypatch.setattr(main.DRIVE_CLIENT, "builds", 3)
+    monkeypatch.setattr(main.DRIVE_CLIENT, "refreshes", 2)
+    text = TestClient(main.app).get("/metrics").text
+    assert 'video_render_drive_client_events_total{event="builds"} 3.0' in text
+    assert 'video_render_drive_client_events_total{event="token_refreshes"} 2.0' in text
+    assert "video_render_drive_pooled_http_clients" in text
@@ -0,0 +1,52 @@
+import struct
+
+from app import main
+
+
+def _atom(kind: bytes, payload: bytes = b"") -> bytes:
+    return struct.pack(">I4s", 8 + len(payload), kind) + payload
+
+
+FTYP = _atom(b"ftyp", b"isom\x00\x00\x02\x00isomiso2")
+
+
+def test_moov_before_mdat():
+    moov = _atom(b"moov", b"\x00" * 32)
+    head = FTYP + moov + _atom(b"mdat", b"\x00" * 16)
+    assert main._mp4_moov_end(head) == len(FTYP) + len(moov)
+
+
+def test_moov_end_known_before_its_bytes_arrive():
+    moov = _atom(b"moov", b"\x00" * 32)
+    assert main._mp4_moov_end(FTYP + moov[:8]) == len(FTYP) + len(moov)
+
+
+def test_mdat_before_moov():
+    assert main._mp4_moov_end(FTYP + _atom(b"free") + _atom(b"mdat", b"\x00" * 16)) == -1
+
+
+def test_not_mp4():
+    assert main._mp4_moov_end(b"ID3\x04\x00\x00\x00\x00\x00\x00") == -1
+    assert main._mp4_moov_end(_atom(b"moov", b"\x00" * 8)) == -1
+
+
+def test_missing_moov_needs_more_bytes():
+    assert main._mp4_moov_end(b"") is None
+    assert main._mp4_moov_end(FTYP[:6]) is None
+    assert main._mp4_moov_end(FTYP) is None
+    assert main._mp4_moov_end(FTYP + _atom(b"free", b"\x00" * 8)) is None
+
+
+def test_truncated_large_size_atom():
+    large = struct.pack(">I4s", 1, b"free") + b"\x00\x00"
+    assert main._mp4_moov_end(FTYP + large) is None
+
+
+def test_large_size_atom_is_skipped():
+    large = struct.pack(">I4sQ", 1, b"free", 24) + b"\x00" * 8
+    moov = _atom(b"moov", b"\x00" * 8)
+    assert main._mp4_moov_end(FTYP + large + moov) == len(FTYP) + len(large) + len(moov)
+
+
+def test_invalid_atom_size():
+    assert main._mp4_moov_end(FTYP + struct.pack(">I4s", 4, b"free")) == -1
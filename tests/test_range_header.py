@@ -0,0 +1,47 @@
+import pytest
+
+from app import main
+
+
+@pytest.mark.parametrize("value", [
+    "items=0-9",
+    "bytes=",
+    "bytes",
+    "bytes=10",
+    "bytes=a-9",
+    "bytes=0-b",
+    "bytes=9-0",
+    "bytes=0-9,x",
+    "bytes=--5",
+])
+def test_malformed_header_is_ignored(value):
+    assert main._parse_range_header(value, 100) is None
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("bytes=0-9", [(0, 9)]),
+    ("BYTES = 0-9", [(0, 9)]),
+    ("bytes=90-", [(90, 99)]),
+    ("bytes=90-500", [(90, 99)]),
+    ("bytes=-10", [(90, 99)]),
+    ("bytes=-500", [(0, 99)]),
+])
+def test_single_range(value, expected):
+    assert main._parse_range_header(value, 100) == expected
+
+
+@pytest.mark.parametrize("value,expected", [
+    ("bytes=0-9,20-29", [(0, 9), (20, 29)]),
+    ("bytes=50-59,0-9", [(0, 9), (50, 59)]),
+    ("bytes=0-9,5-19,20-29", [(0, 29)]),
+    ("bytes=0-9,,20-29", [(0, 9), (20, 29)]),
+    ("bytes=0-9,-10", [(0, 9), (90, 99)]),
+    ("bytes=0-9,200-300", [(0, 9)]),
+])
+def test_multi_range_sorted_and_merged(value, expected):
+    assert main._parse_range_header(value, 100) == expected
+
+
+@pytest.mark.parametrize("value", ["bytes=100-", "bytes=200-300", "bytes=-0", "bytes=100-199,300-"])
+def test_unsatisfiable_ranges(value):
+    assert main._parse_range_header(value, 100) == []
@@ -0,0 +1,104 @@
+import os
+import threading
+import time
+
+import pytest
+
+from app import main
+
+
+def test_failed_input_aborts_sibling_downloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "AUDIO_ASSET_CACHE", None)
+    sibling = {}
+
+    def fake_download(url, out_path, progress=None):
+        if url.endswith("missing.mp3"):
+            time.sleep(0.1)
+            raise RuntimeError("HTTP 404")
+        # Descarga larga que solo para si se aborta
+        with open(out_path, "wb") as f:
+            progress.begin(out_path)
+            deadline = time.monotonic() + 10
+            while time.monotonic() < deadline:
+                progress.check_aborted()
+                f.write(b"x")
+                time.sleep(0.01)
+        sibling["finished"] = True
+        return {}
+
+    monkeypatch.setattr(main, "download_source", fake_download)
+    sources = {
+        "video": ("https://cdn.example.com/video.mp4", str(tmp_path / "video.mp4")),
+        "audio": ("https://cdn.example.com/missing.mp3", str(tmp_path / "audio.mp3")),
+    }
+    fds_before = len(os.listdir("/proc/self/fd"))
+    t0 = time.monotonic()
+    with pytest.raises(RuntimeError, match="HTTP 404"):
+        main._fetch_render_inputs(sources, str(tmp_path))
+    assert time.monotonic() - t0 < 3
+    assert "finished" not in sibling
+    assert len(os.listdir("/proc/self/fd")) == fds_before
+
+
+def test_cancel_aborts_non_streaming_downloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "AUDIO_ASSET_CACHE", None)
+    started = threading.Event()
+
+    def fake_download(url, out_path, progress=None):
+        started.set()
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            progress.check_aborted()
+            time.sleep(0.01)
+        return {}
+
+    monkeypatch.setattr(main, "download_source", fake_download)
+    job = main.RenderJob(lambda j: None)
+    job.status = "running"
+    threading.Thread(target=lambda: started.wait(5) and job.cancel()).start()
+    t0 = time.monotonic()
+    with pytest.raises(main.DownloadAborted):
+        main._fetch_render_inputs({"audio": ("https://cdn.example.com/a.mp3", str(tmp_path / "a.mp3"))},
+                                  str(tmp_path), job=job)
+    assert time.monotonic() - t0 < 3
+
+
+def _member(tmp_path, n):
+    params = {"audio_mode": "two_pass"}
+    return {
+        "params": params, "audio_input": str(tmp_path / "a.mp3"), "image_path": None, "layer_path": None,
+        "single_pass": False, "audio_start": 0.0, "music_gain": None, "duration": 1.0, "video_copy": False,
+        "video_meta": {}, "render_key": f"key{n}", "plan": {"duration": 1.0, "video_path": "encode", "sources": {}},
+    }
+
+
+def test_batch_publish_failure_keeps_other_variants_and_cleans_staging(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "build_batch_command", lambda inputs, outputs: "ffmpeg")
+
+    def fake_run(cmd, job=None, duration=0.0, **kwargs):
+        for out in written:
+            with open(out, "wb") as f:
+                f.write(b"mp4")
+
+    written = []
+    real_staging = main._staging_path
+    monkeypatch.setattr(main, "_staging_path", lambda uuid: written.append(real_staging(uuid)) or written[-1])
+    monkeypatch.setattr(main, "run", fake_run)
+    monkeypatch.setattr(main, "_encode_stats", lambda *a: {})
+    calls = []
+
+    def fake_publish(staging, video_uuid, base_url, info=None, renditions=None):
+        calls.append(video_uuid)
+        if len(calls) == 2:
+            raise Exception("disk full")
+        os.remove(staging)
+        return {"download_url": f"{base_url}/download/{video_uuid}.mp4"}
+
+    monkeypatch.setattr(main, "_publish_video", fake_publish)
+    members = [_member(tmp_path, n) for n in range(3)]
+    results = main._batch_encode(str(tmp_path / "v.mp4"), members, "http://t")
+
+    assert [r.get("status") for r in results] == [None, "failed", None]
+    assert "disk full" in results[1]["error"]
+    assert results[2]["download_url"].endswith(f"{members[2]['video_uuid']}.mp4")
+    assert not any(os.path.exists(path) for path in written)
@@ -0,0 +1,76 @@
+import pytest
+
+from app import main
+
+
+def _names(renditions):
+    return [r["name"] for r in renditions]
+
+
+def test_draft_drops_renditions_not_smaller_than_capped_output():
+    renditions = main.parse_renditions("1080p,720p,480p,poster")
+    kept = main.drop_capped_renditions(renditions, {"encoder_profile": "draft"}, (1080, 1920))
+    assert _names(kept) == ["480p", "poster"]
+
+
+def test_draft_keeps_renditions_of_small_sources():
+    renditions = main.parse_renditions("720p,480p")
+    assert main.drop_capped_renditions(renditions, {"encoder_profile": "draft"}, (540, 960)) == renditions
+
+
+def test_draft_keeps_custom_size_with_other_aspect():
+    renditions = main.parse_renditions("1080x1080,1080x1920,540x960")
+    kept = main.drop_capped_renditions(renditions, {"encoder_profile": "draft"}, (1080, 1920))
+    assert _names(kept) == ["1080x1080"]
+
+
+@pytest.mark.parametrize("profile", ["social", "archive"])
+def test_profiles_without_cap_keep_all(profile):
+    renditions = main.parse_renditions("1080p,720p")
+    assert main.drop_capped_renditions(renditions, {"encoder_profile": profile}, (1080, 1920)) == renditions
+
+
+def test_unknown_frame_size_keeps_all():
+    renditions = main.parse_renditions("720p")
+    assert main.drop_capped_renditions(renditions, {"encoder_profile": "draft"}, None) == renditions
+
+
+def test_parse_renditions_normalizes_and_deduplicates():
+    assert _names(main.parse_renditions(" 720P, 480p ,720p,,poster,poster")) == ["720p", "480p", "poster"]
+    assert main.parse_renditions("") == []
+    assert main.parse_renditions(None) == []
+
+
+def test_parse_renditions_shapes():
+    ladder, custom, poster = main.parse_renditions("720p,480x854,poster")
+    assert ladder["ext"] == "mp4" and "720" in ladder["scale"]
+    assert custom["scale"] == main.build_scale_pad("480x854")
+    assert poster == {"name": "poster", "ext": "jpg", "scale": None}
+
+
+@pytest.mark.parametrize("value,message", [
+    ("4k", "unknown rendition 4k"),
+    ("720", "unknown rendition 720"),
+    ("1x1", "unknown rendition 1x1"),
+    ("12345x100", "unknown rendition 12345x100"),
+    ("480x-854", "unknown rendition 480x-854"),
+    ("481x854", "must have even dimensions"),
+    ("480x853", "must have even dimensions"),
+])
+def test_parse_renditions_invalid(value, message):
+    with pytest.raises(ValueError, match=message):
+        main.parse_renditions(value)
+
+
+def test_parse_renditions_max(monkeypatch):
+    monkeypatch.setattr(main, "RENDITIONS_MAX", 2)
+    assert len(main.parse_renditions("720p,480p,720p")) == 2
+    with pytest.raises(ValueError, match="at most 2"):
+        main.parse_renditions("720p,480p,poster")
+
+
+def test_invalid_renditions_rejected_by_params_validation():
+    params = main._batch_variant_params({}, {"video_url": "https://cdn.example.com/v.mp4",
+                                             "audio_url": "https://cdn.example.com/a.mp3",
+                                             "renditions": "720p,4k"})
+    assert main._render_params_error(params) == "renditions invalid: unknown rendition 4k"